@@ -0,0 +1,74 @@
+# This code encodes the scene images with the ResNet used by the physical attention static pooling and writes the
+# features in the feature store (<group>/scene_features/<scene>_<image hash>.npy), so that training and evaluation
+# do not need to run the ResNet
+
+import argparse
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from sgan.context.physical_attention import Attention_Encoder
+from sgan.context.scene_feature_store import SEGMENTED_SCENES_FOLDER, get_image_hash, get_scene_features_path, \
+    read_scene_image, encode_scene_images, save_scene_features
+from sgan.model.folder_utils import get_root_dir
+from sgan.model.utils import get_device
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_folder', default=get_root_dir() + '/datasets/safegan_dataset/', type=str)
+parser.add_argument('--encoded_image_size', default=14, type=int)
+parser.add_argument('--batch_size', default=8, type=int)
+parser.add_argument('--num_workers', default=4, type=int)
+parser.add_argument('--overwrite', default=0, type=int)
+
+
+def list_scene_images(data_folder, overwrite=False):
+    """ Return (scene name, image path, features path) of all the scene images still to encode """
+    scene_images = []
+    for group in sorted(os.listdir(data_folder)):
+        path_group = os.path.join(data_folder, group)
+        images_folder = os.path.join(path_group, SEGMENTED_SCENES_FOLDER)
+        if not os.path.isdir(images_folder):
+            continue
+        for image_name in sorted(os.listdir(images_folder)):
+            if not image_name.endswith('.jpg'):
+                continue
+            name = image_name[:-len('.jpg')]
+            image_path = os.path.join(images_folder, image_name)
+            features_path = get_scene_features_path(path_group, name, get_image_hash(image_path))
+            if overwrite or not os.path.isfile(features_path):
+                scene_images.append((name, image_path, features_path))
+    return scene_images
+
+
+def build_scene_features(data_folder, encoded_image_size=14, batch_size=8, num_workers=4, overwrite=False):
+    scene_images = list_scene_images(data_folder, overwrite)
+    if len(scene_images) == 0:
+        print("All scene images are already encoded")
+        return
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        images = list(executor.map(read_scene_image, [image_path for _, image_path, _ in scene_images]))
+
+    # Only images with the same size can be encoded in the same batch
+    same_size = defaultdict(list)
+    for scene_image, image in zip(scene_images, images):
+        same_size[image.shape].append((scene_image, image))
+
+    attention_encoder = Attention_Encoder(encoded_image_size).to(get_device())
+    for shape, scenes in same_size.items():
+        for start in range(0, len(scenes), batch_size):
+            batch = scenes[start:start + batch_size]
+            features = encode_scene_images(attention_encoder, [image for _, image in batch])
+            for ((name, _, features_path), _), scene_features in zip(batch, features):
+                print("\n***** saving scene features {}:\n".format(scene_features.shape), features_path)
+                save_scene_features(features_path, scene_features)
+
+
+def main(args):
+    build_scene_features(args.data_folder, args.encoded_image_size, args.batch_size, args.num_workers, args.overwrite)
+    return True
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,42 @@
+# This code generates, for each scene, the tables with the precomputed beam distances used by the raycast and polar
+# static pooling (see StaticSceneFeatureExtractorRaycast / StaticSceneFeatureExtractorPolar)
+
+import argparse
+import os
+import numpy as np
+
+from sgan.context.static_pooling_algorithms import build_beam_lookup_table, get_beam_lookup_table_name
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_folder', default='datasets/safegan_dataset/SDD/', type=str)
+parser.add_argument('--boundary_file', default='world_points_boundary.npy', type=str)
+parser.add_argument('--num_cells', default=8, type=int)
+parser.add_argument('--neighborhood_size', default=2.0, type=float)
+parser.add_argument('--cell_size', default=0.25, type=float)
+parser.add_argument('--num_headings', default=16, type=int)
+
+
+def generate_beam_lookup_tables(data_folder, boundary_file, num_beams, radius, cell_size, num_headings):
+    for scene_folder in sorted(os.listdir(data_folder)):
+        path = os.path.join(data_folder, scene_folder)
+        if not os.path.isfile(os.path.join(path, boundary_file)):
+            continue
+        boundary_points = np.load(os.path.join(path, boundary_file))
+
+        for pool_static_type in ('raycast', 'polar'):
+            lookup_table = build_beam_lookup_table(boundary_points, num_beams, radius, polar=(pool_static_type == 'polar'),
+                                                   cell_size=cell_size, num_headings=num_headings)
+            file_name = os.path.join(path, get_beam_lookup_table_name(pool_static_type, num_beams))
+            print("\n***** saving {} lookup table {}:\n".format(pool_static_type, lookup_table['table'].shape), file_name)
+            np.savez_compressed(file_name, **lookup_table)
+
+
+def main(args):
+    generate_beam_lookup_tables(args.data_folder, args.boundary_file, args.num_cells, args.neighborhood_size,
+                                args.cell_size, args.num_headings)
+    return True
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,38 @@
+# This code generates, for each scene, the boundary points down-sampled uniformly in space at several resolutions
+# (world_points_boundary_levels.npz), used instead of taking one every k points of world_points_boundary.npy
+
+import argparse
+import os
+import numpy as np
+
+from sgan.data.boundary_points import BOUNDARY_POINTS_FILE, BOUNDARY_LEVELS_FILE, build_boundary_levels, get_levels
+from sgan.model.utils import int_tuple
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_folder', default='datasets/safegan_dataset/SDD/', type=str)
+parser.add_argument('--levels', default='64,200,1000', type=int_tuple)
+parser.add_argument('--voxel_size', default=0.05, type=float)
+
+
+def generate_boundary_levels(data_folder, levels, voxel_size):
+    for scene_folder in sorted(os.listdir(data_folder)):
+        path = os.path.join(data_folder, scene_folder)
+        if not os.path.isfile(os.path.join(path, BOUNDARY_POINTS_FILE)):
+            continue
+        boundary_points = np.load(os.path.join(path, BOUNDARY_POINTS_FILE))
+        boundary_levels = build_boundary_levels(boundary_points, levels, voxel_size)
+
+        print("\n***** saving boundary levels:\n", os.path.join(path, BOUNDARY_LEVELS_FILE))
+        for level, coverage in get_levels(boundary_levels):
+            print("{} points: coverage {:.3f} m".format(level, coverage))
+        np.savez_compressed(os.path.join(path, BOUNDARY_LEVELS_FILE), **boundary_levels)
+
+
+def main(args):
+    generate_boundary_levels(args.data_folder, args.levels, args.voxel_size)
+    return True
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
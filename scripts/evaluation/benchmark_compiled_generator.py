@@ -0,0 +1,89 @@
+# This code measures the latency of a generator, eager and compiled with torch.compile (see compile_generator), on the
+# sequences of a single scene of the test split, and checks that both predict the same trajectories
+
+import argparse
+import os
+import sys
+import torch
+from attrdict import AttrDict
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(current_path, os.path.pardir))
+
+from sgan.data.loader import data_loader
+from sgan.model.utils import get_device, set_device, set_num_threads, bool_flag
+from sgan.model.folder_utils import get_root_dir, get_test_data_path
+from sgan.model.compiled_inference import compile_generator
+from scripts.helpers.helper_get_generator import helper_get_generator
+from scripts.evaluation.quantize_generator import benchmark_generator
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model_path', default='results/models/SDD/SafeGAN/checkpoint_200_with_model.pt', type=str)
+parser.add_argument('--compile_mode', default='default', type=str)
+parser.add_argument('--scene_id', default=0, type=int)  # index of the scene in the test split
+parser.add_argument('--num_runs', default=50, type=int)
+parser.add_argument('--device', default='cpu', type=str)
+parser.add_argument('--num_threads', default=0, type=int)
+parser.add_argument('--num_interop_threads', default=0, type=int)
+parser.add_argument('--check_outputs', default=1, type=bool_flag)
+
+
+def get_scene_batch(loader, scene_id):
+    """ The sequences of the first batch that holds the scene, restricted to that scene """
+    for batch in loader:
+        (obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel,
+         non_linear_ped, loss_mask, traj_frames, seq_start_end, seq_scene_ids) = batch
+        in_scene = (seq_scene_ids == scene_id).nonzero().view(-1)
+        if in_scene.numel() == 0:
+            continue
+        seq_start_end = seq_start_end[in_scene]
+        peds = torch.cat([torch.arange(start, end) for start, end in seq_start_end.tolist()])
+        offsets = torch.cumsum(seq_start_end[:, 1] - seq_start_end[:, 0], dim=0)
+        seq_start_end = torch.stack([offsets - (seq_start_end[:, 1] - seq_start_end[:, 0]), offsets], dim=1)
+        return [obs_traj[:, peds], pred_traj_gt[:, peds], obs_traj_rel[:, peds], pred_traj_gt_rel[:, peds],
+                non_linear_ped[peds], loss_mask[peds], traj_frames, seq_start_end, seq_scene_ids[in_scene]]
+    print("No sequence of scene {} in the test split!".format(scene_id))
+    exit()
+
+
+def main(args):
+    set_num_threads(args.num_threads, args.num_interop_threads)
+    set_device(args.device)
+
+    checkpoint = torch.load(os.path.join(get_root_dir(), args.model_path), map_location=get_device())
+    model_args = AttrDict(checkpoint['args'])
+    test_path = get_test_data_path(model_args.dataset_name)
+    generator = helper_get_generator(model_args, test_path)
+    generator.load_state_dict(checkpoint['g_best_state'])
+    generator.to(get_device())
+    generator.eval()
+
+    _, loader = data_loader(model_args, test_path, shuffle=False)
+    batch = get_scene_batch(loader, args.scene_id)
+    latency = benchmark_generator(generator, batch, args.num_runs)
+
+    if args.check_outputs:
+        (obs_traj, _, obs_traj_rel, _, _, _, _, seq_start_end, seq_scene_ids) = [tensor.to(get_device()) for tensor in batch]
+        with torch.no_grad():
+            torch.manual_seed(0)
+            pred_eager = generator(obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids)
+
+    # Compilation and recompilations happen during the warmup runs of the benchmark
+    compile_generator(generator, args.compile_mode)
+    latency_compiled = benchmark_generator(generator, batch, args.num_runs)
+
+    if args.check_outputs:
+        with torch.no_grad():
+            torch.manual_seed(0)
+            pred_compiled = generator(obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids)
+        print('Max difference of the predictions: {:.2e}'.format((pred_compiled - pred_eager).abs().max().item()))
+
+    print('Latency (scene {}, {} pedestrians, {}) eager: {:.2f} ms compiled ({}): {:.2f} ms (x{:.2f})'.format(
+        args.scene_id, batch[0].size(1), get_device(), latency, args.compile_mode, latency_compiled,
+        latency / latency_compiled))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
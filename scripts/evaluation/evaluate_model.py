@@ -3,19 +3,17 @@ import torch
 import sys
 import pickle
 import argparse
-import matplotlib.pyplot as plt
-import matplotlib
 import numpy as np
-import imageio
 from attrdict import AttrDict
 
 current_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(0, os.path.join(current_path, os.path.pardir))
 
 from sgan.data.loader import data_loader
-from sgan.model.utils import bool_flag
-from scripts.helpers.helper_get_generator import get_generator
+from sgan.model.utils import bool_flag, get_device, set_device, set_num_threads
+from scripts.helpers.helper_get_generator import get_generator, get_quantized_generator
 from sgan.model.models_static_scene import get_homography_and_map, get_pixels_from_world
+from sgan.model.homography import HomographyTransform
 from sgan.model.utils import relative_to_abs
 from sgan.model.folder_utils import get_root_dir, get_test_data_path, get_dset_name, get_dset_group_name, get_sdd_dir
 from sgan.model.losses import displacement_error, final_displacement_error
@@ -40,10 +38,11 @@ def evaluate_helper(error, seq_start_end, min=True):
         sum_ += _error.mean()
     return sum_
 
-def get_trajectories(generator, obs_traj, obs_traj_rel, seq_start_end, pred_traj_gt, seq_scene_ids, path=None):
-
+def get_trajectories(generator, obs_traj, obs_traj_rel, seq_start_end, pred_traj_gt, seq_scene_ids, path=None,
+                     num_samples=1):
+    """ Trajectories of shape (num_samples, pred_len, batch, 2), all the samples being decoded at once """
     (seq_len, batch_size, _) = pred_traj_gt.size()
-    pred_traj_fake_rel = generator(obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids)
+    pred_traj_fake_rel = generator.sample(obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids, num_samples=num_samples)
 
     pred_traj_fake = relative_to_abs(pred_traj_fake_rel, obs_traj[-1])
     return pred_traj_fake, pred_traj_fake_rel
@@ -127,7 +126,7 @@ def plot_occ_pix(ax, pixels):
 
 
 def on_occupied(traj1, ii, static_map, num_points, seq_length, minimum_distance=.25):
-    img = torch.tensor(static_map).float().cuda()
+    img = torch.tensor(static_map, dtype=torch.float, device=traj1.device)
     overlap = torch.norm(traj1[ii].repeat(num_points, 1) - img.repeat(seq_length, 1), dim=1)
     cols1 = torch.sum(overlap < minimum_distance, dim=0)
     if cols1 > 0:
@@ -176,14 +175,15 @@ def load_pickle(name, scene, num, data_set, model_name):
     return list
 
 
-def collect_generated_samples(args, generator1, generator2, data_dir, data_set, model_name, selected_scene=None, selected_batch=-1):
+def collect_generated_samples(args, generator1, generator2, data_dir, data_set, model_name, selected_scene=None, selected_batch=-1,
+                              boundary_tolerance=None):
     num_samples = 10 # args.best_k
     _, loader = data_loader(args, data_dir, shuffle=False)
 
     with torch.no_grad():
         for b, batch in enumerate(loader):
             print('batch = {}'.format(b))
-            batch = [tensor.cuda() for tensor in batch]
+            batch = [tensor.to(get_device()) for tensor in batch]
             if b != selected_batch and selected_batch != -1:
                continue
 
@@ -197,8 +197,10 @@ def collect_generated_samples(args, generator1, generator2, data_dir, data_set,
             for i, (start, end) in enumerate(seq_start_end):
                 dataset_name = seq_scenes[i]
                 path = get_path(dataset_name)
+                import imageio  # only the plots of the video frames need it
                 reader = imageio.get_reader(get_sdd_dir(dataset_name, 'video'), 'ffmpeg')
-                annotated_points, h = get_homography_and_map(dataset_name, "/world_points_boundary.npy")
+                annotated_points, h = get_homography_and_map(dataset_name, "/world_points_boundary.npy",
+                                                             tolerance=boundary_tolerance)
                 homography_list.append(h)
                 annotated_points_list.append(annotated_points)
                 scene_name_list.append(dataset_name)
@@ -225,18 +227,15 @@ def collect_generated_samples(args, generator1, generator2, data_dir, data_set,
             save_pickle(scene_name_list, 'scene_name_list', selected_scene, b, data_set, model_name)
             save_pickle(scene_information, 'scene_information', selected_scene, b, data_set, model_name)
 
-            pred_traj_fake1_list, pred_traj_fake2_list = [], []
-
-            for sample in range(num_samples):
-                pred_traj_fake1, _ = get_trajectories(generator1, obs_traj, obs_traj_rel,
-                                                      seq_start_end, pred_traj_gt,
-                                                      seq_scene_ids, data_dir)
-                pred_traj_fake2, _ = get_trajectories(generator2, obs_traj, obs_traj_rel,
-                                                      seq_start_end, pred_traj_gt,
-                                                      seq_scene_ids, data_dir)
-
-                pred_traj_fake1_list.append(pred_traj_fake1)
-                pred_traj_fake2_list.append(pred_traj_fake2)
+            pred_traj_fake1, _ = get_trajectories(generator1, obs_traj, obs_traj_rel,
+                                                  seq_start_end, pred_traj_gt,
+                                                  seq_scene_ids, data_dir, num_samples)
+            pred_traj_fake2, _ = get_trajectories(generator2, obs_traj, obs_traj_rel,
+                                                  seq_start_end, pred_traj_gt,
+                                                  seq_scene_ids, data_dir, num_samples)
+            # The pickles keep one tensor of shape (pred_len, batch, 2) per sample
+            pred_traj_fake1_list = list(pred_traj_fake1.unbind(0))
+            pred_traj_fake2_list = list(pred_traj_fake2.unbind(0))
 
             save_pickle(pred_traj_fake1_list, 'pred_traj_fake1_list', selected_scene, b, data_set, model_name)
             save_pickle(pred_traj_fake2_list, 'pred_traj_fake2_list', selected_scene, b, data_set, model_name)
@@ -255,6 +254,7 @@ def evaluate_trajectory_quality(data_set, scene, model_name, batch=5, selection=
     annotated_points_list = load_pickle('annotated_points_list', scene, batch, data_set, model_name)
     scene_name_list = load_pickle('scene_name_list', scene, batch, data_set, model_name)
 
+    import matplotlib.pyplot as plt  # only the interactive plots need it
     fig, ((ax1, ax14), (ax15, ax4)) = plt.subplots(2, 2, figsize=(32, 32), num=1)
 
     num_samples = len(pred_traj_fake1_list)
@@ -359,7 +359,8 @@ def evaluate_test_ade(data_set, model_name, selected_scene=None, selected_batch=
     ade2 = evaluate_helper(ade2, seq_start_end) / (total_traj * pred_len)
     return ade1, ade2
 
-def evaluate_test_pixel_ade(data_set, model_name, selected_scene=None, selected_batch=-1):
+def get_pixel_trajectories(data_set, model_name, selected_scene=None, selected_batch=-1):
+    """ Ground truth and samples of both models in pixel coordinates, all scenes of the batch at once """
     pred_traj_gt = load_pickle('pred_traj_gt', selected_scene, selected_batch, data_set, model_name)
     seq_start_end = load_pickle('seq_start_end', selected_scene, selected_batch, data_set, model_name)
     scene_name_list = load_pickle('scene_name_list', selected_scene, selected_batch, data_set, model_name)
@@ -369,41 +370,31 @@ def evaluate_test_pixel_ade(data_set, model_name, selected_scene=None, selected_
 
     homography_list = load_pickle('homography_list', selected_scene, selected_batch, data_set, model_name)
 
-    num_samples = len(pred_traj_fake1_list)
-    ade1 = []
-    ade2 = []
     scene_name = np.unique(scene_name_list)
     print(scene_name)
 
-    for s in range(num_samples): # seq_len, batch, 2
-        traj1_pixels, traj2_pixels, traj_gt_pixels = [], [], []
-        total_traj = pred_traj_gt.size(1)
-        for i, (start, end) in enumerate(seq_start_end):
-            # get homography of current scene
-            h = homography_list[i]
-            num_ped = end - start
-            # calculate pixels for a sample in a scene
-            pixels_t1 = get_pixels_from_world(pred_traj_fake1_list[s][:, start:end].contiguous().view(-1, 2), h)
-            pixels_t2 = get_pixels_from_world(pred_traj_fake2_list[s][:, start:end].contiguous().view(-1, 2), h)
-            pixels_gt = get_pixels_from_world(pred_traj_gt[:, start:end].contiguous().view(-1, 2), h)
-            t1 = torch.from_numpy(pixels_t1).view(-1, num_ped, 2) # time, peds in scene, 2
-            t2 = torch.from_numpy(pixels_t2).view(-1, num_ped, 2)
-            tg = torch.from_numpy(pixels_gt).view(-1, num_ped, 2)
-
-            traj1_pixels.append(t1)
-            traj2_pixels.append(t2)
-            traj_gt_pixels.append(tg)
-
-        # concatignate along batch dimension
-        traj1_pixels = torch.cat(traj1_pixels, dim=1)
-        traj2_pixels = torch.cat(traj2_pixels, dim=1)
-        traj_gt_pixels = torch.cat(traj_gt_pixels, dim=1)
+    homography_transform = HomographyTransform()
+    for dataset_name, h in zip(scene_name_list, homography_list):
+        homography_transform.add_scene(dataset_name, h)
+
+    # (num_samples, seq_len, batch, 2)
+    traj1_pixels = homography_transform.world_to_pixels(torch.stack(pred_traj_fake1_list), seq_start_end, scene_name_list)
+    traj2_pixels = homography_transform.world_to_pixels(torch.stack(pred_traj_fake2_list), seq_start_end, scene_name_list)
+    traj_gt_pixels = homography_transform.world_to_pixels(pred_traj_gt, seq_start_end, scene_name_list)
+    return traj1_pixels, traj2_pixels, traj_gt_pixels, seq_start_end
 
+
+def evaluate_test_pixel_ade(data_set, model_name, selected_scene=None, selected_batch=-1):
+    traj1_pixels, traj2_pixels, traj_gt_pixels, seq_start_end = get_pixel_trajectories(data_set, model_name, selected_scene, selected_batch)
+
+    ade1 = []
+    ade2 = []
+    for s in range(traj1_pixels.size(0)): # seq_len, batch, 2
         # (seq_len, batch, 2) for each sample we calculate displacement error
-        ade1.append(displacement_error(traj1_pixels.view(-1, total_traj, 2), traj_gt_pixels.view(-1, total_traj, 2), mode='raw'))
-        ade2.append(displacement_error(traj2_pixels.view(-1, total_traj, 2), traj_gt_pixels.view(-1, total_traj, 2), mode='raw'))
+        ade1.append(displacement_error(traj1_pixels[s], traj_gt_pixels, mode='raw'))
+        ade2.append(displacement_error(traj2_pixels[s], traj_gt_pixels, mode='raw'))
 
-    pred_len = pred_traj_gt.size(0)
+    pred_len, total_traj, _ = traj_gt_pixels.size()
     ade1 = evaluate_helper(ade1, seq_start_end) / (total_traj * pred_len)
     ade2 = evaluate_helper(ade2, seq_start_end) / (total_traj * pred_len)
     return ade1, ade2
@@ -432,50 +423,15 @@ def evaluate_test_fde(data_set, model_name, selected_scene=None, selected_batch=
     return ade1, ade2
 
 def evaluate_test_pixel_fde(data_set, model_name, selected_scene=None, selected_batch=-1):
-    pred_traj_gt = load_pickle('pred_traj_gt', selected_scene, selected_batch, data_set, model_name)
-    seq_start_end = load_pickle('seq_start_end', selected_scene, selected_batch, data_set, model_name)
-    scene_name_list = load_pickle('scene_name_list', selected_scene, selected_batch, data_set, model_name)
-
-    pred_traj_fake1_list = load_pickle('pred_traj_fake1_list', selected_scene, selected_batch, data_set, model_name)
-    pred_traj_fake2_list = load_pickle('pred_traj_fake2_list', selected_scene, selected_batch, data_set, model_name)
-
-    homography_list = load_pickle('homography_list', selected_scene, selected_batch, data_set, model_name)
+    traj1_pixels, traj2_pixels, traj_gt_pixels, seq_start_end = get_pixel_trajectories(data_set, model_name, selected_scene, selected_batch)
 
-    num_samples = len(pred_traj_fake1_list)
     ade1 = []
     ade2 = []
-    scene_name = np.unique(scene_name_list)
-    print(scene_name)
+    for s in range(traj1_pixels.size(0)): # seq_len, batch, 2
+        ade1.append(final_displacement_error(traj1_pixels[s, -1], traj_gt_pixels[-1], mode='raw'))
+        ade2.append(final_displacement_error(traj2_pixels[s, -1], traj_gt_pixels[-1], mode='raw'))
 
-    for s in range(num_samples): # seq_len, batch, 2
-        traj1_pixels, traj2_pixels, traj_gt_pixels = [], [], []
-        total_traj = pred_traj_gt.size(1)
-        for i, (start, end) in enumerate(seq_start_end):
-            # get homography of current scene
-            h = homography_list[i]
-            num_ped = end - start
-            # calculate pixels for a sample in a scene
-            pixels_t1 = get_pixels_from_world(pred_traj_fake1_list[s][:, start:end].contiguous().view(-1, 2), h)
-            pixels_t2 = get_pixels_from_world(pred_traj_fake2_list[s][:, start:end].contiguous().view(-1, 2), h)
-            pixels_gt = get_pixels_from_world(pred_traj_gt[:, start:end].contiguous().view(-1, 2), h)
-            t1 = torch.from_numpy(pixels_t1).view(-1, num_ped, 2) # time, peds in scene, 2
-            t2 = torch.from_numpy(pixels_t2).view(-1, num_ped, 2)
-            tg = torch.from_numpy(pixels_gt).view(-1, num_ped, 2)
-
-            traj1_pixels.append(t1)
-            traj2_pixels.append(t2)
-            traj_gt_pixels.append(tg)
-
-        # concatignate along batch dimension
-        traj1_pixels = torch.cat(traj1_pixels, dim=1)
-        traj2_pixels = torch.cat(traj2_pixels, dim=1)
-        traj_gt_pixels = torch.cat(traj_gt_pixels, dim=1)
-
-        # (seq_len, batch, 2) for each sample we calculate displacement error
-        ade1.append(final_displacement_error(traj1_pixels.view(-1, total_traj, 2)[-1], traj_gt_pixels.view(-1, total_traj, 2)[-1], mode='raw'))
-        ade2.append(final_displacement_error(traj2_pixels.view(-1, total_traj, 2)[-1], traj_gt_pixels.view(-1, total_traj, 2)[-1], mode='raw'))
-
-    pred_len = pred_traj_gt.size(0)
+    total_traj = traj_gt_pixels.size(1)
     ade1 = evaluate_helper(ade1, seq_start_end) / (total_traj)
     ade2 = evaluate_helper(ade2, seq_start_end) / (total_traj)
     return ade1, ade2
@@ -531,6 +487,8 @@ def evaluate_test_occs(data_set, scene, model_name, batch=1):
     return ade1, ade2
 
 def main(args):
+    set_num_threads(args.num_threads, args.num_interop_threads)
+    set_device(args.device)
     data_set = 'TRAJNET'
     model_path1 = os.path.join(get_root_dir(),
                                'results/models/{}/{}/{}'.format(data_set, args.model_folder, args.model_name1))
@@ -540,19 +498,27 @@ def main(args):
     data_dir = get_test_data_path(data_set.lower())
 
     # load checkpoint of first model and arguments
-    checkpoint1 = torch.load(model_path1)
-    args1 = AttrDict(checkpoint1['args'])
-    print('Loading model from path: ' + model_path1)
-    generator1 = get_generator(checkpoint1, args1)
+    if args.quantized_model_path is not None:
+        # The int8 generator replaces the first model, everything then runs on the CPU
+        quantized_model_path = os.path.join(get_root_dir(), args.quantized_model_path)
+        print('Loading quantized model from path: ' + quantized_model_path)
+        generator1, args1 = get_quantized_generator(quantized_model_path)
+        args1 = AttrDict(args1)
+    else:
+        checkpoint1 = torch.load(model_path1, map_location=get_device())
+        args1 = AttrDict(checkpoint1['args'])
+        print('Loading model from path: ' + model_path1)
+        generator1 = get_generator(checkpoint1, args1, args.compile_mode)
 
     # load checkpoing of second model
-    checkpoint2 = torch.load(model_path2)
+    checkpoint2 = torch.load(model_path2, map_location=get_device())
     args2 = AttrDict(checkpoint2['args'])
     print('Loading model from path: ' + model_path2)
-    generator2 = get_generator(checkpoint2, args2)
+    generator2 = get_generator(checkpoint2, args2, args.compile_mode)
 
     if args.precompute_required:
-        collect_generated_samples(args1, generator1, generator2, data_dir, data_set, args.model_folder, selected_scene=args.scene, selected_batch=-1)
+        collect_generated_samples(args1, generator1, generator2, data_dir, data_set, args.model_folder, selected_scene=args.scene, selected_batch=-1,
+                                  boundary_tolerance=args.boundary_tolerance)
 
     m1, m2, counter = 0, 0, 0
     for batch in range(0, 16):
@@ -584,6 +550,17 @@ parser.add_argument('--precompute_required', default=1, type=bool_flag)
 parser.add_argument('--model_folder', default='SafeGAN', type=str)
 parser.add_argument('--model_name1', default='checkpoint_200_with_model.pt', type=str)
 parser.add_argument('--model_name2', default='checkpoint_100_with_model.pt', type=str)
+# torch.compile mode of the generators (default, reduce-overhead, max-autotune), not compiled if not given. Same
+# predictions as the eager generators, not a measured speedup: see benchmark_compiled_generator.py
+parser.add_argument('--compile_mode', default=None, type=str)
+# int8 generator exported by quantize_generator.py, evaluated in place of model_name1 (on the CPU)
+parser.add_argument('--quantized_model_path', default=None, type=str)
+# cpu, cuda, cuda:1, ... (the GPU if available when not given), and CPU threads (0: PyTorch defaults)
+parser.add_argument('--device', default=None, type=str)
+parser.add_argument('--num_threads', default=0, type=int)
+parser.add_argument('--num_interop_threads', default=0, type=int)
+# Boundary points of the occupancy metrics from the precomputed levels within this tolerance (m), if given
+parser.add_argument('--boundary_tolerance', default=None, type=float)
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -2,7 +2,6 @@
 import torch
 import matplotlib.pyplot as plt
 from attrdict import AttrDict
-import imageio
 import numpy as np
 import sys
 import os
@@ -13,6 +12,7 @@ sys.path.insert(0, os.path.join(current_path, os.path.pardir))
 
 from sgan.model.folder_utils import get_test_data_path
 from scripts.helpers.helper_get_critic import helper_get_critic
+from sgan.model.utils import get_device
 
 
 fig, (ax1) = plt.subplots(1, 1, figsize=(8, 8), num=1)
@@ -70,7 +70,7 @@ def get_critic(checkpoint_in, args):
     test_path = get_test_data_path(args.dataset_name)
     critic = helper_get_critic(args, test_path)
     critic.load_state_dict(checkpoint_in['c_state'])
-    critic.cuda()
+    critic.to(get_device())
     critic.eval()
     return critic
 
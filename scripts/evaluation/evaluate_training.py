@@ -38,11 +38,11 @@ def main(args):
         paths = [path for path in paths if 'no_model' not in path]
 
         # load checkpoint of first model and arguments
-        checkpoint1 = torch.load(paths[0])
+        checkpoint1 = torch.load(paths[0], map_location='cpu')
         print('Loading model from path: ' + paths[0])
 
         # load checkpoing of second model
-        checkpoint2 = torch.load(paths[1])
+        checkpoint2 = torch.load(paths[1], map_location='cpu')
         print('Loading model from path: ' + paths[1])
 
         evaluate_training_metric(checkpoint1, checkpoint2, args.metric, 'val')
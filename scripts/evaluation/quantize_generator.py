@@ -0,0 +1,116 @@
+# This code exports an int8 dynamic quantized generator for CPU inference, with a report of the accuracy (ADE/FDE on the
+# test split) and of the latency of the fp32 and int8 generators. The exported file is loaded with get_quantized_generator
+# It runs on the CPU, since dynamic quantized layers run on the CPU only
+
+import argparse
+import copy
+import os
+import sys
+import time
+import torch
+import numpy as np
+from attrdict import AttrDict
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(current_path, os.path.pardir))
+
+from sgan.data.loader import data_loader
+from sgan.model.utils import get_device, set_device, set_num_threads, relative_to_abs
+from sgan.model.folder_utils import get_root_dir, get_test_data_path
+from sgan.model.losses import displacement_error, final_displacement_error
+from sgan.model.quantization import quantize_generator
+from scripts.helpers.helper_get_generator import helper_get_generator
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model_path', default='results/models/SDD/SafeGAN/checkpoint_200_with_model.pt', type=str)
+parser.add_argument('--output_path', default=None, type=str)  # model_path with the _int8 suffix if not given
+parser.add_argument('--num_runs', default=50, type=int)  # runs of the latency benchmark
+parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('--num_threads', default=0, type=int)  # CPU threads (0: PyTorch default)
+parser.add_argument('--num_interop_threads', default=0, type=int)
+
+
+def evaluate_generator(args, loader, generator, seed):
+    """ ADE and FDE on the loader, with the same noise (seed) for all the generators compared """
+    ade, fde, total_traj = 0., 0., 0
+    with torch.no_grad():
+        for b, batch in enumerate(loader):
+            batch = [tensor.to(get_device()) for tensor in batch]
+            (obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel,
+             non_linear_ped, loss_mask, _, seq_start_end, seq_scene_ids) = batch
+
+            torch.manual_seed(seed + b)
+            pred_traj_fake_rel = generator(obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids)
+            pred_traj_fake = relative_to_abs(pred_traj_fake_rel, obs_traj[-1])
+
+            ade += displacement_error(pred_traj_fake, pred_traj_gt).item()
+            fde += final_displacement_error(pred_traj_fake[-1], pred_traj_gt[-1]).item()
+            total_traj += pred_traj_gt.size(1)
+    return ade / (total_traj * args.pred_len), fde / total_traj
+
+
+def benchmark_generator(generator, batch, num_runs, num_warmup=5):
+    """ Median latency in ms of the generator on one batch """
+    (obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel,
+     non_linear_ped, loss_mask, _, seq_start_end, seq_scene_ids) = [tensor.to(get_device()) for tensor in batch]
+    latencies = []
+    with torch.no_grad():
+        for run in range(num_warmup + num_runs):
+            start = time.perf_counter()
+            generator(obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids)
+            if run >= num_warmup:
+                latencies.append(time.perf_counter() - start)
+    return 1000 * np.median(latencies)
+
+
+def main(args):
+    set_num_threads(args.num_threads, args.num_interop_threads)
+    set_device('cpu')
+
+    model_path = os.path.join(get_root_dir(), args.model_path)
+    output_path = args.output_path or '{}_int8.pt'.format(os.path.splitext(model_path)[0])
+
+    checkpoint = torch.load(model_path, map_location=get_device())
+    model_args = AttrDict(checkpoint['args'])
+    test_path = get_test_data_path(model_args.dataset_name)
+    generator = helper_get_generator(model_args, test_path)
+    generator.load_state_dict(checkpoint['g_best_state'])
+    generator.eval()
+
+    quantized_generator = copy.deepcopy(generator)
+    quantized_modules = quantize_generator(quantized_generator)
+    print('Quantized layers ({}):'.format(len(quantized_modules)))
+    for name in quantized_modules:
+        print('  {}'.format(name))
+
+    _, loader = data_loader(model_args, test_path, shuffle=False)
+    ade, fde = evaluate_generator(model_args, loader, generator, args.seed)
+    ade_int8, fde_int8 = evaluate_generator(model_args, loader, quantized_generator, args.seed)
+
+    batch = next(iter(loader))
+    latency = benchmark_generator(generator, batch, args.num_runs)
+    latency_int8 = benchmark_generator(quantized_generator, batch, args.num_runs)
+
+    report = {
+        'ade': ade, 'ade_int8': ade_int8, 'fde': fde, 'fde_int8': fde_int8,
+        'latency_ms': latency, 'latency_int8_ms': latency_int8, 'num_threads': torch.get_num_threads(),
+    }
+    print('ADE fp32: {:.4f} int8: {:.4f} (delta {:+.4f})'.format(ade, ade_int8, ade_int8 - ade))
+    print('FDE fp32: {:.4f} int8: {:.4f} (delta {:+.4f})'.format(fde, fde_int8, fde_int8 - fde))
+    print('Latency (batch of {} pedestrians, {} threads) fp32: {:.2f} ms int8: {:.2f} ms (x{:.2f})'.format(
+        batch[0].size(1), report['num_threads'], latency, latency_int8, latency / latency_int8))
+
+    # The whole quantized generator is saved, its pooling modules included, so that it is loaded without rebuilding it
+    torch.save({
+        'args': checkpoint['args'],
+        'quantized_modules': quantized_modules,
+        'report': report,
+        'g_int8': quantized_generator,
+    }, output_path)
+    print('Saving quantized generator to {}'.format(output_path))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
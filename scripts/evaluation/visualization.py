@@ -1,12 +1,14 @@
-#import matplotlib.pyplot as plt
+# This module is imported only by the features that plot, so that matplotlib is not loaded with the models
+import matplotlib.pyplot as plt
 #from tensorboardX import SummaryWriter
 import numpy as np
-#import matplotlib.cm as cm
-#import matplotlib.patches as patches
+import matplotlib.cm as cm
+import matplotlib.patches as patches
 import skimage.transform
 from PIL import Image
 import pandas as pd
 import os
+from functools import lru_cache
 import torch
 from attrdict import AttrDict
 
@@ -15,13 +17,17 @@ from sgan.model.folder_utils import get_root_dir
 from sgan.model.utils import get_device
 from sgan.context.dynamic_pooling_algorithms import make_grid
 
-device = get_device()
-
 
 def get_figure(rows=1, cols=1, num=1):
     fig, ax = plt.subplots(rows, cols, figsize=(16, 16), num=num)
     return fig
 
+@lru_cache(maxsize=None)
+def get_attention_axes():
+    """ Axes of the figure of the attention weights of the pooling modules, created at the first call """
+    fig, ((ax1, ax2)) = plt.subplots(1, 2, figsize=(8, 4), num=1)
+    return ax1, ax2
+
 def plot_prediction(args, obs_traj, traj, pred_traj, seq_start_end, time=0, target=0):
     """
     Input:
@@ -79,9 +85,10 @@ def plot_prediction(args, obs_traj, traj, pred_traj, seq_start_end, time=0, targ
         ax[j].axis('square')
 
         j = 5
-        curr_hidden = torch.ones(num_ped, 1).to(device)
-        grid_gts = make_grid(curr_end_pos=current_obs_traj[:, -1, :], curr_hidden=curr_hidden, num_ped=num_ped,
-                             grid_size=args.grid_size, seq_start_end=seq_start_end, neighborhood_size=neighborhood_size)
+        curr_hidden = torch.ones(num_ped, 1).to(get_device())
+        curr_seq_start_end = torch.tensor([[0, num_ped]]).to(get_device())
+        grid_gts = make_grid(curr_end_pos=current_obs_traj[:, -1, :], curr_hidden=curr_hidden,
+                             grid_size=args.grid_size, seq_start_end=curr_seq_start_end, neighborhood_size=neighborhood_size)
         grid_gt = grid_gts.squeeze(1)
         total_grid_size = args.grid_size**2
         grid_gt_target = grid_gt[target*total_grid_size:(target+1)*total_grid_size]
@@ -89,9 +96,9 @@ def plot_prediction(args, obs_traj, traj, pred_traj, seq_start_end, time=0, targ
         ax[j].set_xlabel('grid obs traj')
 
         j = 6
-        curr_hidden = torch.ones(num_ped, 1).to(device)
-        grid_gts = make_grid(curr_end_pos=current_traj[:, time, :], curr_hidden=curr_hidden, num_ped=num_ped,
-                             grid_size=args.grid_size, seq_start_end=seq_start_end, neighborhood_size=neighborhood_size)
+        curr_hidden = torch.ones(num_ped, 1).to(get_device())
+        grid_gts = make_grid(curr_end_pos=current_traj[:, time, :], curr_hidden=curr_hidden,
+                             grid_size=args.grid_size, seq_start_end=curr_seq_start_end, neighborhood_size=neighborhood_size)
         grid_gt = grid_gts.squeeze(1)
         total_grid_size = args.grid_size**2
         grid_gt_target = grid_gt[target*total_grid_size:(target+1)*total_grid_size]
@@ -99,8 +106,8 @@ def plot_prediction(args, obs_traj, traj, pred_traj, seq_start_end, time=0, targ
         ax[j].set_xlabel('grid g truth traj')
 
         j = 7
-        grid_gts = make_grid(curr_end_pos=current_pred_traj[:, time, :], curr_hidden=curr_hidden, num_ped=num_ped,
-                             grid_size=args.grid_size, seq_start_end=seq_start_end, neighborhood_size=neighborhood_size)
+        grid_gts = make_grid(curr_end_pos=current_pred_traj[:, time, :], curr_hidden=curr_hidden,
+                             grid_size=args.grid_size, seq_start_end=curr_seq_start_end, neighborhood_size=neighborhood_size)
         grid_gt = grid_gts.squeeze(1)
         total_grid_size = args.grid_size**2
         grid_gt_target = grid_gt[target*total_grid_size:(target+1)*total_grid_size]
@@ -301,7 +308,7 @@ def visualize_attention_weights(scene_name, encoded_image_size, attention_weight
     w, h = image_original.size
     col = np.round(pixels[ped_id][0])
     row = np.round(pixels[ped_id][1])
-    grid_left_upper_corner = curr_end_pos - torch.tensor([grid_size/2.0, grid_size/2.0]).expand_as(curr_end_pos).to(device)
+    grid_left_upper_corner = curr_end_pos - torch.tensor([grid_size/2.0, grid_size/2.0]).expand_as(curr_end_pos).to(get_device())
     pixels_grid = get_pixels_from_world(grid_left_upper_corner, h_matrix, True)
 
     col_grid = (col - np.round(pixels_grid[ped_id][0]))
@@ -347,13 +354,13 @@ def main():
     model_path = os.path.join(get_root_dir(), 'models_sdd/temp/checkpoint_with_model.pt')
     if True:
         # load checkpoint of first model and arguments
-        checkpoint1 = torch.load(model_path)
+        checkpoint1 = torch.load(model_path, map_location=get_device())
         args1 = AttrDict(checkpoint1['args'])
         generator1 = get_generator(checkpoint1, args1)
 
-        encoder_out = torch.randn(1, 64, 32).cuda()
-        curr_hidden = torch.randn(1, 32).cuda()
-        embed_info = torch.randn(1, 4).cuda()
+        encoder_out = torch.randn(1, 64, 32, device=get_device())
+        curr_hidden = torch.randn(1, 32, device=get_device())
+        embed_info = torch.randn(1, 4, device=get_device())
         _, attention_weights = generator1.pooling.pooling_list[1].attention_decoder.forward(encoder_out, curr_hidden, embed_info) #torch.zeros(1, 256*256).cuda()
 
         visualize_attention_weights('gates_8', 8, attention_weights, torch.tensor([25, 55]).unsqueeze(0))
@@ -21,7 +21,13 @@ def helper_get_critic(args, data_path):
             neighborhood_size=args.neighborhood_size,
             grid_size=args.grid_size,
             pooling_dim=args.pooling_dim,
-            down_samples=args.down_samples)
+            down_samples=args.down_samples,
+            neighbor_radius=getattr(args, 'neighbor_radius', 0),
+            max_neighbors=getattr(args, 'max_neighbors', -1),
+            concurrent_pooling=getattr(args, 'concurrent_pooling', False),
+            pool_memory_budget=getattr(args, 'pool_memory_budget', 0),
+            pool_checkpoint=getattr(args, 'pool_checkpoint', False),
+            boundary_tolerance=getattr(args, 'boundary_tolerance', None))
 
     if args.static_pooling_type is not None:
         c_builder.with_static_pooling(data_path)
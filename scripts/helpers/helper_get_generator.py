@@ -1,6 +1,10 @@
+import torch
+
 from sgan.model.trajectory_generator_builder import TrajectoryGeneratorBuilder
 from sgan.model.decoder_builder import DecoderBuilder
 from sgan.model.folder_utils import get_test_data_path
+from sgan.model.compiled_inference import compile_generator
+from sgan.model.utils import get_device, set_device
 
 def helper_get_generator(args, data_path):
     # build decoder
@@ -20,7 +24,16 @@ def helper_get_generator(args, data_path):
         neighborhood_size=args.neighborhood_size,
         grid_size=args.grid_size,
         pooling_dim=args.pooling_dim,
-        down_samples=args.down_samples
+        down_samples=args.down_samples,
+        neighbor_radius=getattr(args, 'neighbor_radius', 0),
+        max_neighbors=getattr(args, 'max_neighbors', -1),
+        concurrent_pooling=getattr(args, 'concurrent_pooling', False),
+        pool_memory_budget=getattr(args, 'pool_memory_budget', 0),
+        pool_checkpoint=getattr(args, 'pool_checkpoint', False),
+        boundary_tolerance=getattr(args, 'boundary_tolerance', None),
+        pool_every_k=getattr(args, 'pool_every_k', 1),
+        pool_steps=getattr(args, 'pool_steps', None),
+        pool_motion_threshold=getattr(args, 'pool_motion_threshold', 0.0)
     )
     if args.pool_every_timestep:
         if args.static_pooling_type is not None:
@@ -55,7 +68,13 @@ def helper_get_generator(args, data_path):
         neighborhood_size=args.neighborhood_size,
         grid_size=args.grid_size,
         pooling_dim=args.pooling_dim,
-        down_samples=args.down_samples)
+        down_samples=args.down_samples,
+        neighbor_radius=getattr(args, 'neighbor_radius', 0),
+        max_neighbors=getattr(args, 'max_neighbors', -1),
+        concurrent_pooling=getattr(args, 'concurrent_pooling', False),
+        pool_memory_budget=getattr(args, 'pool_memory_budget', 0),
+        pool_checkpoint=getattr(args, 'pool_checkpoint', False),
+        boundary_tolerance=getattr(args, 'boundary_tolerance', None))
     
     g_builder.with_decoder(decoder)
     if args.static_pooling_type is not None:
@@ -66,10 +85,26 @@ def helper_get_generator(args, data_path):
     return generator
 
 
-def get_generator(checkpoint_in, args):
+def get_generator(checkpoint_in, args, compile_mode=None):
     test_path = get_test_data_path(args.dataset_name)
     generator = helper_get_generator(args, test_path)
     generator.load_state_dict(checkpoint_in['g_best_state'])
-    generator.cuda()
+    generator.to(get_device())
     generator.eval()
+    if compile_mode is not None:
+        compile_generator(generator, compile_mode)
     return generator
+
+
+def get_quantized_generator(artifact_path):
+    """
+    int8 generator exported by scripts/evaluation/quantize_generator.py, and the args of its checkpoint. The int8
+    layers only run on the CPU, so the device is set to the CPU: the batches and the other models must go there too
+    """
+    if get_device().type != 'cpu':
+        print("The quantized generator runs on the CPU only, the device is set to the CPU")
+    set_device('cpu')
+    artifact = torch.load(artifact_path, map_location='cpu', weights_only=False)
+    generator = artifact['g_int8']
+    generator.eval()
+    return generator, artifact['args']
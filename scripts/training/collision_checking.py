@@ -1,23 +1,44 @@
 import torch
 
+from sgan.context.batch_topology import get_topology
 from sgan.model.utils import get_device
-device = get_device()
 
-def collision_error(pred_pos, seq_start_end, minimum_distance=0.2, mode='binary'):
+def collision_error(pred_pos, seq_start_end, minimum_distance=0.2, mode='binary', topology=None):
     """
     Input:
     - pred_pos: Tensor of shape (seq_len, batch, 2). Predicted last pos.
     - minimum_distance: Minimum between people
     last pos
     - mode: 'binary' gives a score of 1 if at least one timestep is in collision. 'all' sums collisions for each time step
+    - topology: BatchTopology of the batch, built from seq_start_end if not given
     Output:
     - loss: gives the collision error for all pedestrians (batch * number of ped in batch)
     """
+    if mode == 'sequential':
+        return collision_error_sequential(pred_pos, seq_start_end, minimum_distance)
+
+    # Distances of all the pairs of pedestrians in the same sequence of the batch, [seq_len, num_pairs]
+    ped_index, other_index, _ = get_topology(seq_start_end, topology=topology).get_pair_indices()
+    pred_pos = pred_pos.to(get_device()).float()  # distances in fp32, also under autocast
+    distance = torch.norm(pred_pos[:, other_index] - pred_pos[:, ped_index], dim=2)
+    distance = distance.masked_fill(distance == 0, minimum_distance)  # exclude distance between people and themself
+
+    in_collision = distance < minimum_distance
+    if mode == 'binary':
+        pair_collisions = in_collision.any(0)
+    elif mode == 'all':
+        pair_collisions = in_collision.sum(0)
+    cols = distance.new_zeros(pred_pos.size(1)).index_add_(0, ped_index, pair_collisions.type_as(distance))
+    if mode == 'binary':
+        cols = (cols > 0).type_as(distance)
+    return cols
+
+
+def collision_error_sequential(pred_pos, seq_start_end, minimum_distance=0.2):
+    """ collision_error in 'sequential' mode, which also returns the collision matrices of each sequence """
     pred_pos_perm = pred_pos.permute(1, 0, 2)  # (batch, seq_len, 2)
     seq_length = pred_pos.size(0)
     collisions, collisions_per_agent = [], []
-    if mode == 'sequential':
-        index = []
     for i, (start, end) in enumerate(seq_start_end):
         start = start.item()
         end = end.item()
@@ -32,31 +53,16 @@ def collision_error(pred_pos, seq_start_end, minimum_distance=0.2, mode='binary'
 
         distance[distance == 0] = minimum_distance  # exclude distance between people and themself
 
-        if mode == 'binary':
-            min_distance = distance.min(1)[0] # [t X ped]
-            min_distance_all = min_distance.min(0)[0]
-            cols = torch.zeros_like(min_distance_all)
-            cols[min_distance_all < minimum_distance] = 1
-
-        elif mode == 'all':
-            cols = torch.zeros(seq_length, num_ped, num_ped)
-            cols[distance < minimum_distance] = 1
-            cols = cols.sum(1).sum(0)
-        elif mode == 'sequential':
-            cols = torch.zeros(seq_length, num_ped, num_ped)
-            cols[distance < minimum_distance] = 1
-            cols[distance > minimum_distance] = -1
-            cols = cols.view(num_ped, seq_length, num_ped) # so we can append and concat along batch dim
-            collisions_per_agent.append(cols)
-            cols = cols.sum(0).view(num_ped, -1)
-
+        cols = torch.zeros(seq_length, num_ped, num_ped)
+        cols[distance < minimum_distance] = 1
+        cols[distance > minimum_distance] = -1
+        cols = cols.view(num_ped, seq_length, num_ped) # so we can append and concat along batch dim
+        collisions_per_agent.append(cols)
+        cols = cols.sum(0).view(num_ped, -1)
 
         collisions.append(cols)
-    if mode != 'sequential':
-        return torch.cat(collisions, dim=0).to(device)
-    else:
-        collisions = torch.cat(collisions, dim=0).to(device)
-        return collisions, collisions_per_agent
+    collisions = torch.cat(collisions, dim=0).to(get_device())
+    return collisions, collisions_per_agent
 
 
 def occupancy_error(pred_pos, seq_start_end, scene_information, seq_scene, minimum_distance=0.2, mode='binary'):
@@ -93,10 +99,10 @@ def occupancy_error(pred_pos, seq_start_end, scene_information, seq_scene, minim
             cols[min_distance_all < minimum_distance] = 1
 
         elif mode == 'all':
-            cols = torch.zeros(seq_length, num_points, num_ped)
+            cols = torch.zeros_like(distance)
             cols[distance < minimum_distance] = 1
             cols = cols.sum(1).sum(0)
 
         collisions.append(cols)
-    return torch.cat(collisions, dim=0).cuda()
+    return torch.cat(collisions, dim=0)
 
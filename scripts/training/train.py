@@ -18,18 +18,17 @@ sys.path.insert(0, os.path.join(current_path, os.path.pardir))
 
 from scripts.helpers.helper_get_generator import helper_get_generator
 from scripts.helpers.helper_get_critic import helper_get_critic
-from scripts.evaluation.visualization import get_figure
 
 from scripts.training.train_critic import critic_step, check_accuracy_critic
 from scripts.training.train_discriminator import discriminator_step, check_accuracy_discriminator
 from scripts.training.train_generator import generator_step, check_accuracy_generator
-from scripts.training.train_utils import init_weights, get_dtypes, get_argument_parser
+from scripts.training.train_utils import init_weights, get_argument_parser, get_grad_scaler, configure_device
 
 from sgan.evaluation.discriminator import TrajectoryDiscriminator
 from sgan.evaluation.trajectory_generator_evaluator import TrajectoryGeneratorEvaluator
 
 from sgan.data.loader import data_loader
-from sgan.model.utils import get_total_norm, get_device
+from sgan.model.utils import get_total_norm, get_device, synchronize
 from sgan.model.folder_utils import get_dset_path, get_root_dir, get_dset_name
 from sgan.model.losses import gan_g_loss, gan_d_loss, critic_loss, g_critic_loss_function, displacement_error
 
@@ -39,17 +38,19 @@ FORMAT = '[%(levelname)s: %(filename)s: %(lineno)4d]: %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT, stream=sys.stdout)
 logger = logging.getLogger(__name__)
 
-device = get_device()
 
 def main(args):
     if args.summary_writer_name is not None:
         writer = SummaryWriter(args.summary_writer_name)
 
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_num
+    device = configure_device(args)
+    logger.info('Running on {} with {} threads'.format(device, torch.get_num_threads()))
     train_path = get_dset_path(args.dataset_path, args.dataset_name, 'train')
     val_path = get_dset_path(args.dataset_path, args.dataset_name, 'val')
 
-    long_dtype, float_dtype = get_dtypes(args)
+    # Models in fp32 on the device of the run (--amp adds autocast regions)
+    float_dtype = torch.float
 
     logger.info("Initializing val dataset")
     val_dset, val_loader = data_loader(args, val_path, shuffle=False)
@@ -72,7 +73,7 @@ def main(args):
     generator = helper_get_generator(args, train_path)    
 
     generator.apply(init_weights)
-    generator.type(float_dtype).train()
+    generator.to(device=device, dtype=float_dtype).train()
     logger.info('Here is the generator:')
     logger.info(generator)
     g_loss_fn = gan_g_loss
@@ -95,7 +96,7 @@ def main(args):
 
 
     discriminator.apply(init_weights)
-    discriminator.type(float_dtype).train()
+    discriminator.to(device=device, dtype=float_dtype).train()
     logger.info('Here is the discriminator:')
     logger.info(discriminator)
     d_loss_fn = gan_d_loss
@@ -103,12 +104,15 @@ def main(args):
 
     critic = helper_get_critic(args, train_path)
     critic.apply(init_weights)
-    critic.type(float_dtype).train()
+    critic.to(device=device, dtype=float_dtype).train()
     logger.info('Here is the critic:')
     logger.info(critic)
     c_loss_fn = gan_d_loss
     optimizer_c = optim.Adam(filter(lambda x: x.requires_grad, critic.parameters()), lr=args.c_learning_rate)
     
+    # Gradient scalers of the --amp mode (pass-through without fp16 autocast)
+    scaler_g, scaler_d, scaler_c = get_grad_scaler(args), get_grad_scaler(args), get_grad_scaler(args)
+
     trajectory_evaluator = TrajectoryGeneratorEvaluator()
     if args.d_loss_weight > 0:
         logger.info('Discrimintor loss')
@@ -126,7 +130,7 @@ def main(args):
 
     if restore_path is not None and os.path.isfile(restore_path):
         logger.info('Restoring from checkpoint {}'.format(restore_path))
-        checkpoint = torch.load(restore_path)
+        checkpoint = torch.load(restore_path, map_location=device)
         generator.load_state_dict(checkpoint['g_state'])
         # discriminator.load_state_dict(checkpoint['d_state'])
         optimizer_g.load_state_dict(checkpoint['g_optim_state'])
@@ -194,7 +198,7 @@ def main(args):
         logger.info('Starting epoch {}  -  [{}]'.format(epoch, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())))
         for batch_num, batch in enumerate(train_loader):
             if args.timing == 1:
-                torch.cuda.synchronize()
+                synchronize()
                 t1 = time.time()
 
             # Decide whether to use the batch for stepping on discriminator or
@@ -202,7 +206,7 @@ def main(args):
             # discriminator followed by args.g_steps steps on the generator.
             if d_steps_left > 0:
                 step_type = 'd'
-                losses_d = discriminator_step(args, batch, generator, discriminator, d_loss_fn, optimizer_d)
+                losses_d = discriminator_step(args, batch, generator, discriminator, d_loss_fn, optimizer_d, scaler_d)
                 checkpoint['norm_d'].append(get_total_norm(discriminator.parameters()))
                 d_steps_left -= 1
                 if len(avg_losses_d) == 0:
@@ -214,7 +218,7 @@ def main(args):
 
             elif c_steps_left > 0:
                 step_type = 'c'
-                losses_c = critic_step(args, batch, generator, critic, c_loss_fn, optimizer_c)
+                losses_c = critic_step(args, batch, generator, critic, c_loss_fn, optimizer_c, scaler_c)
                 checkpoint['norm_c'].append(get_total_norm(critic.parameters()))
                 c_steps_left -= 1
                 if len(avg_losses_c) == 0:
@@ -226,7 +230,7 @@ def main(args):
 
             elif g_steps_left > 0:
                 step_type = 'g'
-                losses_g = generator_step(args, batch, generator, optimizer_g, trajectory_evaluator)
+                losses_g = generator_step(args, batch, generator, optimizer_g, trajectory_evaluator, scaler_g)
 
                 checkpoint['norm_g'].append(get_total_norm(generator.parameters()))
                 g_steps_left -= 1
@@ -238,7 +242,7 @@ def main(args):
                         avg_losses_g[k] += v / num_g_steps
 
             if args.timing == 1:
-                torch.cuda.synchronize()
+                synchronize()
                 t2 = time.time()
                 logger.info('{} step took {}'.format(step_type, t2 - t1))
 
@@ -1,40 +1,36 @@
 import torch
 import torch.nn as nn
-from sgan.model.utils import relative_to_abs
+from sgan.model.utils import relative_to_abs, get_device
+from scripts.training.train_utils import amp_autocast, optimizer_step
 
 
-def discriminator_step(args, batch, generator, discriminator, d_loss_fn, optimizer_d):
-    batch = [tensor.cuda() for tensor in batch]
+def discriminator_step(args, batch, generator, discriminator, d_loss_fn, optimizer_d, scaler=None):
+    batch = [tensor.to(get_device()) for tensor in batch]
     (obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel, non_linear_ped,
      loss_mask, _, seq_start_end, seq_scene_ids) = batch
 
     losses = {}
     loss = torch.zeros(1).to(pred_traj_gt)
 
-    pred_traj_fake_rel = generator(obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids)
-    pred_traj_fake = relative_to_abs(pred_traj_fake_rel, obs_traj[-1])
+    with amp_autocast(args):
+        pred_traj_fake_rel = generator(obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids)
+        pred_traj_fake = relative_to_abs(pred_traj_fake_rel, obs_traj[-1])
 
-    traj_real = torch.cat([obs_traj, pred_traj_gt], dim=0)
-    traj_real_rel = torch.cat([obs_traj_rel, pred_traj_gt_rel], dim=0)
-    traj_fake = torch.cat([obs_traj, pred_traj_fake], dim=0)
-    traj_fake_rel = torch.cat([obs_traj_rel, pred_traj_fake_rel], dim=0)
+        traj_real = torch.cat([obs_traj, pred_traj_gt], dim=0)
+        traj_real_rel = torch.cat([obs_traj_rel, pred_traj_gt_rel], dim=0)
+        traj_fake = torch.cat([obs_traj, pred_traj_fake], dim=0)
+        traj_fake_rel = torch.cat([obs_traj_rel, pred_traj_fake_rel], dim=0)
 
-    scores_fake = discriminator(traj_fake, traj_fake_rel, seq_start_end)
-    scores_real = discriminator(traj_real, traj_real_rel, seq_start_end)
+        scores_fake = discriminator(traj_fake, traj_fake_rel, seq_start_end)
+        scores_real = discriminator(traj_real, traj_real_rel, seq_start_end)
 
-    # Compute loss with optional gradient penalty
-    data_loss = d_loss_fn(scores_real, scores_fake, args.loss_type)
+        # Compute loss with optional gradient penalty
+        data_loss = d_loss_fn(scores_real, scores_fake, args.loss_type)
     losses['D_data_loss'] = data_loss.item()
     loss += data_loss
     losses['D_total_loss'] = loss.item()
 
-    optimizer_d.zero_grad()
-    loss.backward()
-    if args.clipping_threshold_d > 0:
-        nn.utils.clip_grad_norm_(discriminator.parameters(),
-                                 args.clipping_threshold_d)
-
-    optimizer_d.step()
+    optimizer_step(loss, optimizer_d, discriminator.parameters(), args.clipping_threshold_d, scaler)
 
     return losses
 
@@ -48,7 +44,7 @@ def check_accuracy_discriminator(args, loader, generator, discriminator, d_loss_
     discriminator.eval()
     with torch.no_grad():
         for b, batch in enumerate(loader):
-            batch = [tensor.cuda() for tensor in batch]
+            batch = [tensor.to(get_device()) for tensor in batch]
             (obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel,
              non_linear_ped, loss_mask, _, seq_start_end, seq_scene_ids) = batch
 
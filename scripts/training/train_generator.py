@@ -5,23 +5,23 @@ import torch.nn as nn
 from sgan.model.utils import relative_to_abs
 from sgan.model.losses import l2_loss
 from sgan.model.utils import get_device
-from scripts.training.train_utils import rotate_traj, get_batch
-from scripts.evaluation.visualization import sanity_check, plot_prediction, get_figure
+from scripts.training.train_utils import rotate_traj, get_batch, amp_autocast, optimizer_step
 from scripts.training.train_utils import cal_l2_losses, cal_cols, cal_occs, cal_ade, cal_fde
 from sgan.context.dynamic_pooling_algorithms import make_grid
+from sgan.context.batch_topology import BatchTopology
+from sgan.context.segment_reduction import segment_sum
 
-device = get_device()
 
-
-def generator_step(args, batch, generator, optimizer_g, trajectory_evaluator):
-    batch = [tensor.to(device) for tensor in batch]
+def generator_step(args, batch, generator, optimizer_g, trajectory_evaluator, scaler=None):
+    batch = [tensor.to(get_device()) for tensor in batch]
     (obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel, non_linear_ped,
      loss_mask, _, seq_start_end, seq_scene_ids) = batch
     losses = {}
     loss = torch.zeros(1).to(pred_traj_gt)
-    g_l2_loss_rel = []
 
     loss_mask = loss_mask[:, args.obs_len:]
+    # Index tensors of the batch, shared by the best_k samples and the evaluator
+    topology = BatchTopology(seq_start_end, seq_scene_ids)
 
     if args.augment:
         traj = torch.cat([obs_traj, pred_traj_gt], dim=0)
@@ -29,45 +29,35 @@ def generator_step(args, batch, generator, optimizer_g, trajectory_evaluator):
         traj, traj_rel = rotate_traj(traj, traj_rel)
         obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel = get_batch(args.obs_len, traj, traj_rel)
 
-    for _ in range(args.best_k):
-        pred_traj_fake_rel = generator(obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids)
-        pred_traj_fake = relative_to_abs(pred_traj_fake_rel, obs_traj[-1])
+    with amp_autocast(args):
+        # The best_k samples share the encoder and the first pooling, [best_k, pred_len, batch, 2]
+        pred_traj_fake_rel_samples = generator.sample(obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids,
+                                                      num_samples=args.best_k, topology=topology)
 
         if args.l2_loss_weight > 0:
-            g_l2_loss_rel.append(args.l2_loss_weight * l2_loss(
-                pred_traj_fake_rel,
-                pred_traj_gt_rel,
-                loss_mask,
-                mode='raw'))
-
-    g_l2_loss_sum_rel = torch.zeros(1).to(pred_traj_gt)
-    if args.l2_loss_weight > 0:
-        g_l2_loss_rel = torch.stack(g_l2_loss_rel, dim=1)
-        for start, end in seq_start_end.data:
-            _g_l2_loss_rel = g_l2_loss_rel[start:end]
-            _g_l2_loss_rel = torch.sum(_g_l2_loss_rel, dim=0)
-            _g_l2_loss_rel = torch.min(_g_l2_loss_rel) / torch.sum(
-                loss_mask[start:end])  # min among all best_k samples, sum loss_mask = num_peds * seq_len
-            g_l2_loss_sum_rel += _g_l2_loss_rel
-        losses['G_l2_loss_rel'] = g_l2_loss_sum_rel.item()
-        loss += g_l2_loss_sum_rel
-
-    traj_fake = torch.cat([obs_traj, pred_traj_fake], dim=0)
-    traj_fake_rel = torch.cat([obs_traj_rel, pred_traj_fake_rel], dim=0)
-
-    evaluator_loss = trajectory_evaluator.get_loss(traj_fake, traj_fake_rel, seq_start_end, seq_scene_ids)
-    loss += evaluator_loss
+            # Raw l2 loss of each pedestrian in each sample, [batch, best_k]
+            g_l2_loss_rel = args.l2_loss_weight * torch.sum(
+                loss_mask.t() * ((pred_traj_gt_rel - pred_traj_fake_rel_samples) ** 2).sum(dim=3), dim=1).t()
+            # Summed over the pedestrians of each sequence, [num_seq, best_k]
+            g_l2_loss_rel = segment_sum(g_l2_loss_rel, topology.seq_id, topology.num_seq)
+            loss_mask_sum = segment_sum(loss_mask.sum(dim=1), topology.seq_id, topology.num_seq)
+            # min among all best_k samples, sum loss_mask = num_peds * seq_len
+            g_l2_loss_sum_rel = torch.sum(torch.min(g_l2_loss_rel, dim=1)[0] / loss_mask_sum).view(1)
+            losses['G_l2_loss_rel'] = g_l2_loss_sum_rel.item()
+            loss += g_l2_loss_sum_rel
+
+        pred_traj_fake_rel = pred_traj_fake_rel_samples[-1]
+        pred_traj_fake = relative_to_abs(pred_traj_fake_rel, obs_traj[-1])
 
-    losses['G_total_loss'] = loss.item()
+        traj_fake = torch.cat([obs_traj, pred_traj_fake], dim=0)
+        traj_fake_rel = torch.cat([obs_traj_rel, pred_traj_fake_rel], dim=0)
+
+        evaluator_loss = trajectory_evaluator.get_loss(traj_fake, traj_fake_rel, seq_start_end, seq_scene_ids, topology)
+        loss += evaluator_loss
 
-    optimizer_g.zero_grad()
-    loss.backward()
+    losses['G_total_loss'] = loss.item()
 
-    if args.clipping_threshold_g > 0:
-        nn.utils.clip_grad_norm_(
-            generator.parameters(), args.clipping_threshold_g
-        )
-    optimizer_g.step()
+    optimizer_step(loss, optimizer_g, generator.parameters(), args.clipping_threshold_g, scaler)
 
     return losses
 
@@ -84,13 +74,14 @@ def check_accuracy_generator(string, epoch, args, loader, generator, limit=False
     generator.eval()
     with torch.no_grad():
         for b, batch in enumerate(loader):
-            batch = [tensor.to(device) for tensor in batch]
+            batch = [tensor.to(get_device()) for tensor in batch]
             (obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel,
              non_linear_ped, loss_mask, _, seq_start_end, seq_scene_ids) = batch
             linear_ped = 1 - non_linear_ped
             loss_mask = loss_mask[:, args.obs_len:]
+            topology = BatchTopology(seq_start_end, seq_scene_ids)
 
-            pred_traj_fake_rel = generator(obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids)
+            pred_traj_fake_rel = generator(obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids, topology=topology)
             pred_traj_fake = relative_to_abs(pred_traj_fake_rel, obs_traj[-1])
 
             g_l2_loss_abs, g_l2_loss_rel = cal_l2_losses(
@@ -105,8 +96,10 @@ def check_accuracy_generator(string, epoch, args, loader, generator, limit=False
                 pred_traj_gt, pred_traj_fake, linear_ped, non_linear_ped
             )
 
-            cols_pred = cal_cols(pred_traj_fake, seq_start_end, minimum_distance=args.collision_threshold, mode='all')
-            cols_gt = cal_cols(pred_traj_gt, seq_start_end, minimum_distance=args.collision_threshold, mode='all')
+            cols_pred = cal_cols(pred_traj_fake, seq_start_end, minimum_distance=args.collision_threshold, mode='all',
+                                 topology=topology)
+            cols_gt = cal_cols(pred_traj_gt, seq_start_end, minimum_distance=args.collision_threshold, mode='all',
+                               topology=topology)
 
             g_l2_losses_abs.append(g_l2_loss_abs.item())
             g_l2_losses_rel.append(g_l2_loss_rel.item())
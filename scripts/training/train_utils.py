@@ -6,30 +6,72 @@ import numpy as np
 from scripts.training.collision_checking import collision_error, occupancy_error
 from sgan.evaluation.rewards import collision_rewards
 from sgan.model.losses import l2_loss, displacement_error, final_displacement_error
-from sgan.model.utils import get_device
-device = get_device()
+from sgan.model.utils import get_device, set_device, set_num_threads
 
 def init_weights(m):
     classname = m.__class__.__name__
     if classname.find('Linear') != -1:
         nn.init.kaiming_normal_(m.weight)
 
+def configure_device(args):
+    """
+    Device of the run (--device, or the CPU with --use_gpu 0, else the GPU if available) and CPU threads, set before
+    the models and the data loaders are built
+    """
+    set_num_threads(getattr(args, 'num_threads', 0), getattr(args, 'num_interop_threads', 0))
+    name = getattr(args, 'device', None)
+    if name is None and getattr(args, 'use_gpu', 1) != 1:
+        name = 'cpu'
+    return set_device(name)
+
 def get_dtypes(args):
     long_dtype = torch.LongTensor
     float_dtype = torch.FloatTensor
-    if args.use_gpu == 1:
+    if get_device().type == 'cuda':
         long_dtype = torch.cuda.LongTensor
         float_dtype = torch.cuda.FloatTensor
     return long_dtype, float_dtype
 
-def cal_cols(pred_traj_gt, seq_start_end, minimum_distance, mode="all"):
-    return collision_error(pred_traj_gt, seq_start_end, minimum_distance=minimum_distance, mode=mode)
+def get_amp_dtype(args):
+    """ Autocast dtype with --amp: bf16 on CPU, fp16 on GPU unless --amp_dtype bfloat16 """
+    if get_device().type != 'cuda' or getattr(args, 'amp_dtype', 'float16') == 'bfloat16':
+        return torch.bfloat16
+    return torch.float16
+
+def amp_autocast(args):
+    """ Autocast region of the forward passes and losses of the training steps, disabled without --amp """
+    return torch.autocast(get_device().type, dtype=get_amp_dtype(args), enabled=bool(getattr(args, 'amp', False)))
+
+def get_grad_scaler(args):
+    """ Loss scaling, needed by fp16 only, a pass-through otherwise. One per optimizer """
+    enabled = bool(getattr(args, 'amp', False)) and get_amp_dtype(args) == torch.float16
+    return torch.amp.GradScaler(get_device().type, enabled=enabled)
+
+def optimizer_step(loss, optimizer, parameters, clipping_threshold, scaler=None):
+    """ Backward pass, optional gradient clipping and optimizer step, through the gradient scaler if any """
+    optimizer.zero_grad()
+    if scaler is None:
+        loss.backward()
+        if clipping_threshold > 0:
+            nn.utils.clip_grad_norm_(parameters, clipping_threshold)
+        optimizer.step()
+        return
+    scaler.scale(loss).backward()
+    if clipping_threshold > 0:
+        # The gradients are clipped at their true scale
+        scaler.unscale_(optimizer)
+        nn.utils.clip_grad_norm_(parameters, clipping_threshold)
+    scaler.step(optimizer)
+    scaler.update()
+
+def cal_cols(pred_traj_gt, seq_start_end, minimum_distance, mode="all", topology=None):
+    return collision_error(pred_traj_gt, seq_start_end, minimum_distance=minimum_distance, mode=mode, topology=topology)
 
 def cal_occs(pred_traj_gt, seq_start_end, scene_information, seq_scene, minimum_distance, mode="all"):
     return occupancy_error(pred_traj_gt, seq_start_end, scene_information, seq_scene, minimum_distance=minimum_distance, mode=mode)
 
-def cal_rew(pred_traj_gt, seq_start_end, minimum_distance, mode="all"):
-    return collision_rewards(pred_traj_gt, seq_start_end, minimum_distance)
+def cal_rew(pred_traj_gt, seq_start_end, minimum_distance, mode="all", topology=None):
+    return collision_rewards(pred_traj_gt, seq_start_end, minimum_distance, topology=topology)
 
 def cal_l2_losses(pred_traj_gt, pred_traj_gt_rel, pred_traj_fake, pred_traj_fake_rel,loss_mask):
     g_l2_loss_abs = l2_loss(pred_traj_fake, pred_traj_gt, loss_mask, mode='sum')
@@ -50,10 +92,10 @@ def cal_fde(pred_traj_gt, pred_traj_fake, linear_ped, non_linear_ped):
     fde_nl = final_displacement_error(pred_traj_fake[-1], pred_traj_gt[-1], non_linear_ped)
     return fde, fde_l, fde_nl
 
-R0 = torch.tensor([[1, 0], [0, 1]]).type(torch.FloatTensor).to(device)
-R90 = torch.tensor([[0, -1], [1, 0]]).type(torch.FloatTensor).to(device)
-R180 = torch.tensor([[-1, 0], [0, -1]]).type(torch.FloatTensor).to(device)
-R270 = torch.tensor([[0, 1], [-1, 0]]).type(torch.FloatTensor).to(device)
+R0 = torch.tensor([[1, 0], [0, 1]]).type(torch.FloatTensor)
+R90 = torch.tensor([[0, -1], [1, 0]]).type(torch.FloatTensor)
+R180 = torch.tensor([[-1, 0], [0, -1]]).type(torch.FloatTensor)
+R270 = torch.tensor([[0, 1], [-1, 0]]).type(torch.FloatTensor)
 DICT = {}
 
 DICT[0] = R0
@@ -64,7 +106,7 @@ DICT[3] = R270
 def rotate_traj(traj, traj_rel):
     #R = DICT[np.random.randint(4)]
     angle = np.random.randn(1)*2*np.pi
-    R = torch.tensor([[np.cos(angle[0]), -np.sin(angle[0])], [np.sin(angle[0]), np.cos(angle[0])]]).type(torch.FloatTensor).to(device)
+    R = torch.tensor([[np.cos(angle[0]), -np.sin(angle[0])], [np.sin(angle[0]), np.cos(angle[0])]]).type(torch.FloatTensor).to(traj.device)
     seq_len = traj.size(0)
     traj = torch.mm(traj.view(-1, 2), R)
     traj = traj.view(seq_len, -1, 2)
@@ -133,6 +175,14 @@ def get_argument_parser():
     # Pooling Options
     parser.add_argument('--pool_every_timestep', default=0, type=bool_flag)
     parser.add_argument('--down_samples', default=-1, type=int)
+    # Boundary points from the precomputed levels (generate_boundary_levels.py) within this tolerance (m), if given
+    parser.add_argument('--boundary_tolerance', default=None, type=float)
+    parser.add_argument('--concurrent_pooling', default=0, type=bool_flag)
+    # Decoder pooling schedule: at the listed steps (e.g. 0,4,8), or when a pedestrian moved more than the threshold (m)
+    # since the last pooling, or every k steps. In between, the outputs of the last pooling are reused with the new hidden state
+    parser.add_argument('--pool_every_k', default=1, type=int)
+    parser.add_argument('--pool_steps', default=None, type=int_tuple)
+    parser.add_argument('--pool_motion_threshold', default=0.0, type=float)
 
     # Pool Net Option
     parser.add_argument('--bottleneck_dim', default=128, type=int)
@@ -142,6 +192,14 @@ def get_argument_parser():
     parser.add_argument('--neighborhood_size', default=2.0, type=float)
     parser.add_argument('--grid_size', default=8, type=int)
 
+    # Sparse Pooling Options (0: all the pedestrians of the sequence, -1: no limit)
+    parser.add_argument('--neighbor_radius', default=0.0, type=float)
+    parser.add_argument('--max_neighbors', default=-1, type=int)
+
+    # Chunked Pool Net Options (memory budget in MB of the pair MLP activations per chunk, 0: no chunks)
+    parser.add_argument('--pool_memory_budget', default=0.0, type=float)
+    parser.add_argument('--pool_checkpoint', default=0, type=bool_flag)
+
     parser.add_argument('--static_pooling_type', default=None, type=str) # random, grid, polar, raycast, physical_attention_with_encoder
     parser.add_argument('--dynamic_pooling_type', default=None, type=str) # social_pooling, pool_hidden_net, social_pooling_attention
 
@@ -166,9 +224,17 @@ def get_argument_parser():
 
     # Misc
     parser.add_argument('--use_gpu', default=1, type=int)
+    # cpu, cuda, cuda:1, ... (the GPU if available when not given), and CPU threads (0: PyTorch defaults)
+    parser.add_argument('--device', default=None, type=str)
+    parser.add_argument('--num_threads', default=0, type=int)
+    parser.add_argument('--num_interop_threads', default=0, type=int)
     parser.add_argument('--timing', default=0, type=int)
     parser.add_argument('--gpu_num', default="1", type=str)
 
+    # Mixed precision training (autocast and, with fp16, gradient scaling) of the generator, discriminator and critic steps
+    parser.add_argument('--amp', default=0, type=bool_flag)
+    parser.add_argument('--amp_dtype', default='float16', type=str) # float16 or bfloat16, GPU only (bfloat16 on CPU)
+
     return parser
 
 
@@ -0,0 +1,92 @@
+import torch
+
+
+class BatchTopology:
+    """
+    Index tensors describing how the pedestrians of a batch are split into sequences and scenes. It is built once per
+    batch from seq_start_end, on its device, and shared by the pooling modules (at every decoder step), the noise
+    and the metrics, so that none of them has to walk seq_start_end again.
+    """
+    def __init__(self, seq_start_end, seq_scene_ids=None, batch=None):
+        """
+        Inputs:
+        - seq_start_end: Tensor of shape (num_seq, 2) which delimits sequences within batch
+        - seq_scene_ids: Tensor of shape (num_seq,) with the scene id of each sequence
+        - batch: Number of pedestrians, when known from the shape of the inputs (no host sync to compute it)
+        """
+        # The index tensors follow seq_start_end, which is on the device of the batch
+        self.seq_start_end = seq_start_end
+        self.device = seq_start_end.device
+        self.seq_scene_ids = seq_scene_ids.to(self.device) if seq_scene_ids is not None else None
+        # Number of pedestrians of each sequence, [num_seq]
+        self.seq_len = self.seq_start_end[:, 1] - self.seq_start_end[:, 0]
+        self.num_seq = self.seq_len.size(0)
+        self.batch = int(self.seq_len.sum()) if batch is None else batch
+
+        # Segment id, first pedestrian and number of pedestrians of the sequence of each pedestrian, [batch]
+        self.seq_id = torch.arange(self.num_seq, device=self.device).repeat_interleave(self.seq_len, output_size=self.batch)
+        self.seq_start = self.seq_start_end[self.seq_id, 0]
+        self.num_neighbors = self.seq_len[self.seq_id]
+
+        self.pair_indices = None
+        self.scene_groups = None
+        # Tensors that the modules compute once per batch and reuse at every step (e.g. projections of the scenes)
+        self.cache = {}
+
+    def repeat(self, num_samples):
+        """
+        Topology of the batch replicated num_samples times along the batch dimension (all the pedestrians of the first
+        sample, then of the second, ...), as used to decode several samples at once. The cache is shared, since what
+        it holds does not depend on the pedestrians.
+        """
+        if num_samples == 1:
+            return self
+        offsets = torch.arange(num_samples, device=self.device).view(-1, 1, 1) * self.batch
+        seq_start_end = (self.seq_start_end.unsqueeze(0) + offsets).view(-1, 2)
+        seq_scene_ids = self.seq_scene_ids.repeat(num_samples) if self.seq_scene_ids is not None else None
+        topology = BatchTopology(seq_start_end, seq_scene_ids, num_samples * self.batch)
+        topology.cache = self.cache
+        return topology
+
+    def get_pair_indices(self):
+        """
+        Output:
+        - ped_index, other_index: Tensors of shape (num_pairs,) with all the (ordered) pairs of pedestrians in the same
+        sequence, the self pairs included. Pairs are sorted by ped_index, so that the neighbors of each pedestrian are
+        contiguous: P1-P1, P1-P2, P2-P1, P2-P2, P3-P3, ...
+        - pair_slot: Tensor of shape (num_pairs,) with the position of other_index among the neighbors of ped_index
+        """
+        if self.pair_indices is None:
+            num_pairs = int((self.seq_len * self.seq_len).sum())
+            ped_index = torch.arange(self.batch, device=self.device).repeat_interleave(self.num_neighbors, output_size=num_pairs)
+            # Offset of the first pair of each pedestrian
+            pair_offset = torch.cumsum(self.num_neighbors, dim=0) - self.num_neighbors
+            pair_slot = torch.arange(num_pairs, device=self.device) - pair_offset[ped_index]
+            other_index = self.seq_start[ped_index] + pair_slot
+            self.pair_indices = (ped_index, other_index, pair_slot)
+        return self.pair_indices
+
+    def get_scene_groups(self):
+        """
+        Output:
+        - list of (scene_id, ped_index), ped_index being the Tensor with the batch indices of all the pedestrians in
+        that scene, so that the static features of a scene are computed once for all its pedestrians
+        """
+        if self.scene_groups is None:
+            if self.seq_scene_ids is None:
+                print("The scene ids of the sequences are needed to group the pedestrians by scene!")
+                exit()
+            ped_scene_ids = self.seq_scene_ids[self.seq_id]
+            scene_ids, ped_scene_groups = torch.unique(ped_scene_ids, return_inverse=True)
+            # Pedestrians sorted by scene, and number of pedestrians per scene
+            ped_index = torch.sort(ped_scene_groups, stable=True)[1]
+            num_peds_per_scene = torch.bincount(ped_scene_groups, minlength=scene_ids.size(0)).tolist()
+            self.scene_groups = list(zip(scene_ids.tolist(), torch.split(ped_index, num_peds_per_scene)))
+        return self.scene_groups
+
+
+def get_topology(seq_start_end, seq_scene_ids=None, topology=None, batch=None):
+    """ The topology given by the caller, or a new one for callers that do not share it """
+    if topology is not None:
+        return topology
+    return BatchTopology(seq_start_end, seq_scene_ids, batch)
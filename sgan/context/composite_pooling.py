@@ -1,22 +1,124 @@
 import torch
+from concurrent.futures import ThreadPoolExecutor
 
 from sgan.context.pooling import Pooling
+from sgan.context.null_pooling import NullPooling
+from sgan.context.batch_topology import get_topology
 
 class CompositePooling(Pooling):
-    def __init__(self):
+    def __init__(self, concurrent=False):
         self.pooling_list = []
+        # If True the pooling modules, which are independent, run on separate CUDA streams (GPU) or threads (CPU)
+        self.concurrent = concurrent
+        self.streams = None
+        self.executor = None
+        # Output buffer reused across calls (decoder steps) when no graph has to be kept for backward
+        self.output_buffer = None
+        # Width of the output of each pooling module, in the order of the context
+        self.context_widths = None
+
+    def __getstate__(self):
+        # The thread pool, the CUDA streams and the output buffer can not be (or need not be) pickled, e.g. with the
+        # whole generator saved by quantize_generator.py: they are built again when needed
+        state = self.__dict__.copy()
+        state['streams'] = None
+        state['executor'] = None
+        state['output_buffer'] = None
+        return state
+
+    def train(self, mode=True):
+        """ Train or eval mode of the pooling modules (e.g. for their batch norm), set by the model that holds them """
+        for pooling in self.pooling_list:
+            if isinstance(pooling, torch.nn.Module):
+                pooling.train(mode)
+        return self
 
     def get_pooling_count(self):
         return len(self.pooling_list)
 
     def add(self, pooling):
-        self.pooling_list.append(pooling)        
+        self.pooling_list.append(pooling)
         print('Composite pooling modules: {}'.format(self.get_pooling_count()))
-    
-    def aggregate_context(self, final_encoder_h, seq_start_end, end_pos, rel_pos, seq_scene_ids):
+
+    def run_sequential(self, *inputs):
+        return [pooling.forward(*inputs) for pooling in self.pooling_list]
+
+    def run_on_streams(self, *inputs):
+        if self.streams is None:
+            self.streams = [torch.cuda.Stream() for _ in self.pooling_list]
+        current_stream = torch.cuda.current_stream()
         accumulator = []
-        for pooling in self.pooling_list:
-            ci = pooling.forward(final_encoder_h, seq_start_end, end_pos, rel_pos, seq_scene_ids)
-            accumulator.append(ci)
-        accumulator = torch.cat(accumulator, dim=1)
+        for pooling, stream in zip(self.pooling_list, self.streams):
+            # The inputs have been computed on the current stream
+            stream.wait_stream(current_stream)
+            with torch.cuda.stream(stream):
+                accumulator.append(pooling.forward(*inputs))
+        for ci, stream in zip(accumulator, self.streams):
+            current_stream.wait_stream(stream)
+            ci.record_stream(current_stream)
         return accumulator
+
+    def run_on_threads(self, *inputs):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.get_pooling_count())
+        # Autograd mode is thread local
+        grad_enabled = torch.is_grad_enabled()
+
+        def run(pooling):
+            with torch.set_grad_enabled(grad_enabled):
+                return pooling.forward(*inputs)
+
+        return list(self.executor.map(run, self.pooling_list))
+
+    def get_output_buffer(self, accumulator):
+        size = (accumulator[0].size(0), sum(ci.size(1) for ci in accumulator))
+        if torch.is_grad_enabled():
+            # The previous output may still be needed for backward, it can not be overwritten
+            return accumulator[0].new_empty(size)
+        if self.output_buffer is None or self.output_buffer.size() != size or \
+                self.output_buffer.device != accumulator[0].device or self.output_buffer.dtype != accumulator[0].dtype:
+            self.output_buffer = accumulator[0].new_empty(size)
+        return self.output_buffer
+
+    def aggregate_context(self, final_encoder_h, seq_start_end, end_pos, rel_pos, seq_scene_ids, topology=None):
+        # All the pooling modules share the same index tensors of the batch
+        topology = get_topology(seq_start_end, seq_scene_ids, topology, batch=end_pos.size(0))
+        inputs = (final_encoder_h, seq_start_end, end_pos, rel_pos, seq_scene_ids, topology)
+        if not self.concurrent or self.get_pooling_count() < 2:
+            accumulator = self.run_sequential(*inputs)
+        else:
+            # Build the cached indices before the branches run concurrently and read them
+            topology.get_pair_indices()
+            if seq_scene_ids is not None:
+                topology.get_scene_groups()
+            if final_encoder_h.is_cuda:
+                accumulator = self.run_on_streams(*inputs)
+            else:
+                accumulator = self.run_on_threads(*inputs)
+
+        self.context_widths = [ci.size(1) for ci in accumulator]
+        context_information = self.get_output_buffer(accumulator)
+        start = 0
+        for ci in accumulator:
+            context_information[:, start:start + ci.size(1)] = ci
+            start += ci.size(1)
+        return context_information
+
+    def refresh_context(self, context_information, final_encoder_h):
+        """
+        Context of the last aggregate_context with the hidden states (the output of the NullPooling modules) replaced by
+        final_encoder_h, the outputs of the other pooling modules being reused as they are
+        Inputs:
+        - context_information: Tensor of shape (batch, context_dim), output of the last aggregate_context
+        - final_encoder_h: Tensor of shape (num_layers, batch, h_dim)
+        Output:
+        - Tensor of shape (batch, context_dim)
+        """
+        pieces, start = [], 0
+        for pooling, width in zip(self.pooling_list, self.context_widths):
+            if isinstance(pooling, NullPooling):
+                pieces.append(pooling.forward(final_encoder_h, None, None, None, None))
+            else:
+                pieces.append(context_information[:, start:start + width])
+            start += width
+        return torch.cat(pieces, dim=1)
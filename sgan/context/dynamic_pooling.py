@@ -1,28 +1,28 @@
+import os
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 
 from sgan.model.mlp import make_mlp
 from sgan.context.physical_attention import Attention_Decoder
-from sgan.context.dynamic_pooling_algorithms import make_grid
+from sgan.context.dynamic_pooling_algorithms import make_grid, get_neighbor_indices
+from sgan.context.batch_topology import get_topology
+from sgan.context.segment_reduction import segment_max
 from sgan.model.folder_utils import get_dset_name, get_root_dir, get_test_data_path
 from sgan.model.utils import get_device
 
-device = get_device()
 
+# The visualization (matplotlib) is imported only when the attention weights are plotted
 visualize_attention = False
-if visualize_attention:
-    import os
-    import matplotlib.pyplot as plt
-    fig, ((ax1, ax2)) = plt.subplots(1, 2, figsize=(8, 4), num=1)
-    from scripts.visualization import visualize_attention_weights
 
 
 class PoolHiddenNet(nn.Module):
     """Pooling module as proposed in our paper"""
     def __init__(
         self, embedding_dim=64, h_dim=64, mlp_dim=1024, bottleneck_dim=1024,
-        activation='relu', batch_norm=True, dropout=0.0, pooling_dim=2, neighborhood_size=2.0, pool_every=False
+        activation='relu', batch_norm=True, dropout=0.0, pooling_dim=2, neighborhood_size=2.0, pool_every=False,
+        neighbor_radius=0, max_neighbors=-1, pool_memory_budget=0, pool_checkpoint=False
     ):
         super(PoolHiddenNet, self).__init__()
 
@@ -32,88 +32,122 @@ class PoolHiddenNet(nn.Module):
         self.embedding_dim = embedding_dim
         self.pooling_dim = pooling_dim
         self.neighborhood_size = neighborhood_size
+        # Sparse mode: if neighbor_radius > 0 only the (at most max_neighbors) pedestrians within it are pooled
+        self.neighbor_radius = neighbor_radius
+        self.max_neighbors = max_neighbors
+        # Chunked mode: if pool_memory_budget > 0 (MB) the pairs go through mlp_pre_pool in chunks whose activations fit
+        # in the budget, optionally recomputed in backward (pool_checkpoint) instead of being kept
+        self.pool_memory_budget = pool_memory_budget
+        self.pool_checkpoint = pool_checkpoint
 
         mlp_pre_dim = embedding_dim + h_dim
 
         mlp_pre_pool_dims = [mlp_pre_dim, self.mlp_dim * 8, bottleneck_dim]
-        self.spatial_embedding = nn.Linear(pooling_dim, embedding_dim).to(device)
+        self.spatial_embedding = nn.Linear(pooling_dim, embedding_dim).to(get_device())
         self.mlp_pre_pool = make_mlp(
             mlp_pre_pool_dims,
             activation=activation,
             batch_norm=batch_norm,
             dropout=dropout)
 
-    def repeat(self, tensor, num_reps):
+    def forward(self, h_states, seq_start_end, end_pos, rel_pos, seq_scene_ids=None, topology=None):
         """
         Inputs:
-        -tensor: 2D tensor of any shape
-        -num_reps: Number of times to repeat each row
-        Outpus:
-        -repeat_tensor: Repeat each row such that: R1, R1, R2, R2
+        - h_states: Tensor of shape (num_layers, batch, h_dim)
+        - seq_start_end: A list of tuples which delimit sequences within batch
+        - end_pos: Tensor of shape (batch, 2)
+        - topology: BatchTopology of the batch, built from seq_start_end if not given
+        Output:
+        - pool_h: Tensor of shape (batch, bottleneck_dim)
         """
-        col_len = tensor.size(1)
-        tensor = tensor.unsqueeze(dim=1).repeat(1, num_reps, 1)
-        tensor = tensor.view(-1, col_len)
-        return tensor
+        hidden = h_states.view(-1, self.h_dim)
+        topology = get_topology(seq_start_end, seq_scene_ids, topology)
+        # All pairs of pedestrians in the same sequence for the whole batch: P1-P1, P1-P2, P2-P1, P2-P2, P3-P3, ...
+        if self.neighbor_radius > 0:
+            ped_index, other_index, _ = get_neighbor_indices(end_pos, seq_start_end, self.neighbor_radius,
+                                                             self.max_neighbors, topology)
+        else:
+            ped_index, other_index, _ = topology.get_pair_indices()
 
+        if self.pool_memory_budget > 0:
+            return self.pool_pairs_chunked(end_pos, rel_pos, hidden, ped_index, other_index)
+        return self.pool_pairs(end_pos, rel_pos, hidden, ped_index, other_index, 0, hidden.size(0))
 
-    def forward(self, h_states, seq_start_end, end_pos, rel_pos, seq_scene_ids=None):
+    def pool_pairs(self, end_pos, rel_pos, hidden, ped_index, other_index, first_ped, num_ped):
         """
         Inputs:
-        - h_states: Tensor of shape (num_layers, batch, h_dim)
-        - seq_start_end: A list of tuples which delimit sequences within batch
-        - end_pos: Tensor of shape (batch, 2)
+        - ped_index, other_index: Tensors of shape (num_pairs,) with the pairs of the pedestrians
+        first_ped, ..., first_ped + num_ped - 1
         Output:
-        - pool_h: Tensor of shape (batch, bottleneck_dim)
+        - pool_h: Tensor of shape (num_ped, bottleneck_dim), max over the neighbors of each pedestrian
         """
-        pool_h = []
-        for _, (start, end) in enumerate(seq_start_end):
-            start = start.item()
-            end = end.item()
-            num_ped = end - start
-            curr_hidden = h_states.view(-1, self.h_dim)[start:end] # view [1, 540, 64] --> [540, 64] take start:end ped
-            curr_end_pos = end_pos[start:end]
-
-            # Repeat position -> P1, P2, P1, P2
-            curr_end_pos_1 = curr_end_pos.repeat(num_ped, 1)
-            # Repeat position -> P1, P1, P2, P2
-            curr_end_pos_2 = self.repeat(curr_end_pos, num_ped)
-            curr_rel_pos = curr_end_pos_1 - curr_end_pos_2
-
-            curr_rel_pos[curr_rel_pos > self.neighborhood_size / 2] = self.neighborhood_size / 2
-            curr_rel_pos[curr_rel_pos < -self.neighborhood_size / 2] = -self.neighborhood_size / 2
-            curr_rel_pos /= (self.neighborhood_size / 2)
-
-            if self.pooling_dim == 4:
-                curr_disp = rel_pos[start:end]
-                curr_disp_1 = curr_disp.repeat(num_ped, 1)
-                # Repeat position -> P1, P1, P2, P2
-                curr_disp_2 = self.repeat(curr_disp, num_ped)
-                curr_rel_disp = curr_disp_1 - curr_disp_2
-                curr_rel_pos = torch.cat([curr_rel_pos, curr_rel_disp], dim=1)
-
-            curr_rel_embedding = self.spatial_embedding(curr_rel_pos)
-            # Repeat -> H1, H2, H1, H2
-            curr_hidden_1 = curr_hidden.repeat(num_ped, 1)
-            mlp_h_input = torch.cat([curr_rel_embedding, curr_hidden_1], dim=1)
-            curr_pool_h = self.mlp_pre_pool(mlp_h_input)
-            curr_pool_h = curr_pool_h.view(num_ped, num_ped, -1).max(1)[0]
-            pool_h.append(curr_pool_h) # append for all sequences the hiddens (num_ped_per_seq, 64)
-        pool_h = torch.cat(pool_h, dim=0)
+        rel_pos_pairs = end_pos[other_index] - end_pos[ped_index]
+        rel_pos_pairs = rel_pos_pairs.clamp(-self.neighborhood_size / 2, self.neighborhood_size / 2)
+        rel_pos_pairs = rel_pos_pairs / (self.neighborhood_size / 2)
+
+        if self.pooling_dim == 4:
+            rel_disp_pairs = rel_pos[other_index] - rel_pos[ped_index]
+            rel_pos_pairs = torch.cat([rel_pos_pairs, rel_disp_pairs], dim=1)
+
+        rel_embedding = self.spatial_embedding(rel_pos_pairs)
+        mlp_h_input = torch.cat([rel_embedding, hidden[other_index]], dim=1)
+        pool_h_pairs = self.mlp_pre_pool(mlp_h_input)
+
+        # Max over the neighbors of each pedestrian
+        pool_h = segment_max(pool_h_pairs, ped_index - first_ped, num_ped)
         return pool_h
 
+    def get_chunk_size(self, element_size):
+        """ Number of pairs whose mlp_pre_pool activations (about three tensors per layer) fit in pool_memory_budget """
+        pair_size = 2 * self.embedding_dim + self.h_dim + self.pooling_dim + 3 * (self.mlp_dim * 8 + self.bottleneck_dim)
+        return max(1, int(self.pool_memory_budget * 2 ** 20) // (pair_size * element_size))
+
+    def pool_pairs_chunked(self, end_pos, rel_pos, hidden, ped_index, other_index):
+        """
+        pool_pairs for the whole batch, with the pairs processed in chunks of about get_chunk_size pairs. Chunks are
+        made of whole pedestrians (a pedestrian goes to the chunk of its first pair), so that the max of each chunk is
+        already the final max of its pedestrians and the chunks are just concatenated.
+        In eval mode the output is the same as pool_pairs. In train mode it is not: the batch norm layers of
+        mlp_pre_pool normalize each chunk with its own statistics, so pool_memory_budget changes the training (and,
+        with pool_checkpoint, the recomputation in backward updates their running statistics again).
+        """
+        batch = hidden.size(0)
+        chunk_size = self.get_chunk_size(hidden.element_size())
+        num_pairs = torch.bincount(ped_index, minlength=batch)
+        chunk_id = (torch.cumsum(num_pairs, dim=0) - num_pairs) // chunk_size
+        peds_per_chunk = torch.bincount(chunk_id)
+        pairs_per_chunk = torch.zeros_like(peds_per_chunk).index_add_(0, chunk_id, num_pairs)
+
+        pool_h = []
+        first_ped, first_pair = 0, 0
+        for chunk_peds, chunk_pairs in torch.stack([peds_per_chunk, pairs_per_chunk], dim=1).tolist():
+            if chunk_peds == 0:
+                # A pedestrian with more than chunk_size pairs spans this chunk
+                continue
+            pairs = slice(first_pair, first_pair + chunk_pairs)
+            inputs = (end_pos, rel_pos, hidden, ped_index[pairs], other_index[pairs], first_ped, chunk_peds)
+            if self.pool_checkpoint and torch.is_grad_enabled():
+                pool_h.append(checkpoint(self.pool_pairs, *inputs, use_reentrant=False))
+            else:
+                pool_h.append(self.pool_pairs(*inputs))
+            first_ped += chunk_peds
+            first_pair += chunk_pairs
+        return torch.cat(pool_h, dim=0)
+
 
 class SocialPooling(nn.Module):
     """Current state of the art pooling mechanism:
     http://cvgl.stanford.edu/papers/CVPR16_Social_LSTM.pdf"""
     def __init__(
         self, h_dim=64, bottleneck_dim= 1024,activation='relu', batch_norm=True, dropout=0.0,
-        neighborhood_size=2.0, grid_size=8, pool_dim=None
+        neighborhood_size=2.0, grid_size=8, pool_dim=None, neighbor_radius=0, max_neighbors=-1
     ):
         super(SocialPooling, self).__init__()
         self.h_dim = h_dim
         self.grid_size = grid_size
         self.neighborhood_size = neighborhood_size
+        self.neighbor_radius = neighbor_radius
+        self.max_neighbors = max_neighbors
         if pool_dim:
             mlp_pool_dims = [grid_size * grid_size * h_dim, pool_dim]
         else:
@@ -126,26 +160,20 @@ class SocialPooling(nn.Module):
             dropout=dropout
         )
 
-    def forward(self, h_states, seq_start_end, end_pos, rel_pos, seq_scene_ids=None):          
+    def forward(self, h_states, seq_start_end, end_pos, rel_pos, seq_scene_ids=None, topology=None):          
         """
         Inputs:
         - h_states: Tesnsor of shape (num_layers, batch, h_dim)
         - seq_start_end: A list of tuples which delimit sequences within batch.
         - end_pos: Absolute end position of obs_traj (batch, 2)
+        - topology: BatchTopology of the batch, built from seq_start_end if not given
         Output:
         - pool_h: Tensor of shape (batch, h_dim)
         """
-        pool_h = []
-        for _, (start, end) in enumerate(seq_start_end):
-            start = start.item()
-            end = end.item()
-            num_ped = end - start
-            curr_hidden = h_states.view(-1, self.h_dim)[start:end]
-            curr_end_pos = end_pos[start:end]
-            curr_pool_h = make_grid(curr_end_pos, curr_hidden, num_ped, self.grid_size, seq_start_end, self.neighborhood_size)
-            pool_h.append(curr_pool_h.view(num_ped, -1))
-
-        pool_h = torch.cat(pool_h, dim=0)
+        hidden = h_states.view(-1, self.h_dim)
+        pool_h = make_grid(end_pos, hidden, self.grid_size, seq_start_end, self.neighborhood_size,
+                           self.neighbor_radius, self.max_neighbors, topology)
+        pool_h = pool_h.view(hidden.size(0), -1)
         pool_h = self.mlp_pool(pool_h)
         return pool_h
 
@@ -155,12 +183,14 @@ class SocialPoolingAttention(nn.Module):
     http://cvgl.stanford.edu/papers/CVPR16_Social_LSTM.pdf"""
     def __init__(
         self, h_dim=64, bottleneck_dim= 1024,activation='relu', batch_norm=True, dropout=0.0,
-        neighborhood_size=2.0, grid_size=8, pool_dim=None
+        neighborhood_size=2.0, grid_size=8, pool_dim=None, neighbor_radius=0, max_neighbors=-1
     ):
         super(SocialPoolingAttention, self).__init__()
         self.h_dim = h_dim
         self.grid_size = grid_size
         self.neighborhood_size = neighborhood_size
+        self.neighbor_radius = neighbor_radius
+        self.max_neighbors = max_neighbors
 
         self.attention_decoder = Attention_Decoder(
             attention_dim=bottleneck_dim, embed_dim=4, decoder_dim=h_dim, encoder_dim=h_dim)
@@ -172,116 +202,37 @@ class SocialPoolingAttention(nn.Module):
             activation=activation,
             batch_norm=batch_norm,
             dropout=dropout
-        ).to(device)
-
-    def get_bounds(self, ped_pos):
-        top_left_x = ped_pos[:, 0] - self.neighborhood_size / 2
-        top_left_y = ped_pos[:, 1] + self.neighborhood_size / 2
-        bottom_right_x = ped_pos[:, 0] + self.neighborhood_size / 2
-        bottom_right_y = ped_pos[:, 1] - self.neighborhood_size / 2
-        top_left = torch.stack([top_left_x, top_left_y], dim=1)
-        bottom_right = torch.stack([bottom_right_x, bottom_right_y], dim=1)
-        return top_left, bottom_right
-
-    def get_grid_locations(self, top_left, other_pos):
-        cell_x = torch.floor(
-            ((other_pos[:, 0] - top_left[:, 0]) / self.neighborhood_size) *
-            self.grid_size)
-        cell_y = torch.floor(
-            ((top_left[:, 1] - other_pos[:, 1]) / self.neighborhood_size) *
-            self.grid_size)
-        grid_pos = cell_x + cell_y * self.grid_size
-        return grid_pos
-
-    def repeat(self, tensor, num_reps):
-        """
-        Inputs:
-        -tensor: 2D tensor of any shape
-        -num_reps: Number of times to repeat each row
-        Outpus:
-        -repeat_tensor: Repeat each row such that: R1, R1, R2, R2
-        """
-        col_len = tensor.size(1)
-        tensor = tensor.unsqueeze(dim=1).repeat(1, num_reps, 1)
-        tensor = tensor.view(-1, col_len)
-        return tensor
+        ).to(get_device())
 
-
-    def forward(self, h_states, seq_start_end, end_pos, rel_pos, seq_scene_ids=None):
+    def forward(self, h_states, seq_start_end, end_pos, rel_pos, seq_scene_ids=None, topology=None):
         """
         Inputs:
         - h_states: Tesnsor of shape (num_layers, batch, h_dim)
         - seq_start_end: A list of tuples which delimit sequences within batch.
         - end_pos: Absolute end position of obs_traj (batch, 2)
+        - topology: BatchTopology of the batch, built from seq_start_end if not given
         Output:
         - pool_h: Tensor of shape (batch, h_dim)
         """
-        pool_h = []
         total_grid_size = self.grid_size * self.grid_size
-        for i, (start, end) in enumerate(seq_start_end):
-            start = start.item()
-            end = end.item()
-            num_ped = end - start
-
-            curr_hidden = h_states.view(-1, self.h_dim)[start:end]
-            curr_hidden_repeat = curr_hidden.repeat(num_ped, 1)
-            curr_end_pos = end_pos[start:end]
-            curr_pool_h_size = (num_ped * total_grid_size) + 1
-            curr_pool_h = curr_hidden.new_zeros((curr_pool_h_size, self.h_dim)).to(device)
-            # curr_end_pos = curr_end_pos.data
-            top_left, bottom_right = self.get_bounds(curr_end_pos)
-
-            # Repeat position -> P1, P2, P1, P2
-            curr_end_pos_rep = curr_end_pos.repeat(num_ped, 1)
-            # Repeat bounds -> B1, B1, B2, B2
-            top_left = self.repeat(top_left, num_ped)
-            bottom_right = self.repeat(bottom_right, num_ped)
-
-            grid_pos = self.get_grid_locations(
-                    top_left, curr_end_pos_rep).type_as(seq_start_end)
-            # Make all positions to exclude as non-zero
-            # Find which peds to exclude
-            x_bound = ((curr_end_pos_rep[:, 0] >= bottom_right[:, 0]) +
-                       (curr_end_pos_rep[:, 0] <= top_left[:, 0]))
-            y_bound = ((curr_end_pos_rep[:, 1] >= top_left[:, 1]) +
-                       (curr_end_pos_rep[:, 1] <= bottom_right[:, 1]))
-
-            within_bound = x_bound + y_bound
-            within_bound[0::num_ped + 1] = 1  # Don't include the ped itself
-            within_bound = within_bound.view(-1)
-
-            # This is a tricky way to get scatter add to work. Helps me avoid a
-            # for loop. Offset everything by 1. Use the initial 0 position to
-            # dump all uncessary adds.
-            grid_pos += 1
-            offset = torch.arange(0, total_grid_size * num_ped, total_grid_size).type_as(seq_start_end)
-
-            offset = self.repeat(offset.view(-1, 1), num_ped).view(-1)
-            grid_pos += offset
-            grid_pos[within_bound != 0] = 0
-            grid_pos = grid_pos.view(-1, 1).expand_as(curr_hidden_repeat).to(device) # grid_pos = [num_ped**2, h_dim]
-
-            curr_pool_h = curr_pool_h.scatter_add(0, grid_pos, curr_hidden_repeat)  # curr_pool_h = [num_peds * total_grid_size + 1, h_dim],  grid_pos = [num_peds**2], curr_hidden_repeat = [num_ped**2, h_dim]
-            curr_pool_h = curr_pool_h[1:]
-
-            if visualize_attention:
-                # #pool_h.append(curr_pool_h.view(num_ped, -1))  # grid_size * grid_size * h_dim
-                # Used for visualization
-                embed_info = torch.cat([curr_end_pos, rel_pos[start:end]], dim=1)
-                encoder_out = curr_pool_h.view(num_ped, total_grid_size, self.h_dim)
-                curr_pool_h_after_attention, attention_weights = self.attention_decoder(encoder_out=encoder_out, curr_hidden=curr_hidden,
-                                                                    embed_info=embed_info)
-                data_dir = get_test_data_path('sdd')
-                list_data_files = sorted([get_dset_name(os.path.join(data_dir, _path).split("/")[-1]) for _path in os.listdir(data_dir)])
-                seq_scenes = [list_data_files[num] for num in seq_scene_ids]
-                visualize_attention_weights(seq_scenes[i], self.grid_size, attention_weights, end_pos[start:end], ax1, ax2)
-
-            pool_h.append(curr_pool_h.view(num_ped, total_grid_size, self.h_dim)) # grid_size * grid_size * h_dim
-
-        pool_h = torch.cat(pool_h, dim=0)
+        hidden = h_states.view(-1, self.h_dim)
+        # Grids of all the pedestrians of the batch, [batch * total_grid_size, h_dim]
+        pool_h = make_grid(end_pos, hidden, self.grid_size, seq_start_end, self.neighborhood_size,
+                           self.neighbor_radius, self.max_neighbors, topology)
+
         encoder_out = pool_h.view(-1, total_grid_size, self.h_dim)
         embed_info = torch.cat([end_pos, rel_pos], dim=1)
-        pool_h, attention_weights = self.attention_decoder(encoder_out=encoder_out, curr_hidden=h_states.squeeze(0), embed_info=embed_info)
+        pool_h, attention_weights = self.attention_decoder(encoder_out=encoder_out, curr_hidden=hidden, embed_info=embed_info)
+
+        if visualize_attention:
+            from scripts.evaluation.visualization import visualize_attention_weights, get_attention_axes
+            ax1, ax2 = get_attention_axes()
+            data_dir = get_test_data_path('sdd')
+            list_data_files = sorted([get_dset_name(os.path.join(data_dir, _path).split("/")[-1]) for _path in os.listdir(data_dir)])
+            seq_scenes = [list_data_files[num] for num in seq_scene_ids]
+            for i, (start, end) in enumerate(seq_start_end):
+                visualize_attention_weights(seq_scenes[i], self.grid_size, attention_weights[start:end], end_pos[start:end], ax1, ax2)
+
         pool_h = self.mlp_pool(pool_h)
         return pool_h
 
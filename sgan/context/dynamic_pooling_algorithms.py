@@ -1,8 +1,8 @@
 import torch
 
-from sgan.model.utils import get_device
+from sgan.context.batch_topology import BatchTopology, get_topology
+from sgan.context.segment_reduction import segment_sum
 
-device = get_device()
 
 def get_bounds(ped_pos, neighborhood_size):
     top_left_x = ped_pos[:, 0] - neighborhood_size / 2
@@ -38,53 +38,122 @@ def repeat_row(tensor, num_reps):
     tensor = tensor.view(-1, col_len)
     return tensor
 
-def make_grid(curr_end_pos, curr_hidden, num_ped, grid_size, seq_start_end, neighborhood_size):
+def get_pair_indices(seq_start_end):
+    """
+    Inputs:
+    - seq_start_end: Tensor of shape (num_seq, 2) which delimits sequences within batch
+    Output:
+    - ped_index, other_index, pair_slot: see BatchTopology.get_pair_indices
+    """
+    return BatchTopology(seq_start_end).get_pair_indices()
+
+
+def get_pair_slots(ped_index, batch):
+    """ Position of each pair among the pairs of its pedestrian, pairs must be sorted by ped_index """
+    num_neighbors = torch.bincount(ped_index, minlength=batch)
+    first_pair = torch.cumsum(num_neighbors, dim=0) - num_neighbors
+    return torch.arange(ped_index.size(0), device=ped_index.device) - first_pair[ped_index]
+
+
+def get_neighbor_indices(end_pos, seq_start_end, radius, max_neighbors=-1, topology=None):
+    """
+    Sparse version of get_pair_indices: only the pairs of pedestrians in the same sequence whose distance along x and y
+    is at most radius (the self pairs included), found with a cell list of side radius, so that the cost is
+    O(batch * neighbors) instead of O(batch * num_ped).
+    Inputs:
+    - end_pos: Tensor of shape (batch, 2)
+    - seq_start_end: Tensor of shape (num_seq, 2) which delimits sequences within batch
+    - radius: Maximum distance along each axis
+    - max_neighbors: If != -1, keep only the max_neighbors closest neighbors of each pedestrian
+    - topology: BatchTopology of the batch, built from seq_start_end if not given
+    Output:
+    - ped_index, other_index, pair_slot: as in get_pair_indices
+    """
+    batch = end_pos.size(0)
+    seq_id = get_topology(seq_start_end, topology=topology).seq_id
+
+    # Cell of each pedestrian, shifted by one so that the neighboring cells have non-negative coordinates too
+    cells = torch.floor(end_pos.detach() / radius).long()
+    cells = cells - cells.min(dim=0)[0] + 1
+    num_cols, num_rows = (cells.max(dim=0)[0] + 2).tolist()
+    cell_key = (seq_id * num_rows + cells[:, 1]) * num_cols + cells[:, 0]
+    sorted_keys, order = torch.sort(cell_key)
+
+    # Pedestrians in the 3x3 cells around each pedestrian: contiguous ranges of the sorted keys
+    offsets = torch.tensor([-1, 0, 1], device=end_pos.device)
+    offsets = (offsets.view(-1, 1) * num_cols + offsets.view(1, -1)).view(1, -1)  # [1, 9]
+    query_keys = (cell_key.view(-1, 1) + offsets).view(-1)
+    first = torch.searchsorted(sorted_keys, query_keys)
+    num_candidates = torch.searchsorted(sorted_keys, query_keys, right=True) - first
+
+    query_index = torch.arange(query_keys.size(0), device=end_pos.device).repeat_interleave(num_candidates)
+    first_candidate = torch.cumsum(num_candidates, dim=0) - num_candidates
+    candidate_slot = torch.arange(query_index.size(0), device=end_pos.device) - first_candidate[query_index]
+    ped_index = query_index // offsets.size(1)
+    other_index = order[first[query_index] + candidate_slot]
+
+    distance = (end_pos[other_index] - end_pos[ped_index]).detach().abs()
+    within_radius = (distance <= radius).all(dim=1)
+    ped_index = ped_index[within_radius]
+    other_index = other_index[within_radius]
+
+    if max_neighbors != -1:
+        # Sort the neighbors of each pedestrian by distance and keep the closest ones (the ped itself is the first)
+        distance = torch.norm(end_pos[other_index] - end_pos[ped_index], dim=1).detach()
+        by_distance = torch.sort(distance, stable=True)[1]
+        by_ped = torch.sort(ped_index[by_distance], stable=True)[1]
+        ped_index = ped_index[by_distance][by_ped]
+        other_index = other_index[by_distance][by_ped]
+        closest = get_pair_slots(ped_index, batch) < max_neighbors
+        ped_index = ped_index[closest]
+        other_index = other_index[closest]
+
+    return ped_index, other_index, get_pair_slots(ped_index, batch)
+
+
+def make_grid(curr_end_pos, curr_hidden, grid_size, seq_start_end, neighborhood_size, neighbor_radius=0, max_neighbors=-1,
+              topology=None):
     """
     Inputs:
     - curr_end_pos: End position of obs_traj (batch, 2)
-    - seq_start_end: A list of tuples which delimit sequences within batch.
     - curr_hidden: Hidden state (batch, h_dim)
+    - grid_size: Number of cells per side of the grid around each pedestrian
+    - seq_start_end: Tensor of shape (num_seq, 2) which delimits sequences within batch
+    - neighbor_radius: If > 0, consider only the pairs found by get_neighbor_indices (at most neighborhood_size / 2)
+    - max_neighbors: Maximum number of neighbors per pedestrian with neighbor_radius, -1 for no limit
+    - topology: BatchTopology of the batch, built from seq_start_end if not given
     Output:
-    - pool_h: Tensor of shape (batch, h_dim)
+    - pool_h: Tensor of shape (batch * grid_size * grid_size, h_dim), sum of the hidden states of the other
+    pedestrians of the same sequence in each cell of the grid of each pedestrian
     """
-    h_dim = curr_hidden.size(1)
+    batch = curr_hidden.size(0)
     total_grid_size = grid_size*grid_size
 
-    curr_hidden_repeat = curr_hidden.repeat(num_ped, 1)
-    curr_pool_h_size = (num_ped * total_grid_size) + 1
-    curr_pool_h = curr_hidden.new_zeros((curr_pool_h_size, h_dim)).to(device)
-    # curr_end_pos = curr_end_pos.data
+    # Only the pairs of pedestrians in the same sequence
+    topology = get_topology(seq_start_end, topology=topology)
+    if neighbor_radius > 0:
+        ped_index, other_index, _ = get_neighbor_indices(curr_end_pos, seq_start_end, min(neighbor_radius, neighborhood_size / 2),
+                                                         max_neighbors, topology)
+    else:
+        ped_index, other_index, _ = topology.get_pair_indices()
     top_left, bottom_right = get_bounds(curr_end_pos, neighborhood_size)
+    top_left = top_left[ped_index]
+    bottom_right = bottom_right[ped_index]
+    other_pos = curr_end_pos[other_index]
 
-    # Repeat position -> P1, P2, P1, P2
-    curr_end_pos = curr_end_pos.repeat(num_ped, 1)
-    # Repeat bounds -> B1, B1, B2, B2
-    top_left = repeat_row(top_left, num_ped)
-    bottom_right = repeat_row(bottom_right, num_ped)
-
-    grid_pos = get_grid_locations(top_left, curr_end_pos, neighborhood_size, grid_size).type_as(seq_start_end)
-    # Make all positions to exclude as non-zero
+    grid_pos = get_grid_locations(top_left, other_pos, neighborhood_size, grid_size).long()
     # Find which peds to exclude
-    x_bound = ((curr_end_pos[:, 0] >= bottom_right[:, 0]) +
-               (curr_end_pos[:, 0] <= top_left[:, 0]))
-    y_bound = ((curr_end_pos[:, 1] >= top_left[:, 1]) +
-               (curr_end_pos[:, 1] <= bottom_right[:, 1]))
-
-    within_bound = x_bound + y_bound
-    within_bound[0::num_ped + 1] = 1  # Don't include the ped itself
-    within_bound = within_bound.view(-1)
+    x_bound = ((other_pos[:, 0] >= bottom_right[:, 0]) |
+               (other_pos[:, 0] <= top_left[:, 0]))
+    y_bound = ((other_pos[:, 1] >= top_left[:, 1]) |
+               (other_pos[:, 1] <= bottom_right[:, 1]))
+    outside = x_bound | y_bound | (ped_index == other_index)  # Don't include the ped itself
 
     # This is a tricky way to get scatter add to work. Helps me avoid a
     # for loop. Offset everything by 1. Use the initial 0 position to
     # dump all uncessary adds.
-    grid_pos += 1
-
-    offset = torch.arange(0, total_grid_size * num_ped, total_grid_size).type_as(seq_start_end)
-
-    offset = repeat_row(offset.view(-1, 1), num_ped).view(-1)
-    grid_pos += offset
-    grid_pos[within_bound != 0] = 0
-    grid_pos = grid_pos.view(-1, 1).expand_as(curr_hidden_repeat)  # grid_pos = [num_ped**2, h_dim]
+    grid_pos = grid_pos + ped_index * total_grid_size + 1
+    grid_pos[outside] = 0
 
-    curr_pool_h = curr_pool_h.scatter_add(0, grid_pos, curr_hidden_repeat)  # curr_hidden_repeat = [num_ped**2, h_dim]
-    return curr_pool_h[1:]
\ No newline at end of file
+    curr_pool_h = segment_sum(curr_hidden[other_index], grid_pos, batch * total_grid_size + 1)
+    return curr_pool_h[1:]
@@ -1,7 +1,7 @@
 import torch
 
 class NullPooling():
-    def forward(self, final_encoder_h, seq_start_end, end_pos, rel_pos, seq_scene_ids):
+    def forward(self, final_encoder_h, seq_start_end, end_pos, rel_pos, seq_scene_ids, topology=None):
         h_dim = final_encoder_h.size(2)
         ci = final_encoder_h.view(-1, h_dim) 
         return ci 
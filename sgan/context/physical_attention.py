@@ -3,11 +3,9 @@
 
 import torch
 from torch import nn
-import torchvision
 
 from sgan.model.utils import get_device
 
-device = get_device()
 
 class Attention_Encoder(nn.Module):
     """
@@ -22,6 +20,7 @@ class Attention_Encoder(nn.Module):
         super(Attention_Encoder, self).__init__()
         self.enc_image_size = encoded_image_size
 
+        import torchvision  # only the scene encoder needs it, imported when it is built
         resnet = torchvision.models.resnet50(pretrained=True)  # pretrained ImageNet ResNet-50
 
         # Remove linear and pool layers (since we're not doing classification)
@@ -74,27 +73,33 @@ class Attention(nn.Module):
         :param encoded_image_size: used to add a Batch Normalization layer after the image is encoded (to limit their range of values)
         """
         super(Attention, self).__init__()
-        self.encoder_att = nn.Linear(encoder_dim, attention_dim).to(device)  # linear layer to transform encoded image
-        self.decoder_att = nn.Linear(decoder_dim, attention_dim).to(device)  # linear layer to transform SafeGAN decoder's output
+        self.encoder_att = nn.Linear(encoder_dim, attention_dim).to(get_device())  # linear layer to transform encoded image
+        self.decoder_att = nn.Linear(decoder_dim, attention_dim).to(get_device())  # linear layer to transform SafeGAN decoder's output
         self.relu = nn.ReLU()
-        self.full_att = nn.Linear(attention_dim, 1).to(device)  # linear layer to calculate values to be softmax-ed
+        self.full_att = nn.Linear(attention_dim, 1).to(get_device())  # linear layer to calculate values to be softmax-ed
         self.softmax = nn.Softmax(dim=1)  # softmax layer to calculate weights
 
-    def forward(self, encoder_out, decoder_hidden):
+    def forward(self, encoder_out, decoder_hidden, image_features=None):
         """
         Forward propagation.
 
-        :param encoder_out: encoded images, a tensor of dimension (batch_size, num_pixels, encoder_dim)
+        :param encoder_out: encoded images, a tensor of dimension (batch_size, num_pixels, encoder_dim), or
+                            (1, num_pixels, encoder_dim) for one image shared by the whole batch
         :param decoder_hidden: previous SafeGAN decoder output, a tensor of dimension (batch_size, decoder_dim)
+        :param image_features: encoder_att(encoder_out), if already computed
         :return: attention weighted encoding, attention_weights
         """
-        image_features = self.encoder_att(encoder_out) # (batch_size, num_pixels, attention_dim)
+        if image_features is None:
+            image_features = self.encoder_att(encoder_out) # (batch_size or 1, num_pixels, attention_dim)
         hidden_features = self.decoder_att(decoder_hidden)  # (batch_size, attention_dim)
-        out = self.relu(image_features.to(device) + hidden_features.unsqueeze(1).to(device)).to(device)
-        out = out.to(device)
+        out = self.relu(image_features + hidden_features.unsqueeze(1))
         att = self.full_att(out).squeeze(2)  # (batch_size, num_pixels)
         attention_weights = self.softmax(att)  # (batch_size, num_pixels)
-        attention_weighted_encoding = (encoder_out * attention_weights.unsqueeze(2)).sum(dim=1)  # (batch_size, encoder_dim)
+        if encoder_out.size(0) == 1:
+            # Shared image: no per-agent copy of the feature map
+            attention_weighted_encoding = attention_weights.mm(encoder_out[0])  # (batch_size, encoder_dim)
+        else:
+            attention_weighted_encoding = (encoder_out * attention_weights.unsqueeze(2)).sum(dim=1)  # (batch_size, encoder_dim)
 
         return attention_weighted_encoding, attention_weights
 
@@ -121,33 +126,38 @@ class Attention_Decoder(nn.Module):
         self.decoder_dim = decoder_dim
         self.encoder_dim = encoder_dim
 
-        self.attention = Attention(encoder_dim, decoder_dim, attention_dim).to(device)  # attention network
-        self.decode_step = nn.LSTMCell(embed_dim + encoder_dim, attention_dim, bias=True).to(device)  # decoding LSTM
+        self.attention = Attention(encoder_dim, decoder_dim, attention_dim).to(get_device())  # attention network
+        self.decode_step = nn.LSTMCell(embed_dim + encoder_dim, attention_dim, bias=True).to(get_device())  # decoding LSTM
         self.hidden = self.init_hidden()  # initialize hidden and cell state of the decoding LSTM
 
-    def init_hidden(self):
+    def init_hidden(self, device=None):
         """
+        :param device: device of the inputs, get_device() if not given
         :return: two tensors with zeroes to initialize the decoder's LSTM cell state and hidden state
         """
-        return (torch.zeros(1, self.attention_dim).to(device),
-                torch.zeros(1, self.attention_dim).to(device))
+        device = get_device() if device is None else device
+        return (torch.zeros(1, self.attention_dim, device=device),
+                torch.zeros(1, self.attention_dim, device=device))
 
-    def forward(self, encoder_out, curr_hidden, embed_info):
+    def forward(self, encoder_out, curr_hidden, embed_info, image_features=None):
         """
         Forward propagation.
 
-        :param encoder_out: encoded images, a tensor of dimension (batch_size, enc_image_size, enc_image_size, encoder_dim)
+        :param encoder_out: encoded images, a tensor of dimension (batch_size, num_pixels, encoder_dim), or
+                            (1, num_pixels, encoder_dim) for one image shared by the whole batch
         :param curr_hidden: previous hidden state of SafeGAN generator's decoder, of dimension (batch_size, decoder_dim)
         :param embed_info: additional info to attach to the attention weighted image, for example the agents
                            coordinates and their relative displacements with each other (batch_size, embed_dim)
+        :param image_features: projection of encoder_out by the attention network (see Attention.forward), if already
+                               computed
         :return: Attention output, Attention_weights (num_ped, attention_dim), (num_ped, enc_image_size**2)
         """
         self.zero_grad()
-        self.hidden = self.init_hidden()
+        self.hidden = self.init_hidden(embed_info.device)
         # attention-weighting the encoder's output based on the SafeGAN generator decoder's previous hidden state output
-        attention_weighted_encoding, attention_weights = self.attention(encoder_out, curr_hidden)
+        attention_weighted_encoding, attention_weights = self.attention(encoder_out, curr_hidden, image_features)
         state_tuple = (self.hidden[0].repeat(embed_info.shape[0], 1), self.hidden[1].repeat(embed_info.shape[0], 1))
-        input = torch.cat([embed_info.to(device), attention_weighted_encoding.to(device)], dim=1).to(device)
+        input = torch.cat([embed_info, attention_weighted_encoding], dim=1)
         lstm_hidden, lstm_cell = self.decode_step(input, state_tuple)  # (batch_size, attention_dim)
         # update the attention decoder's lstm cell state and hidden state assigning them the first element of the compute
         # output. This because each time the batch size can vary, so it was not possible to have an hidden state with the
@@ -0,0 +1,75 @@
+""" On-disk store of the ResNet encodings of the scene images used by the physical attention static pooling """
+
+import hashlib
+import os
+import numpy as np
+import torch
+
+from sgan.model.utils import get_device
+
+
+SCENE_FEATURES_FOLDER = 'scene_features'
+SEGMENTED_SCENES_FOLDER = 'segmented_scenes'
+
+# Statistics of the ImageNet images' RGB channels (the resnet has been pretrained on ImageNet)
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+def get_image_hash(image_path, block_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(image_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()[:16]
+
+
+def get_scene_image_path(path_group, name):
+    return os.path.join(path_group, SEGMENTED_SCENES_FOLDER, name + '.jpg')
+
+
+def get_scene_features_path(path_group, name, image_hash):
+    """ Features are keyed by scene name and hash of the image, so that a changed image is never matched """
+    return os.path.join(path_group, SCENE_FEATURES_FOLDER, '{}_{}.npy'.format(name, image_hash))
+
+
+def read_scene_image(image_path):
+    import matplotlib.pyplot as plt
+    return plt.imread(image_path)
+
+
+def encode_scene_images(attention_encoder, images):
+    """
+    Inputs:
+    - attention_encoder: Attention_Encoder
+    - images: list of numpy arrays of shape (H, W, 3), all with the same size
+    Output:
+    - features: numpy array of shape (batch_size, encoded_image_size, encoded_image_size, 2048)
+    """
+    images = torch.from_numpy(np.stack(images)).type(torch.float).to(get_device())
+    # PyTorch follows the NCHW convention, which means the channels dimension (C) must precede the size dimensions
+    images = images.permute(0, 3, 1, 2)
+    mean = torch.tensor(IMAGENET_MEAN, device=get_device()).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, device=get_device()).view(1, 3, 1, 1)
+    images = (images - mean) / std
+    attention_encoder.eval()
+    with torch.no_grad():
+        features = attention_encoder(images)
+    return features.cpu().numpy()
+
+
+def save_scene_features(features_path, features):
+    os.makedirs(os.path.dirname(features_path), exist_ok=True)
+    np.save(features_path, features.astype(np.float32))
+
+
+def load_scene_features(path_group, name):
+    """
+    Memory-map the stored features of the scene image, returns None if the image has not been encoded yet. The map is
+    copy-on-write, so that the array is writable (as torch.from_numpy expects) without ever changing the store
+    """
+    image_path = get_scene_image_path(path_group, name)
+    features_path = get_scene_features_path(path_group, name, get_image_hash(image_path))
+    if not os.path.isfile(features_path):
+        return None
+    return np.load(features_path, mmap_mode='c')
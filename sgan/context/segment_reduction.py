@@ -0,0 +1,30 @@
+""" Reductions over segments of rows (e.g. all the pairs of a pedestrian), shared by the pooling modules """
+
+
+def segment_max(src, index, num_segments):
+    """
+    Inputs:
+    - src: Tensor of shape (num_rows, ...), e.g. the features of the pairs of pedestrians
+    - index: LongTensor of shape (num_rows,) with the segment of each row (e.g. the receiving pedestrian), in any
+    order, as with the sparse or the batched pair lists
+    - num_segments: Number of segments
+    Output:
+    - Tensor of shape (num_segments, ...) with the max of the rows of each segment, 0 for the segments without rows.
+    The gradient goes to the rows that are the max (split evenly among ties)
+    """
+    index = index.view((-1, ) + (1, ) * (src.dim() - 1)).expand_as(src)
+    out = src.new_zeros((num_segments, ) + src.shape[1:])
+    return out.scatter_reduce(0, index, src, reduce='amax', include_self=False)
+
+
+def segment_sum(src, index, num_segments):
+    """
+    Inputs:
+    - src: Tensor of shape (num_rows, ...)
+    - index: LongTensor of shape (num_rows,) with the segment of each row
+    - num_segments: Number of segments
+    Output:
+    - Tensor of shape (num_segments, ...) with the sum of the rows of each segment
+    """
+    out = src.new_zeros((num_segments, ) + src.shape[1:])
+    return out.index_add(0, index, src)
@@ -4,20 +4,19 @@ import numpy as np
 
 import os
 
-from scripts.evaluation.visualization import visualize_attention_weights
 from sgan.context.static_scene_feature_extractor import StaticSceneFeatureExtractorRandom, StaticSceneFeatureExtractorGrid, StaticSceneFeatureExtractorCNN, StaticSceneFeatureExtractorRaycast, StaticSceneFeatureExtractorPolar, StaticSceneFeatureExtractorAttention
 from sgan.model.utils import get_device
 from sgan.model.folder_utils import get_dset_name, get_dset_group_name, get_root_dir
+from sgan.data.boundary_points import load_boundary_points
 from sgan.context.physical_attention import Attention_Decoder
 from sgan.model.mlp import make_mlp
-device = get_device()
+from sgan.context.batch_topology import get_topology
+from sgan.context.segment_reduction import segment_sum
+from sgan.context.dynamic_pooling_algorithms import get_bounds
 
+# The visualization (matplotlib) is imported only when the attention weights are plotted
 visualize_attention = False
 
-if visualize_attention:
-    import matplotlib.pyplot as plt
-    fig, ((ax1, ax2)) = plt.subplots(1, 2, figsize=(8, 4), num=1)
-
 
 class PhysicalPooling(nn.Module):
     def __init__(
@@ -39,56 +38,54 @@ class PhysicalPooling(nn.Module):
         if pool_static_type == "random":
             self.static_scene_feature_extractor = StaticSceneFeatureExtractorRandom(pool_static_type, down_samples, embedding_dim,
                                                                           h_dim, bottleneck_dim, activation, batch_norm, dropout,
-                                                                          mlp_dim, num_cells, neighborhood_size).to(device)
+                                                                          mlp_dim, num_cells, neighborhood_size).to(get_device())
 
         elif pool_static_type == "grid":
             self.static_scene_feature_extractor = StaticSceneFeatureExtractorGrid(pool_static_type, down_samples, embedding_dim,
                                                                           h_dim, bottleneck_dim, activation, batch_norm, dropout,
-                                                                          mlp_dim, num_cells, neighborhood_size).to(device)
+                                                                          mlp_dim, num_cells, neighborhood_size).to(get_device())
         elif pool_static_type == "random_cnn" or pool_static_type == "random_cnn":
             self.static_scene_feature_extractor = StaticSceneFeatureExtractorCNN(pool_static_type, down_samples, embedding_dim,
                                                                           h_dim, bottleneck_dim, activation, batch_norm, dropout,
-                                                                          mlp_dim, num_cells, neighborhood_size).to(device)
+                                                                          mlp_dim, num_cells, neighborhood_size).to(get_device())
         elif "raycast" in pool_static_type:
             self.static_scene_feature_extractor = StaticSceneFeatureExtractorRaycast(pool_static_type, down_samples, embedding_dim,
                                                                                  h_dim, bottleneck_dim, activation, batch_norm, dropout,
-                                                                                 mlp_dim, num_cells, neighborhood_size).to(device)
+                                                                                 mlp_dim, num_cells, neighborhood_size).to(get_device())
         elif "polar" in pool_static_type:
             self.static_scene_feature_extractor = StaticSceneFeatureExtractorPolar(pool_static_type, down_samples, embedding_dim,
                                                                                  h_dim, bottleneck_dim, activation, batch_norm, dropout,
-                                                                                 mlp_dim, num_cells, neighborhood_size).to(device)
+                                                                                 mlp_dim, num_cells, neighborhood_size).to(get_device())
         elif "physical_attention" in pool_static_type:
             self.static_scene_feature_extractor = StaticSceneFeatureExtractorAttention(pool_static_type, down_samples, embedding_dim,
                                                                                  h_dim, bottleneck_dim, activation, batch_norm, dropout,
-                                                                                 mlp_dim, num_cells, neighborhood_size).to(device)
+                                                                                 mlp_dim, num_cells, neighborhood_size).to(get_device())
         else:
             print("Error in recognizing static scene feature extractor type!")
             exit()
 
-    def forward(self, h_states, seq_start_end, end_pos, rel_pos, seq_scene_ids):
+    def forward(self, h_states, seq_start_end, end_pos, rel_pos, seq_scene_ids, topology=None):
         """
         Inputs:
         - h_states: Tensor of shape (num_layers, batch, h_dim)
         - seq_start_end: A list of tuples which delimit sequences within batch
         - end_pos: Tensor of shape (batch, 2)
+        - topology: BatchTopology of the batch, built from seq_start_end if not given
         Output:
         - pool_h: Tensor of shape (batch, bottleneck_dim)
         """
 
-        seq_scenes = [self.static_scene_feature_extractor.list_data_files[num] for num in seq_scene_ids]
-        pool_h = []
-        for i, (start, end) in enumerate(seq_start_end):
-            start = start.item()
-            end = end.item()
-            num_ped = end - start
-            curr_hidden_1 = h_states.view(-1, self.h_dim)[start:end]
-            curr_end_pos = end_pos[start:end]
-            curr_disp_pos = rel_pos[start:end]
-
-            curr_pool_h = self.static_scene_feature_extractor(seq_scenes[i], num_ped, curr_end_pos, curr_disp_pos, curr_hidden_1)
-
-            pool_h.append(curr_pool_h) # append for all sequences the hiddens (num_ped_per_seq, 64)
-        pool_h = torch.cat(pool_h, dim=0)
+        hidden = h_states.view(-1, self.h_dim)
+        pool_h = None
+        # The extractor runs once per scene, over all the pedestrians of the batch in that scene
+        for scene_id, ped_index in get_topology(seq_start_end, seq_scene_ids, topology).get_scene_groups():
+            scene_name = self.static_scene_feature_extractor.list_data_files[scene_id]
+            curr_pool_h = self.static_scene_feature_extractor(scene_name, ped_index.size(0), end_pos[ped_index],
+                                                              rel_pos[ped_index], hidden[ped_index], topology)
+            if pool_h is None:
+                pool_h = curr_pool_h.new_zeros((hidden.size(0), curr_pool_h.size(1)))
+            # Back to the batch order
+            pool_h = pool_h.index_copy(0, ped_index, curr_pool_h)
         return pool_h
 
 class StaticFeatures:
@@ -96,7 +93,7 @@ class StaticFeatures:
         self.scene_information = {}
         self.down_samples = down_samples
 
-    def set_dset_list(self, data_dir, down_sampling=True):
+    def set_dset_list(self, data_dir, down_sampling=True, boundary_tolerance=None):
         """ Fill scene_information with the static environment features that will be used as part of the input of Static
                  Scene Feature Extractor module in SafeGAN"""
 
@@ -110,12 +107,8 @@ class StaticFeatures:
             """ The inputs are the boundary points between the traversable and non-traversable areas. It is 
                 possible to take all points or just a sample"""
             path = os.path.join(path_group, name)
-            map = np.load(path + "/world_points_boundary.npy")
-            if self.down_samples != -1 and down_sampling and map.shape[0] > self.down_samples:
-                down_sampling = (map.shape[0] // self.down_samples)
-                sampled = map[::down_sampling]
-                map = sampled[:self.down_samples]
-            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(device)
+            map = load_boundary_points(path, self.down_samples if down_sampling else -1, boundary_tolerance)
+            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(get_device())
 
 
 class GridPooling(nn.Module):
@@ -146,116 +139,56 @@ class GridPooling(nn.Module):
             activation=activation,
             batch_norm=batch_norm,
             dropout=dropout
-        ).to(device)
+        ).to(get_device())
 
-    def get_bounds(self, ped_pos):
-        top_left_x = ped_pos[:, 0] - self.neighborhood_size / 2
-        top_left_y = ped_pos[:, 1] + self.neighborhood_size / 2
-        bottom_right_x = ped_pos[:, 0] + self.neighborhood_size / 2
-        bottom_right_y = ped_pos[:, 1] - self.neighborhood_size / 2
-        top_left = torch.stack([top_left_x, top_left_y], dim=1)
-        bottom_right = torch.stack([bottom_right_x, bottom_right_y], dim=1)
-        return top_left, bottom_right
-
-    def get_grid_locations(self, top_left, other_pos):
-        cell_x = torch.floor(
-            ((other_pos[:, 0] - top_left[:, 0]) / self.neighborhood_size) *
-            self.grid_size)
-        cell_y = torch.floor(
-            ((top_left[:, 1] - other_pos[:, 1]) / self.neighborhood_size) *
-            self.grid_size)
-        grid_pos = cell_x + cell_y * self.grid_size
-        return grid_pos
-
-    def repeat(self, tensor, num_reps):
-        """
-        Inputs:
-        -tensor: 2D tensor of any shape
-        -num_reps: Number of times to repeat each row
-        Outpus:
-        -repeat_tensor: Repeat each row such that: R1, R1, R2, R2
-        """
-        col_len = tensor.size(1)
-        tensor = tensor.unsqueeze(dim=1).repeat(1, num_reps, 1)
-        tensor = tensor.view(-1, col_len)
-        return tensor
-
-    def forward(self, h_states, seq_start_end, end_pos, rel_pos, seq_scene_ids):
+    def forward(self, h_states, seq_start_end, end_pos, rel_pos, seq_scene_ids, topology=None):
         """
         Inputs:
         - h_states: Tensor of shape (num_layers, batch, h_dim)
         - seq_start_end: A list of tuples which delimit sequences within batch
         - end_pos: Tensor of shape (batch, 2)
+        - topology: BatchTopology of the batch, built from seq_start_end if not given
         Output:
         - pool_h: Tensor of shape (batch, bottleneck_dim)
         """
+        hidden = h_states.view(-1, self.h_dim)
+        batch = hidden.size(0)
+        total_grid_size = self.grid_size ** 2
+        top_left, bottom_right = get_bounds(end_pos, self.neighborhood_size)
+
+        # Occupancy grids of all the pedestrians of the batch. Use the initial 0 position to dump all the points
+        # outside the grids
+        grid_pos_list = []
+        for scene_id, ped_index in get_topology(seq_start_end, seq_scene_ids, topology).get_scene_groups():
+            scene_name = self.static_scene_feature_extractor.list_data_files[scene_id]
+            scene_info = self.static_scene_feature_extractor.scene_information[scene_name]
+
+            # [num_ped_in_scene, num_points] through broadcasting
+            curr_top_left = top_left[ped_index].unsqueeze(1)
+            curr_bottom_right = bottom_right[ped_index].unsqueeze(1)
+            points = scene_info.unsqueeze(0)
+            cell_x = torch.floor(((points[..., 0] - curr_top_left[..., 0]) / self.neighborhood_size) * self.grid_size)
+            cell_y = torch.floor(((curr_top_left[..., 1] - points[..., 1]) / self.neighborhood_size) * self.grid_size)
+            grid_pos = (cell_x + cell_y * self.grid_size).long() + 1 + ped_index.unsqueeze(1) * total_grid_size
+
+            outside = (points[..., 0] >= curr_bottom_right[..., 0]) | (points[..., 0] <= curr_top_left[..., 0]) | \
+                      (points[..., 1] >= curr_top_left[..., 1]) | (points[..., 1] <= curr_bottom_right[..., 1])
+            grid_pos[outside] = 0
+            grid_pos_list.append(grid_pos.view(-1))
+
+        grid_pos = torch.cat(grid_pos_list)
+        grid = segment_sum(hidden.new_ones(grid_pos.size(0)), grid_pos, batch * total_grid_size + 1)
+
+        encoder_out = grid[1:].view(batch, total_grid_size, 1)
+        embed_info = torch.cat([end_pos, rel_pos], dim=1)
+        pool_h, attention_weights = self.attention_decoder(encoder_out=encoder_out, curr_hidden=hidden, embed_info=embed_info)
 
-        seq_scenes = [self.static_scene_feature_extractor.list_data_files[num] for num in seq_scene_ids]
-        pool_h = []
-        for i, (start, end) in enumerate(seq_start_end):
-            start = start.item()
-            end = end.item()
-            num_ped = end - start
-            curr_hidden_1 = h_states.view(-1, self.h_dim)[start:end]
-            curr_end_pos = end_pos[start:end]
-            curr_disp_pos = rel_pos[start:end]
-
-            scene_info = self.static_scene_feature_extractor.scene_information[seq_scenes[i]]
-            num_points = scene_info.size(0)
-            total_grid_size = self.grid_size ** 2
-            # scene_info = torch.rand(10)*5
-
-            curr_hidden = curr_hidden_1.view(-1, self.h_dim)
-
-            # curr_end_pos = curr_end_pos.data
-            top_left, bottom_right = self.get_bounds(curr_end_pos)
-
-            # Repeat position -> P1, P2, P1, P2
-            scene_info_rep = scene_info.repeat(num_ped, 1)
-            # Repeat bounds -> B1, B1, B2, B2
-            top_left = self.repeat(top_left, num_points)
-            bottom_right = self.repeat(bottom_right, num_points)
-
-            grid_pos = self.get_grid_locations(
-                top_left, scene_info_rep).view(num_ped, num_points)
-            # Make all positions to exclude as non-zero
-            # Find which peds to exclude
-            x_bound = ((scene_info_rep[:, 0] >= bottom_right[:, 0]) +
-                       (scene_info_rep[:, 0] <= top_left[:, 0]))
-            y_bound = ((scene_info_rep[:, 1] >= top_left[:, 1]) +
-                       (scene_info_rep[:, 1] <= bottom_right[:, 1]))
-
-            within_bound = x_bound + y_bound
-            within_bound = within_bound.view(num_ped, num_points)
-
-            grid_pos += 1
-            offset = torch.arange(0, total_grid_size * num_ped, total_grid_size).to(device)
-            offset = self.repeat(offset.view(-1, 1), num_points).view(num_ped, num_points)
-            grid_pos += offset
-
-            grid_pos[within_bound != 0] = 0
-            occupancy = torch.ones(num_points * num_ped, 1).to(device)
-            grid_pos = grid_pos.view(-1, 1).type(torch.LongTensor).to(device)  # grid_pos = [num_ped*num_points, h_dim]
-            curr_grid = torch.zeros(((num_ped * total_grid_size + 1), 1)).to(device)
-
-            curr_grid = curr_grid.scatter_add(0, grid_pos, occupancy)  # curr_hidden_repeat = [num_ped**2, h_dim]
-            curr_grid = curr_grid[1:]
-            # curr_grid.view(num_ped, total_grid_size, 1)
-            # encoder_out = curr_grid.view(num_ped, total_grid_size, 1)
-            # curr_pool_h, attention_weights = self.attention_decoder(encoder_out=encoder_out, curr_hidden=curr_hidden, embed_info=embed_info)
-            # pool_h.append(curr_pool_h) # append for all sequences the hiddens (num_ped_per_seq, 64)
-
-            if visualize_attention:
-                embed_info = torch.cat([curr_end_pos, curr_disp_pos], dim=1)
-                encoder_out = curr_grid.view(num_ped, total_grid_size, 1)
-                curr_pool_h, attention_weights = self.attention_decoder(encoder_out=encoder_out, curr_hidden=curr_hidden, embed_info=embed_info)
-                visualize_attention_weights(seq_scenes[i], self.grid_size, attention_weights, end_pos[start:end], ax1, ax2)
-            pool_h.append(curr_grid.view(num_ped, total_grid_size, 1)) # grid_size * grid_size * 1
+        if visualize_attention:
+            from scripts.evaluation.visualization import visualize_attention_weights, get_attention_axes
+            ax1, ax2 = get_attention_axes()
+            seq_scenes = [self.static_scene_feature_extractor.list_data_files[num] for num in seq_scene_ids]
+            for i, (start, end) in enumerate(seq_start_end):
+                visualize_attention_weights(seq_scenes[i], self.grid_size, attention_weights[start:end], end_pos[start:end], ax1, ax2)
 
-        pool_h = torch.cat(pool_h, dim=0)
-        encoder_out = pool_h.view(-1, total_grid_size, 1)
-        embed_info = torch.cat([end_pos, rel_pos], dim=1)
-        pool_h, attention_weights = self.attention_decoder(encoder_out=encoder_out, curr_hidden=h_states.squeeze(0), embed_info=embed_info)
         pool_h = self.mlp_pool(pool_h)
-        #pool_h = torch.cat(pool_h, dim=0)
         return pool_h
@@ -1,8 +1,10 @@
+import os
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
 
+from sgan.model.utils import get_device
+
 
 def repeat(tensor, num_reps):
     """
@@ -40,7 +42,7 @@ def get_polar_grid_points(ped_positions, ped_directions, boundary_points, num_be
     thetas_peds = torch.atan2(ped_directions[:, 1], ped_directions[:, 0]).unsqueeze(1)
     thetas_peds_repeated = repeat(thetas_peds, boundary_points.size(0))
     ped_positions_repeated = repeat(ped_positions, boundary_points.size(0))
-    ped_ids = torch.from_numpy(np.arange(ped_positions.size(0))).unsqueeze(1).cuda()
+    ped_ids = torch.from_numpy(np.arange(ped_positions.size(0))).unsqueeze(1).to(ped_positions.device)
     ped_ids_repeated = repeat(ped_ids, boundary_points.size(0))
     boundary_points_repeated = boundary_points.repeat(ped_positions.size(0), 1)
 
@@ -56,12 +58,13 @@ def get_polar_grid_points(ped_positions, ped_directions, boundary_points, num_be
     thetas_boundary_points = torch.atan2(boundary_points_repeated[:, 1], boundary_points_repeated[:, 0]).unsqueeze(1)
 
     # Build Dataframe with [pedestrians_ids, thetas_boundaries, radiuses_boundaries]
+    import pandas as pd  # only the brute force grids need it, the lookup tables do not
     df = pd.DataFrame(columns=['ped_id', 'theta_boundary', 'radius_boundary'],
                       data=np.concatenate((ped_ids_repeated, thetas_boundary_points, radiuses_boundary_points), axis=1))
 
     if not return_true_points:
         # Add num_beams equidistant points for each pedestrian so that, if there are no other points in that polar grid beams, there will be always num_beams points
-        thetas_new_boundaries = torch.from_numpy(np.linspace(-np.pi / 2 + (np.pi / num_beams) / 2, np.pi / 2 - (np.pi / num_beams) / 2, num_beams)).unsqueeze(1).cuda()
+        thetas_new_boundaries = torch.from_numpy(np.linspace(-np.pi / 2 + (np.pi / num_beams) / 2, np.pi / 2 - (np.pi / num_beams) / 2, num_beams)).unsqueeze(1).to(ped_positions.device)
         thetas_new_boundaries_repeated = thetas_new_boundaries.repeat(ped_positions.size(0), 1)
         df_new_thetas = pd.DataFrame(columns=['ped_id', 'theta_boundary', 'radius_boundary'],
                                      data=np.concatenate((repeat(torch.from_numpy(np.arange(ped_positions.size(0))).unsqueeze(1), thetas_new_boundaries.size(0))[:, 0].unsqueeze(1),
@@ -73,7 +76,7 @@ def get_polar_grid_points(ped_positions, ped_directions, boundary_points, num_be
         df = df.loc[df['radius_boundary'] <= radius]
         # Create a new dataframe with "num_beams" points at a distance of 0 meter from the curr pedestrian position, so that afterwards
         # they will be output in the case in some beams there are no points in the range 0-"radius" meters
-        thetas_new_boundaries = torch.from_numpy(np.linspace(-np.pi / 2 + (np.pi / num_beams) / 2, np.pi / 2 - (np.pi / num_beams) / 2, num_beams)).unsqueeze(1).cuda()
+        thetas_new_boundaries = torch.from_numpy(np.linspace(-np.pi / 2 + (np.pi / num_beams) / 2, np.pi / 2 - (np.pi / num_beams) / 2, num_beams)).unsqueeze(1).to(ped_positions.device)
         thetas_new_boundaries_repeated = thetas_new_boundaries.repeat(ped_positions.size(0), 1)
         df_new_thetas = pd.DataFrame(columns=['ped_id', 'theta_boundary', 'radius_boundary'],
                                      data=np.concatenate((repeat(torch.from_numpy(np.arange(ped_positions.size(0))).unsqueeze(1),thetas_new_boundaries.size(0))[:, 0].unsqueeze(1),
@@ -95,10 +98,10 @@ def get_polar_grid_points(ped_positions, ped_directions, boundary_points, num_be
     # Convert back the polar coordinates of the chosen boundary points in cartesian coordinates
     ped_positions_repeated = repeat(ped_positions, num_beams)
     thetas_peds_repeated = repeat(thetas_peds, num_beams)
-    new_x_boundaries_chosen = torch.tensor(polar_grids_points['radius_boundary'].values).cuda().float() \
-                              * torch.cos(torch.tensor(polar_grids_points['theta_boundary'].values).cuda()).float()
-    new_y_boundaries_chosen = torch.tensor(polar_grids_points['radius_boundary'].values).cuda().float() \
-                              * torch.sin(torch.tensor(polar_grids_points['theta_boundary'].values).cuda()).float()
+    new_x_boundaries_chosen = torch.tensor(polar_grids_points['radius_boundary'].values).to(ped_positions.device).float() \
+                              * torch.cos(torch.tensor(polar_grids_points['theta_boundary'].values).to(ped_positions.device)).float()
+    new_y_boundaries_chosen = torch.tensor(polar_grids_points['radius_boundary'].values).to(ped_positions.device).float() \
+                              * torch.sin(torch.tensor(polar_grids_points['theta_boundary'].values).to(ped_positions.device)).float()
     x_boundaries_chosen = new_x_boundaries_chosen * torch.cos(thetas_peds_repeated[:, 0]) \
                           - new_y_boundaries_chosen * torch.sin(thetas_peds_repeated[:, 0]) + ped_positions_repeated[:,0]
     y_boundaries_chosen = new_x_boundaries_chosen * torch.sin(thetas_peds_repeated[:, 0]) \
@@ -119,7 +122,7 @@ def get_raycast_grid_points(ped_positions, boundary_points, num_rays, radius, re
     round_decimal_digit = 2
     ped_positions = ped_positions.detach()
 
-    ped_ids = torch.from_numpy(np.arange(ped_positions.size(0))).unsqueeze(1).cuda()
+    ped_ids = torch.from_numpy(np.arange(ped_positions.size(0))).unsqueeze(1).to(ped_positions.device)
     ped_ids_repeated = repeat(ped_ids, boundary_points.size(0))
     ped_positions_repeated = repeat(ped_positions, boundary_points.size(0))
     boundary_points_repeated = boundary_points.repeat(ped_positions.size(0), 1)
@@ -129,16 +132,17 @@ def get_raycast_grid_points(ped_positions, boundary_points, num_rays, radius, re
     radiuses_boundary_points = torch.norm(boundary_points_repeated_polar, dim=1)
     # I round the theta values otherwise I will never take the boundary points because they can have a difference in the last digits
     # (eg. 3.14159 is considered different from the possible ray angle of 3.14158). It would be difficult to find points that have the exact same angle of the rays.
-    thetas_boundary_points = torch.round( torch.atan2(boundary_points_repeated_polar[:, 1], boundary_points_repeated_polar[:, 0]) * torch.tensor( 10^round_decimal_digit ).float().cuda())\
-                             / torch.tensor( 10^round_decimal_digit ).float().cuda()
+    thetas_boundary_points = torch.round( torch.atan2(boundary_points_repeated_polar[:, 1], boundary_points_repeated_polar[:, 0]) * torch.tensor( 10^round_decimal_digit ).float().to(ped_positions.device))\
+                             / torch.tensor( 10^round_decimal_digit ).float().to(ped_positions.device)
 
     # Build Dataframe with [pedestrians_ids, thetas_boundaries, radiuses_boundaries]
+    import pandas as pd  # only the brute force grids need it, the lookup tables do not
     df = pd.DataFrame(columns=['ped_id', 'theta_boundary', 'radius_boundary'],
                       data=np.concatenate((ped_ids_repeated, thetas_boundary_points.view(-1, 1), radiuses_boundary_points.view(-1, 1)), axis=1))
 
     if not return_true_points:
         # Compute the angles of the rays and add "num_rays" points on these rays at a distance of "radius" so that there will be always "num_rays" points as output
-        rays_angles = torch.tensor(np.round( np.linspace(-np.pi, np.pi - ((2 * np.pi) / num_rays), num_rays), round_decimal_digit )).unsqueeze(1).cuda()
+        rays_angles = torch.tensor(np.round( np.linspace(-np.pi, np.pi - ((2 * np.pi) / num_rays), num_rays), round_decimal_digit )).unsqueeze(1).to(ped_positions.device)
         rays_angles_repeated = rays_angles.repeat(ped_positions.size(0), 1)
         # Add these points to the boundary points dataframe
         df_new_points = pd.DataFrame(columns=['ped_id', 'theta_boundary', 'radius_boundary'],
@@ -151,7 +155,7 @@ def get_raycast_grid_points(ped_positions, boundary_points, num_rays, radius, re
         df = df.loc[df['radius_boundary'] <= radius]
         # Create a new dataframe with "num_beams" points at a distance of 0 meter from the curr pedestrian position, so that afterwards
         # they will be output in the case in some beams there are no points in the range 0-"radius" meters
-        rays_angles = torch.tensor(np.round(np.linspace(-np.pi, np.pi - ((2 * np.pi) / num_rays), num_rays), round_decimal_digit)).unsqueeze(1).cuda()
+        rays_angles = torch.tensor(np.round(np.linspace(-np.pi, np.pi - ((2 * np.pi) / num_rays), num_rays), round_decimal_digit)).unsqueeze(1).to(ped_positions.device)
         rays_angles_repeated = rays_angles.repeat(ped_positions.size(0), 1)
         # Add these points to the boundary points dataframe
         df_new_points = pd.DataFrame(columns=['ped_id', 'theta_boundary', 'radius_boundary'],
@@ -173,11 +177,160 @@ def get_raycast_grid_points(ped_positions, boundary_points, num_rays, radius, re
 
     # Convert the chosen points from polar to cartesian coordinates
     ped_positions_repeated = repeat(ped_positions, num_rays)
-    x_boundaries_chosen = torch.tensor(polar_grids_points['radius_boundary'].values).cuda().float() \
-                              * torch.cos(torch.tensor(polar_grids_points['theta_boundary'].values).cuda()).float() + ped_positions_repeated[:, 0]
-    y_boundaries_chosen = torch.tensor(polar_grids_points['radius_boundary'].values).cuda().float() \
-                              * torch.sin(torch.tensor(polar_grids_points['theta_boundary'].values).cuda()).float() + ped_positions_repeated[:, 1]
+    x_boundaries_chosen = torch.tensor(polar_grids_points['radius_boundary'].values).to(ped_positions.device).float() \
+                              * torch.cos(torch.tensor(polar_grids_points['theta_boundary'].values).to(ped_positions.device)).float() + ped_positions_repeated[:, 0]
+    y_boundaries_chosen = torch.tensor(polar_grids_points['radius_boundary'].values).to(ped_positions.device).float() \
+                              * torch.sin(torch.tensor(polar_grids_points['theta_boundary'].values).to(ped_positions.device)).float() + ped_positions_repeated[:, 1]
     cartesian_grid_points = torch.stack((x_boundaries_chosen, y_boundaries_chosen)).transpose(0, 1)
 
     return cartesian_grid_points
 
+
+def get_beam_angles(num_beams, polar=False):
+    """
+    Angles of the beams used by the raycast (absolute, over 360 degrees) and by the polar grid (relative to the
+    pedestrian direction, over the 180 degrees in front of him/her)
+    """
+    if polar:
+        return np.linspace(-np.pi / 2 + (np.pi / num_beams) / 2, np.pi / 2 - (np.pi / num_beams) / 2, num_beams)
+    return np.linspace(-np.pi, np.pi - ((2 * np.pi) / num_beams), num_beams)
+
+
+def get_beam_lookup_table_name(pool_static_type, num_beams):
+    kind = 'polar' if 'polar' in pool_static_type else 'raycast'
+    return '{}_lookup_table_{}.npz'.format(kind, num_beams)
+
+
+def build_beam_lookup_table(boundary_points, num_beams, radius, polar=False, cell_size=0.25, num_headings=16,
+                            chunk_size=256):
+    """
+    Inputs:
+    - boundary_points: Numpy array of shape (num_points, 2) with the boundary points of a scene
+    - num_beams: Number of beams (rays or polar grid splits)
+    - radius: Maximum beam length
+    - polar: If True the beams are relative to the pedestrian direction, discretized in num_headings bins
+    - cell_size: Side of the cells in which the scene is discretized
+    Output:
+    - lookup table: dict with the distance of the closest boundary point along each beam, shape
+    (num_rows, num_cols, num_headings, num_beams), sampled at origin + (col, row) * cell_size and clipped to radius
+    """
+    if not polar:
+        num_headings = 1
+    origin = boundary_points.min(axis=0) - radius
+    num_cols = int(np.ceil((boundary_points.max(axis=0)[0] + radius - origin[0]) / cell_size)) + 1
+    num_rows = int(np.ceil((boundary_points.max(axis=0)[1] + radius - origin[1]) / cell_size)) + 1
+    xs = origin[0] + np.arange(num_cols) * cell_size
+    ys = origin[1] + np.arange(num_rows) * cell_size
+    cells = np.stack(np.meshgrid(xs, ys), axis=2).reshape(-1, 2)  # row major: (row, col)
+    headings = -np.pi + np.arange(num_headings) * (2 * np.pi / num_headings)
+
+    table = np.full((cells.shape[0], num_headings, num_beams), radius, dtype=np.float32)
+    for start in range(0, cells.shape[0], chunk_size):
+        curr_cells = cells[start:start + chunk_size]
+        rel_pos = boundary_points[np.newaxis, :, :] - curr_cells[:, np.newaxis, :]  # (cells, points, 2)
+        radiuses = np.linalg.norm(rel_pos, axis=2)
+        thetas = np.arctan2(rel_pos[:, :, 1], rel_pos[:, :, 0])
+        cell_ids = np.repeat(np.arange(curr_cells.shape[0])[:, np.newaxis], boundary_points.shape[0], axis=1)
+        curr_table = table[start:start + chunk_size]
+        for heading_index, heading in enumerate(headings):
+            if polar:
+                # Angle with respect to the pedestrian direction, the polar grid covers [-90, 90] degrees
+                relative_thetas = np.arctan2(np.sin(thetas - heading), np.cos(thetas - heading))
+                beams = np.floor((relative_thetas + np.pi / 2) / (np.pi / num_beams)).astype(np.int64)
+                valid = (beams >= 0) & (beams < num_beams)
+            else:
+                # Every point is assigned to the closest ray
+                beams = np.round((thetas + np.pi) / (2 * np.pi / num_beams)).astype(np.int64) % num_beams
+                valid = np.ones_like(beams, dtype=bool)
+            flat_index = cell_ids[valid] * num_beams + beams[valid]
+            curr_heading_table = curr_table[:, heading_index].reshape(-1)
+            np.minimum.at(curr_heading_table, flat_index, radiuses[valid].astype(np.float32))
+            curr_table[:, heading_index] = curr_heading_table.reshape(-1, num_beams)
+
+    return {
+        'table': table.reshape(num_rows, num_cols, num_headings, num_beams).astype(np.float16),
+        'origin': origin.astype(np.float32),
+        'cell_size': np.float32(cell_size),
+        'radius': np.float32(radius),
+        'angles': get_beam_angles(num_beams, polar).astype(np.float32),
+    }
+
+
+def load_beam_lookup_table(path, pool_static_type, num_beams, radius):
+    """ Load the lookup table generated by scripts/data_processing/generate_beam_lookup_tables.py, if present """
+    file_name = os.path.join(path, get_beam_lookup_table_name(pool_static_type, num_beams))
+    if not os.path.isfile(file_name):
+        return None
+    data = np.load(file_name)
+    if not np.isclose(data['radius'], radius):
+        print('Ignoring {}: built for radius {} instead of {}'.format(file_name, data['radius'], radius))
+        return None
+    return {
+        'table': torch.from_numpy(data['table']).to(get_device()),
+        'origin': torch.from_numpy(data['origin']).to(get_device()),
+        'cell_size': float(data['cell_size']),
+        'radius': float(data['radius']),
+        'angles': torch.from_numpy(data['angles']).to(get_device()),
+    }
+
+
+def lookup_beam_distances(lookup_table, ped_positions, ped_directions=None):
+    """
+    Inputs:
+    - lookup_table: Table returned by load_beam_lookup_table
+    - ped_positions: Tensor of shape (num_ped, 2)
+    - ped_directions: Tensor of shape (num_ped, 2), only for polar tables
+    Output:
+    - distances: Tensor of shape (num_ped, num_beams), bilinear interpolation of the four surrounding cells, and for
+    polar tables linear interpolation between the two headings around the pedestrian direction
+    """
+    table = lookup_table['table']
+    num_rows, num_cols, num_headings, _ = table.size()
+    cells = (ped_positions.detach() - lookup_table['origin']) / lookup_table['cell_size']
+    cells_x = cells[:, 0].clamp(0, num_cols - 1)
+    cells_y = cells[:, 1].clamp(0, num_rows - 1)
+    col = cells_x.floor().clamp(max=num_cols - 2).long()
+    row = cells_y.floor().clamp(max=num_rows - 2).long()
+    weight_x = (cells_x - col.type_as(cells_x)).unsqueeze(1)
+    weight_y = (cells_y - row.type_as(cells_y)).unsqueeze(1)
+
+    def interpolate_cells(heading):
+        top = (1 - weight_x) * table[row, col, heading].float() + weight_x * table[row, col + 1, heading].float()
+        bottom = (1 - weight_x) * table[row + 1, col, heading].float() + weight_x * table[row + 1, col + 1, heading].float()
+        return (1 - weight_y) * top + weight_y * bottom
+
+    if ped_directions is None or num_headings == 1:
+        return interpolate_cells(torch.zeros_like(col))
+
+    # The points are placed at the exact direction (see get_lookup_grid_points), so the distances are interpolated
+    # between the two closest headings, instead of read at the nearest one (up to half a heading bin away)
+    thetas_peds = torch.atan2(ped_directions[:, 1], ped_directions[:, 0]).detach()
+    headings = (thetas_peds + np.pi) / (2 * np.pi / num_headings)
+    heading = headings.floor()
+    weight_heading = (headings - heading).unsqueeze(1)
+    heading = heading.long() % num_headings
+    return (1 - weight_heading) * interpolate_cells(heading) + \
+        weight_heading * interpolate_cells((heading + 1) % num_headings)
+
+
+def get_lookup_grid_points(lookup_table, ped_positions, ped_directions=None, return_true_points=False):
+    """
+    Same output of get_raycast_grid_points / get_polar_grid_points (num_ped * num_beams points), read from the
+    precomputed lookup table instead of looking at all the boundary points of the scene. Each point lies on the
+    central angle of its beam.
+    """
+    ped_positions = ped_positions.detach()
+    distances = lookup_beam_distances(lookup_table, ped_positions, ped_directions)
+    if return_true_points:
+        # If there are no points in the range 0-"radius" meters, return the pedestrian position itself
+        distances = torch.where(distances < lookup_table['radius'], distances, torch.zeros_like(distances))
+
+    angles = lookup_table['angles'].unsqueeze(0)
+    if ped_directions is not None:
+        thetas_peds = torch.atan2(ped_directions[:, 1], ped_directions[:, 0]).detach().unsqueeze(1)
+        angles = angles + thetas_peds
+    x_boundaries_chosen = distances * torch.cos(angles) + ped_positions[:, 0].unsqueeze(1)
+    y_boundaries_chosen = distances * torch.sin(angles) + ped_positions[:, 1].unsqueeze(1)
+    cartesian_grid_points = torch.stack((x_boundaries_chosen, y_boundaries_chosen), dim=2).view(-1, 2)
+
+    return cartesian_grid_points
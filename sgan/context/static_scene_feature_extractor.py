@@ -3,13 +3,15 @@ import numpy as np
 #import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
-import torchvision.transforms as transforms
-from sgan.context.static_pooling_algorithms import make_mlp, get_polar_grid_points, get_raycast_grid_points, repeat
-from sgan.context.physical_attention import Attention_Encoder, Attention_Decoder
+from sgan.context.static_pooling_algorithms import make_mlp, get_polar_grid_points, get_raycast_grid_points, \
+    load_beam_lookup_table, get_lookup_grid_points
+from sgan.context.segment_reduction import segment_sum
+from sgan.context.physical_attention import Attention_Decoder
+from sgan.context.scene_feature_store import load_scene_features
 from sgan.model.folder_utils import get_dset_name, get_dset_group_name, get_root_dir
+from sgan.data.boundary_points import load_boundary_points
 from sgan.model.utils import get_device
 
-device = get_device()
 class StaticSceneFeatureExtractorRandom(nn.Module):
     def __init__(self, pool_static_type, down_samples, embedding_dim, h_dim, bottleneck_dim,
                  activation, batch_norm, dropout, mlp_dim, num_cells, neighborhood_size):
@@ -31,7 +33,7 @@ class StaticSceneFeatureExtractorRandom(nn.Module):
         mlp_pre_pool_dims = [embedding_dim + h_dim, self.mlp_dim * 8, bottleneck_dim]
         self.mlp_pre_pool = make_mlp(mlp_pre_pool_dims, activation=activation, batch_norm=batch_norm, dropout=dropout)
 
-    def set_dset_list(self, data_dir, down_sampling=True):
+    def set_dset_list(self, data_dir, down_sampling=True, boundary_tolerance=None):
         """ Fill scene_information with the static environment features that will be used as part of the input of Static
                  Scene Feature Extractor module in SafeGAN"""
         _dir = os.path.dirname(os.path.realpath(__file__))
@@ -46,29 +48,20 @@ class StaticSceneFeatureExtractorRandom(nn.Module):
             """ The inputs are the boundary points between the traversable and non-traversable areas. It is 
                 possible to take all points or just a sample"""
             path = os.path.join(path_group, name)
-            map = np.load(path + "/world_points_boundary.npy")
-            if self.down_samples != -1 and down_sampling and map.shape[0] > self.down_samples:
-                down_sampling = (map.shape[0] // self.down_samples)
-                sampled = map[::down_sampling]
-                map = sampled[:self.down_samples]
-            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(device)
-
-    def forward(self, scene_name, num_ped, curr_end_pos, curr_disp_pos, curr_hidden_1):
+            map = load_boundary_points(path, self.down_samples if down_sampling else -1, boundary_tolerance)
+            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(get_device())
+
+    def forward(self, scene_name, num_ped, curr_end_pos, curr_disp_pos, curr_hidden_1, topology=None):
         # scene_info will contain the boundary points between traversable and non-traversable
         scene_info = self.scene_information[scene_name]
         self.num_cells = scene_info.size(0)
 
-        # Repeat position -> P1, P1, P1, ....num_cells  P2, P2 #
-        curr_ped_pos_repeated = repeat(curr_end_pos, self.num_cells)
-        boundary_points_per_ped = scene_info.repeat(num_ped, 1)
-        curr_rel_pos = boundary_points_per_ped.view(-1, 2) - curr_ped_pos_repeated
-        # Cast the values outside the range [-self.neighborhood_size, self.neighborhood_size] to
-        # -self.neighborhood_size or self.neighborhood_size (the closest between the two)
-        curr_rel_pos = torch.clamp(curr_rel_pos, -self.neighborhood_size, self.neighborhood_size)
-
-        # Normalize by the neighborhood_size
-        curr_rel_pos = torch.div(curr_rel_pos, self.neighborhood_size)
-        curr_rel_embedding = self.spatial_embedding(curr_rel_pos.view(num_ped, self.num_cells * curr_rel_pos.size(1)))
+        # Boundary points relative to each pedestrian, [num_ped, num_cells, 2] through broadcasting
+        curr_rel_pos = scene_info.unsqueeze(0) - curr_end_pos.unsqueeze(1)
+        # Normalize by the neighborhood_size and cast the values outside the range [-1, 1] to -1 or 1 (the closest
+        # between the two), i.e. the points farther than neighborhood_size along an axis
+        curr_rel_pos = torch.clamp(curr_rel_pos / self.neighborhood_size, -1, 1)
+        curr_rel_embedding = self.spatial_embedding(curr_rel_pos.view(num_ped, -1))
 
         mlp_h_input = torch.cat([curr_rel_embedding, curr_hidden_1], dim=1)
         # Encode the output with an mlp
@@ -104,7 +97,7 @@ class StaticSceneFeatureExtractorGrid(nn.Module):
         mlp_pre_pool_dims = [embedding_dim + h_dim, self.mlp_dim * 8, bottleneck_dim]
         self.mlp_pre_pool = make_mlp(mlp_pre_pool_dims, activation=activation, batch_norm=batch_norm, dropout=dropout)
 
-    def set_dset_list(self, data_dir, down_sampling=True):
+    def set_dset_list(self, data_dir, down_sampling=True, boundary_tolerance=None):
         """ Fill scene_information with the static environment features that will be used as part of the input of Static
                  Scene Feature Extractor module in SafeGAN"""
 
@@ -117,12 +110,8 @@ class StaticSceneFeatureExtractorGrid(nn.Module):
             """ The inputs are the boundary points between the traversable and non-traversable areas. It is 
                 possible to take all points or just a sample"""
             path = os.path.join(path_group, name)
-            map = np.load(path + "/world_points_boundary.npy")
-            if self.down_samples != -1 and down_sampling and map.shape[0] > self.down_samples:
-                down_sampling = (map.shape[0] // self.down_samples)
-                sampled = map[::down_sampling]
-                map = sampled[:self.down_samples]
-            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(device)
+            map = load_boundary_points(path, self.down_samples if down_sampling else -1, boundary_tolerance)
+            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(get_device())
 
     def get_bounds(self, ped_pos):
         top_left_x = ped_pos[:, 0] - self.neighborhood_size / 2
@@ -135,28 +124,15 @@ class StaticSceneFeatureExtractorGrid(nn.Module):
 
     def get_grid_locations(self, top_left, other_pos):
         cell_x = torch.floor(
-            ((other_pos[:, 0] - top_left[:, 0]) / self.neighborhood_size) *
+            ((other_pos[..., 0] - top_left[..., 0]) / self.neighborhood_size) *
             self.grid_size)
         cell_y = torch.floor(
-            ((top_left[:, 1] - other_pos[:, 1]) / self.neighborhood_size) *
+            ((top_left[..., 1] - other_pos[..., 1]) / self.neighborhood_size) *
             self.grid_size)
         grid_pos = cell_x + cell_y * self.grid_size
         return grid_pos
 
-    def repeat(self, tensor, num_reps):
-        """
-        Inputs:
-        -tensor: 2D tensor of any shape
-        -num_reps: Number of times to repeat each row
-        Outpus:
-        -repeat_tensor: Repeat each row such that: R1, R1, R2, R2
-        """
-        col_len = tensor.size(1)
-        tensor = tensor.unsqueeze(dim=1).repeat(1, num_reps, 1)
-        tensor = tensor.view(-1, col_len)
-        return tensor
-
-    def forward(self, scene_name, num_ped, curr_end_pos, curr_disp_pos, curr_hidden_1):
+    def forward(self, scene_name, num_ped, curr_end_pos, curr_disp_pos, curr_hidden_1, topology=None):
         # scene_info will contain the boundary points between traversable and non-traversable
         scene_info = self.scene_information[scene_name]
         num_points = scene_info.size(0)
@@ -171,36 +147,21 @@ class StaticSceneFeatureExtractorGrid(nn.Module):
         # Used in attention
         embed_info = torch.cat([curr_end_pos, curr_disp_pos], dim=1)
 
-        # Repeat position -> P1, P2, P1, P2
-        scene_info_rep = scene_info.repeat(num_ped, 1)
-        # Repeat bounds -> B1, B1, B2, B2
-        top_left = self.repeat(top_left, num_points)
-        bottom_right = self.repeat(bottom_right, num_points)
-
-        grid_pos = self.get_grid_locations(
-            top_left, scene_info_rep).view(num_ped, num_points)
-        # Make all positions to exclude as non-zero
-        # Find which peds to exclude
-        x_bound = ((scene_info_rep[:, 0] >= bottom_right[:, 0]) +
-                   (scene_info_rep[:, 0] <= top_left[:, 0]))
-        y_bound = ((scene_info_rep[:, 1] >= top_left[:, 1]) +
-                   (scene_info_rep[:, 1] <= bottom_right[:, 1]))
-
-        within_bound = x_bound + y_bound
-        within_bound = within_bound.view(num_ped, num_points)
-
-        grid_pos += 1
-        offset = torch.arange(0, total_grid_size * num_ped, total_grid_size).to(device)
-        offset = self.repeat(offset.view(-1, 1), num_points).view(num_ped, num_points)
-        grid_pos += offset
-
-        grid_pos[within_bound != 0] = 0
-        occupancy = torch.ones(num_points * num_ped, 1).to(device)
-        grid_pos = grid_pos.view(-1, 1).type(torch.LongTensor).to(device)  # grid_pos = [num_ped*num_points, h_dim]
-        curr_grid = torch.zeros(((num_ped * total_grid_size + 1), 1)).to(device)
-        #if (grid_pos >= curr_grid.size(0)).any():
-         #   print('false')
-        curr_grid = curr_grid.scatter_add(0, grid_pos, occupancy)  # curr_hidden_repeat = [num_ped**2, h_dim]
+        # Bounds [num_ped, 1, 2] and points [1, num_points, 2], broadcast to [num_ped, num_points]
+        top_left = top_left.unsqueeze(1)
+        bottom_right = bottom_right.unsqueeze(1)
+        points = scene_info.unsqueeze(0)
+
+        grid_pos = self.get_grid_locations(top_left, points).long()
+        # Find which points to exclude
+        outside = (points[..., 0] >= bottom_right[..., 0]) | (points[..., 0] <= top_left[..., 0]) | \
+                  (points[..., 1] >= top_left[..., 1]) | (points[..., 1] <= bottom_right[..., 1])
+
+        # Offset everything by 1 and use the initial 0 position to dump the points outside the grids
+        offset = torch.arange(num_ped, device=grid_pos.device).unsqueeze(1) * total_grid_size
+        grid_pos = (grid_pos + offset + 1).masked_fill(outside, 0)
+        occupancy = curr_hidden.new_ones((num_ped * num_points, 1))
+        curr_grid = segment_sum(occupancy, grid_pos.view(-1), num_ped * total_grid_size + 1)
         curr_grid = curr_grid[1:]
         encoder_out = curr_grid.view(num_ped, total_grid_size, 1)
         curr_pool_h, attention_weights = self.attention_decoder(encoder_out=encoder_out, curr_hidden=curr_hidden, embed_info=embed_info)
@@ -250,14 +211,14 @@ class StaticSceneFeatureExtractorCNN(nn.Module):
                 nn.Conv1d(1, 1, kernel_size=(self.down_samples // self.embedding_dim, 2),
                           stride=self.down_samples // self.embedding_dim),
                 nn.LeakyReLU()
-            ).to(device)
+            ).to(get_device())
 
         elif self.pool_static_type == 'random_cnn_atrous':
             self.spatial_embedding = nn.Sequential(
                 nn.Conv1d(1, 1, kernel_size=(self.down_samples // self.embedding_dim, 2), stride=1,
                           dilation=(self.embedding_dim, 1)),
                 nn.LeakyReLU()
-            ).to(device)
+            ).to(get_device())
 
         else:
             print("Error in recognizing the cnn pool static type!")
@@ -266,7 +227,7 @@ class StaticSceneFeatureExtractorCNN(nn.Module):
         mlp_pre_pool_dims = [embedding_dim + h_dim, self.mlp_dim * 8, bottleneck_dim]
         self.mlp_pre_pool = make_mlp(mlp_pre_pool_dims, activation=activation, batch_norm=batch_norm, dropout=dropout)
 
-    def set_dset_list(self, data_dir, down_sampling=True):
+    def set_dset_list(self, data_dir, down_sampling=True, boundary_tolerance=None):
         """ Fill scene_information with the static environment features that will be used as part of the input of Static
                  Scene Feature Extractor module in SafeGAN"""
         _dir = os.path.dirname(os.path.realpath(__file__))
@@ -281,29 +242,20 @@ class StaticSceneFeatureExtractorCNN(nn.Module):
             """ The inputs are the boundary points between the traversable and non-traversable areas. It is 
                 possible to take all points or just a sample"""
             path = os.path.join(path_group, name)
-            map = np.load(path + "/world_points_boundary.npy")
-            if self.down_samples != -1 and down_sampling and map.shape[0] > self.down_samples:
-                down_sampling = (map.shape[0] // self.down_samples)
-                sampled = map[::down_sampling]
-                map = sampled[:self.down_samples]
-            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(device)
-
-    def forward(self, scene_name, num_ped, curr_end_pos, curr_disp_pos, curr_hidden_1):
+            map = load_boundary_points(path, self.down_samples if down_sampling else -1, boundary_tolerance)
+            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(get_device())
+
+    def forward(self, scene_name, num_ped, curr_end_pos, curr_disp_pos, curr_hidden_1, topology=None):
         # scene_info will contain the boundary points between traversable and non-traversable
         scene_info = self.scene_information[scene_name]
         self.num_cells = scene_info.size(0)
 
-        # Repeat position -> P1, P1, P1, ....num_cells  P2, P2 #
-        curr_ped_pos_repeated = repeat(curr_end_pos, self.num_cells)
-        boundary_points_per_ped = scene_info.repeat(num_ped, 1)
-        curr_rel_pos = boundary_points_per_ped.view(-1, 2) - curr_ped_pos_repeated
-        # Cast the values outside the range [-self.neighborhood_size, self.neighborhood_size] to
-        # -self.neighborhood_size or self.neighborhood_size (the closest between the two)
-        curr_rel_pos = torch.clamp(curr_rel_pos, -self.neighborhood_size, self.neighborhood_size)
-
-        # Normalize by the neighborhood_size
-        curr_rel_pos = torch.div(curr_rel_pos, self.neighborhood_size)
-        curr_rel_embedding = self.spatial_embedding(curr_rel_pos.view(num_ped, 1, -1, curr_rel_pos.size(1))).squeeze()
+        # Boundary points relative to each pedestrian, [num_ped, num_cells, 2] through broadcasting
+        curr_rel_pos = scene_info.unsqueeze(0) - curr_end_pos.unsqueeze(1)
+        # Normalize by the neighborhood_size and cast the values outside the range [-1, 1] to -1 or 1 (the closest
+        # between the two), i.e. the points farther than neighborhood_size along an axis
+        curr_rel_pos = torch.clamp(curr_rel_pos / self.neighborhood_size, -1, 1)
+        curr_rel_embedding = self.spatial_embedding(curr_rel_pos.unsqueeze(1)).squeeze()
         # Since it is not always possible to have kernel dimensions that produce exactly embedding_dim features
         # as convolution output (it depends on the number of annotated points), I have to select only the first embedding_dim ones
         curr_rel_embedding = curr_rel_embedding[:, :self.embedding_dim]
@@ -327,15 +279,18 @@ class StaticSceneFeatureExtractorRaycast(nn.Module):
         self.num_cells = num_cells
         self.neighborhood_size = neighborhood_size
         self.scene_information = {}
+        # Precomputed beam distances per scene, see scripts/data_processing/generate_beam_lookup_tables.py
+        self.scene_lookup = {}
 
         self.spatial_embedding = nn.Linear(2 * self.num_cells, embedding_dim)
 
         mlp_pre_pool_dims = [embedding_dim + h_dim, self.mlp_dim * 8, bottleneck_dim]
         self.mlp_pre_pool = make_mlp(mlp_pre_pool_dims, activation=activation, batch_norm=batch_norm, dropout=dropout)
 
-    def set_dset_list(self, data_dir, down_sampling=True):
+    def set_dset_list(self, data_dir, down_sampling=True, boundary_tolerance=None):
         """ Fill scene_information with the static environment features that will be used as part of the input of Static
-                 Scene Feature Extractor module in SafeGAN"""
+                 Scene Feature Extractor module in SafeGAN. With boundary_tolerance (meters) the boundary points come from
+                 the precomputed levels (see load_boundary_points)"""
         _dir = os.path.dirname(os.path.realpath(__file__))
         _dir = _dir.split("/")[:-2]
         _dir = "/".join(_dir)
@@ -348,26 +303,27 @@ class StaticSceneFeatureExtractorRaycast(nn.Module):
             """ The inputs are the boundary points between the traversable and non-traversable areas. It is 
                 possible to take all points or just a sample"""
             path = os.path.join(path_group, name)
-            map = np.load(path + "/world_points_boundary.npy")
-            if self.down_samples != -1 and down_sampling and map.shape[0] > self.down_samples:
-                down_sampling = (map.shape[0] // self.down_samples)
-                sampled = map[::down_sampling]
-                map = sampled[:self.down_samples]
-            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(device)
-
-    def forward(self, scene_name, num_ped, curr_end_pos, curr_disp_pos, curr_hidden_1):
+            map = load_boundary_points(path, self.down_samples if down_sampling else -1, boundary_tolerance)
+            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(get_device())
+            self.scene_lookup[name] = load_beam_lookup_table(path, self.pool_static_type, self.num_cells, self.neighborhood_size)
+
+    def forward(self, scene_name, num_ped, curr_end_pos, curr_disp_pos, curr_hidden_1, topology=None):
         # scene_info will contain the boundary points between traversable and non-traversable
         scene_info = self.scene_information[scene_name]
 
-        # Repeat position -> P1, P1, P1, ....num_cells  P2, P2 #
-        curr_ped_pos_repeated = repeat(curr_end_pos, self.num_cells)
-        boundary_points_per_ped = get_raycast_grid_points(curr_end_pos, scene_info, self.num_cells,
-                                                              self.neighborhood_size, return_true_points=(self.pool_static_type == "raycast_true_points"))
-        curr_rel_pos = boundary_points_per_ped.view(-1, 2) - curr_ped_pos_repeated
+        return_true_points = (self.pool_static_type == "raycast_true_points")
+        if self.scene_lookup.get(scene_name) is not None:
+            boundary_points_per_ped = get_lookup_grid_points(self.scene_lookup[scene_name], curr_end_pos,
+                                                             return_true_points=return_true_points)
+        else:
+            boundary_points_per_ped = get_raycast_grid_points(curr_end_pos, scene_info, self.num_cells,
+                                                              self.neighborhood_size, return_true_points=return_true_points)
+        # Beam points relative to each pedestrian, [num_ped, num_cells, 2] through broadcasting
+        curr_rel_pos = boundary_points_per_ped.view(num_ped, self.num_cells, 2) - curr_end_pos.unsqueeze(1)
 
         # Normalize by the neighborhood_size
-        curr_rel_pos = torch.div(curr_rel_pos, self.neighborhood_size)
-        curr_rel_embedding = self.spatial_embedding(curr_rel_pos.view(num_ped, self.num_cells * curr_rel_pos.size(1)))
+        curr_rel_pos = curr_rel_pos / self.neighborhood_size
+        curr_rel_embedding = self.spatial_embedding(curr_rel_pos.view(num_ped, -1))
 
         mlp_h_input = torch.cat([curr_rel_embedding, curr_hidden_1], dim=1)
         # Encode the output with an mlp
@@ -388,15 +344,18 @@ class StaticSceneFeatureExtractorPolar(nn.Module):
         self.num_cells = num_cells
         self.neighborhood_size = neighborhood_size
         self.scene_information = {}
+        # Precomputed beam distances per scene, see scripts/data_processing/generate_beam_lookup_tables.py
+        self.scene_lookup = {}
 
         self.spatial_embedding = nn.Linear(2 * self.num_cells, embedding_dim)
 
         mlp_pre_pool_dims = [embedding_dim + h_dim, self.mlp_dim * 8, bottleneck_dim]
         self.mlp_pre_pool = make_mlp(mlp_pre_pool_dims, activation=activation, batch_norm=batch_norm, dropout=dropout)
 
-    def set_dset_list(self, data_dir, down_sampling=True):
+    def set_dset_list(self, data_dir, down_sampling=True, boundary_tolerance=None):
         """ Fill scene_information with the static environment features that will be used as part of the input of Static
-                 Scene Feature Extractor module in SafeGAN"""
+                 Scene Feature Extractor module in SafeGAN. With boundary_tolerance (meters) the boundary points come from
+                 the precomputed levels (see load_boundary_points)"""
         _dir = os.path.dirname(os.path.realpath(__file__))
         _dir = _dir.split("/")[:-2]
         _dir = "/".join(_dir)
@@ -409,26 +368,27 @@ class StaticSceneFeatureExtractorPolar(nn.Module):
             """ The inputs are the boundary points between the traversable and non-traversable areas. It is 
                 possible to take all points or just a sample"""
             path = os.path.join(path_group, name)
-            map = np.load(path + "/world_points_boundary.npy")
-            if self.down_samples != -1 and down_sampling and map.shape[0] > self.down_samples:
-                down_sampling = (map.shape[0] // self.down_samples)
-                sampled = map[::down_sampling]
-                map = sampled[:self.down_samples]
-            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(device)
-
-    def forward(self, scene_name, num_ped, curr_end_pos, curr_disp_pos, curr_hidden_1):
+            map = load_boundary_points(path, self.down_samples if down_sampling else -1, boundary_tolerance)
+            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(get_device())
+            self.scene_lookup[name] = load_beam_lookup_table(path, self.pool_static_type, self.num_cells, self.neighborhood_size)
+
+    def forward(self, scene_name, num_ped, curr_end_pos, curr_disp_pos, curr_hidden_1, topology=None):
         # scene_info will contain the boundary points between traversable and non-traversable
         scene_info = self.scene_information[scene_name]
 
-        # Repeat position -> P1, P1, P1, ....num_cells  P2, P2 #
-        curr_ped_pos_repeated = repeat(curr_end_pos, self.num_cells)
-        boundary_points_per_ped = get_polar_grid_points(curr_end_pos, curr_disp_pos, scene_info, self.num_cells,
-                                                        self.neighborhood_size, return_true_points=(self.pool_static_type == "polar_true_points"))
-        curr_rel_pos = boundary_points_per_ped.view(-1, 2) - curr_ped_pos_repeated
+        return_true_points = (self.pool_static_type == "polar_true_points")
+        if self.scene_lookup.get(scene_name) is not None:
+            boundary_points_per_ped = get_lookup_grid_points(self.scene_lookup[scene_name], curr_end_pos, curr_disp_pos,
+                                                             return_true_points=return_true_points)
+        else:
+            boundary_points_per_ped = get_polar_grid_points(curr_end_pos, curr_disp_pos, scene_info, self.num_cells,
+                                                            self.neighborhood_size, return_true_points=return_true_points)
+        # Beam points relative to each pedestrian, [num_ped, num_cells, 2] through broadcasting
+        curr_rel_pos = boundary_points_per_ped.view(num_ped, self.num_cells, 2) - curr_end_pos.unsqueeze(1)
 
         # Normalize by the neighborhood_size
-        curr_rel_pos = torch.div(curr_rel_pos, self.neighborhood_size)
-        curr_rel_embedding = self.spatial_embedding(curr_rel_pos.view(num_ped, self.num_cells * curr_rel_pos.size(1)))
+        curr_rel_pos = curr_rel_pos / self.neighborhood_size
+        curr_rel_embedding = self.spatial_embedding(curr_rel_pos.view(num_ped, -1))
 
         mlp_h_input = torch.cat([curr_rel_embedding, curr_hidden_1], dim=1)
         # Encode the output with an mlp
@@ -451,16 +411,16 @@ class StaticSceneFeatureExtractorAttention(nn.Module):
         self.scene_information = {}
 
         if self.pool_static_type == 'physical_attention_with_encoder':
-            # Pixel values must be in the range [0,1] and we must then normalize the image by the mean and standard deviation
-            # of the ImageNet images' RGB channels (the resnet has been pretrained on ImageNet).
-            normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-            self.transform = transforms.Compose([normalize])
+            # The scene images are encoded offline by a ResNet (see scripts/data_processing/build_scene_features.py),
+            # here only the features are loaded, the first time a scene is used
             self.encoder_dim = 2048
             self.encoded_image_size = 14
+            self.scene_paths = {}
 
-            self.attention_encoder = Attention_Encoder(self.encoded_image_size)    # encoder to prepare the input for the attention module
             self.attention_decoder = Attention_Decoder(
                 attention_dim=bottleneck_dim, embed_dim=4, decoder_dim=h_dim, encoder_dim=self.encoder_dim)
+            # Old checkpoints contain the weights of the pretrained ResNet, which is not part of the model anymore
+            self._register_load_state_dict_pre_hook(self._drop_attention_encoder_weights)
 
         elif self.pool_static_type == 'physical_attention_no_encoder':
             self.encoder_dim = 5
@@ -472,9 +432,9 @@ class StaticSceneFeatureExtractorAttention(nn.Module):
             exit()
 
 
-    def set_dset_list(self, data_dir):
+    def set_dset_list(self, data_dir, boundary_tolerance=None):
         """ Fill scene_information with the static environment features that will be used as part of the input of Static
-                 Scene Feature Extractor module in SafeGAN"""
+                 Scene Feature Extractor module in SafeGAN. The scenes are images, boundary_tolerance is not used"""
         directory = get_root_dir() + '/datasets/safegan_dataset/'
 
         self.list_data_files = sorted([get_dset_name(os.path.join(data_dir, _path).split("/")[-1]) for _path in os.listdir(data_dir)])
@@ -486,33 +446,53 @@ class StaticSceneFeatureExtractorAttention(nn.Module):
                 I created. The features are taken before the last upsample layers."""
                 path = os.path.join(path_group + "/segmented_features", name)
                 features = np.load(path + "_segmentation_features.npy")
-                features = torch.from_numpy(features).type(torch.float).to(device)
+                features = torch.from_numpy(features).type(torch.float).to(get_device())
 
             elif self.pool_static_type == "physical_attention_with_encoder":
                 """ In this case the input is the raw image or the segmented one (by one of the Segmentation Networks I trained 
-                on the new dataset I created). This image is then encoded by a Deep Network like ResNet"""
-                path = os.path.join(path_group + "/segmented_scenes", name)
-                image = plt.imread(path + ".jpg")
-                image = torch.from_numpy(image).type(torch.float).to(device)
-                # Images fed to the model must be a Float tensor of dimension N, 3, 256, 256, where N is the batch size.
-                # PyTorch follows the NCHW convention, which means the channels dimension (C) must precede the size dimensions
-                image = image.permute(2, 0, 1)
-                # Normalize the image
-                image = self.transform(image)
-                features = self.attention_encoder(image.unsqueeze(0))
+                on the new dataset I created), encoded by a Deep Network like ResNet. The features are loaded lazily"""
+                self.scene_paths[name] = path_group
+                continue
 
             else:
                 print("ERROR in recognizing physical attention pool static type")
                 exit()
             self.scene_information[name] = features
 
-    def forward(self, scene_name, num_ped, curr_end_pos, curr_disp_pos, curr_hidden_1):
+    @staticmethod
+    def _drop_attention_encoder_weights(state_dict, prefix, *args):
+        for key in [key for key in state_dict if key.startswith(prefix + 'attention_encoder.')]:
+            del state_dict[key]
+
+    def get_scene_information(self, scene_name):
+        if scene_name not in self.scene_information:
+            path_group = self.scene_paths[scene_name]
+            features = load_scene_features(path_group, scene_name)
+            if features is None:
+                print("The features of scene {} are not in the feature store! Build them with "
+                      "scripts/data_processing/build_scene_features.py".format(scene_name))
+                exit()
+            # The memory-mapped store is wrapped without copy, it is only read when moved to the device (or used)
+            self.scene_information[scene_name] = torch.from_numpy(features).type(torch.float).unsqueeze(0).to(get_device())
+        return self.scene_information[scene_name]
+
+    def forward(self, scene_name, num_ped, curr_end_pos, curr_disp_pos, curr_hidden_1, topology=None):
         # If it used attention module, scene_info will contain the scene images (or segmented features), otherwise it will contain the boundary points
-        scene_info = self.scene_information[scene_name]
+        scene_info = self.get_scene_information(scene_name)
 
-        encoder_out = scene_info.repeat(num_ped, 1, 1, 1)
-        # Flatten image
-        encoder_out = encoder_out.view(num_ped, -1, self.encoder_dim)  # (batch_size, num_pixels, encoder_dim)
+        # Flatten image, shared by all the pedestrians of the scene
+        encoder_out = scene_info.view(1, -1, self.encoder_dim)  # (1, num_pixels, encoder_dim)
         curr_pool_h, attention_weights = self.attention_decoder(encoder_out, curr_hidden_1,
-                                                                torch.cat([curr_end_pos, curr_disp_pos], dim=1))
+                                                                torch.cat([curr_end_pos, curr_disp_pos], dim=1),
+                                                                self.get_image_features(scene_name, encoder_out, topology))
         return curr_pool_h
+
+    def get_image_features(self, scene_name, encoder_out, topology=None):
+        """ Projection of the scene features by the attention network, computed once per scene for the whole batch (all
+        the decoder steps) when the BatchTopology of the batch is given """
+        if topology is None:
+            return self.attention_decoder.attention.encoder_att(encoder_out)
+        key = (id(self), scene_name, torch.is_grad_enabled())
+        if key not in topology.cache:
+            topology.cache[key] = self.attention_decoder.attention.encoder_att(encoder_out)
+        return topology.cache[key]
@@ -0,0 +1,106 @@
+""" Boundary points between traversable and non-traversable areas, at several resolutions """
+
+import os
+import numpy as np
+
+BOUNDARY_POINTS_FILE = 'world_points_boundary.npy'
+BOUNDARY_LEVELS_FILE = 'world_points_boundary_levels.npz'
+DEFAULT_LEVELS = (64, 200, 1000)
+
+
+def voxel_down_sample(points, voxel_size):
+    """ Keep one point (the first one) per square voxel of side voxel_size """
+    voxels = np.floor((points - points.min(axis=0)) / voxel_size).astype(np.int64)
+    _, indices = np.unique(voxels, axis=0, return_index=True)
+    return points[np.sort(indices)]
+
+
+def farthest_point_sampling(points, num_samples):
+    """
+    Greedy Poisson-disk sampling: every new point is the one farthest from the points already chosen, so the
+    samples are spread uniformly over the walls independently of how dense the original points are.
+    Outputs:
+    - indices of the num_samples chosen points
+    - coverage: maximum distance of a point from its closest sample
+    """
+    indices = np.zeros(num_samples, dtype=np.int64)
+    # Start from the point closest to the centroid, so that the result does not depend on the scan order
+    indices[0] = np.argmin(np.linalg.norm(points - points.mean(axis=0), axis=1))
+    min_distances = np.linalg.norm(points - points[indices[0]], axis=1)
+    for i in range(1, num_samples):
+        indices[i] = np.argmax(min_distances)
+        min_distances = np.minimum(min_distances, np.linalg.norm(points - points[indices[i]], axis=1))
+    return indices, min_distances.max()
+
+
+def build_boundary_levels(points, levels=DEFAULT_LEVELS, voxel_size=0.05):
+    """
+    Output: dict with, for each level n smaller than the number of points, 'points_n' (n, 2) and 'coverage_n', and
+    the full set of points with 'coverage_full' = 0
+    """
+    voxelized = voxel_down_sample(points, voxel_size)
+    voxel_error = voxel_size * np.sqrt(2)
+
+    boundary_levels = {'points_full': points, 'coverage_full': np.float32(0)}
+    for level in sorted(levels):
+        if level >= voxelized.shape[0]:
+            continue
+        indices, coverage = farthest_point_sampling(voxelized, level)
+        boundary_levels['points_{}'.format(level)] = voxelized[indices]
+        boundary_levels['coverage_{}'.format(level)] = np.float32(coverage + voxel_error)
+    return boundary_levels
+
+
+def get_levels(boundary_levels):
+    """ Available levels, from the cheapest to the full set of points, with their coverage """
+    levels = sorted(int(key[len('points_'):]) for key in boundary_levels.keys()
+                    if key.startswith('points_') and key != 'points_full')
+    return [(level, float(boundary_levels['coverage_{}'.format(level)])) for level in levels] + [('full', 0.0)]
+
+
+def select_boundary_level(boundary_levels, tolerance):
+    """ Cheapest level whose points are at most tolerance meters from every boundary point """
+    for level, coverage in get_levels(boundary_levels):
+        if coverage <= tolerance:
+            return boundary_levels['points_{}'.format(level)]
+    return boundary_levels['points_full']
+
+
+def load_boundary_points(path, down_samples=-1, tolerance=None):
+    """
+    Inputs:
+    - path: folder of the scene
+    - down_samples: if != -1, exact number of points to return (when the scene has more points)
+    - tolerance: None to take the stored points, one every k of them when down-sampled. Else the precomputed levels are
+    used: the level of down_samples points (spread uniformly over the walls), or without down-sampling the cheapest
+    level covering all the boundary within tolerance meters
+    Output:
+    - boundary points, numpy array of shape (num_points, 2)
+    """
+    if tolerance is None:
+        map = np.load(os.path.join(path, BOUNDARY_POINTS_FILE))
+        if down_samples != -1 and map.shape[0] > down_samples:
+            down_sampling = (map.shape[0] // down_samples)
+            sampled = map[::down_sampling]
+            return sampled[:down_samples]
+        return map
+
+    levels_file = os.path.join(path, BOUNDARY_LEVELS_FILE)
+    if not os.path.isfile(levels_file):
+        print("No boundary levels in {}! Generate them with scripts/data_processing/generate_boundary_levels.py".format(path))
+        exit()
+    boundary_levels = np.load(levels_file)
+    if down_samples == -1 or boundary_levels['points_full'].shape[0] <= down_samples:
+        return select_boundary_level(boundary_levels, tolerance)
+
+    # The number of points is fixed by the model (e.g. its spatial embedding)
+    level = 'points_{}'.format(down_samples)
+    if level not in boundary_levels.keys():
+        print("No level of {} boundary points in {}! Generate it with scripts/data_processing/generate_boundary_levels.py "
+              "--levels".format(down_samples, path))
+        exit()
+    coverage = float(boundary_levels['coverage_{}'.format(down_samples)])
+    if coverage > tolerance:
+        print("The {} boundary points of {} cover the boundary within {:.3f} m, more than the tolerance of {} m".format(
+            down_samples, path, coverage, tolerance))
+    return boundary_levels[level]
@@ -6,9 +6,10 @@ import numpy as np
 from sgan.model.encoder import Encoder
 from sgan.model.mlp import make_mlp
 from sgan.model.folder_utils import get_root_dir, get_dset_name, get_dset_group_name
+from sgan.data.boundary_points import load_boundary_points
 from sgan.model.models import get_noise
+from sgan.model.utils import get_device
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 class TrajectoryCritic(nn.Module):
     def __init__(
@@ -57,7 +58,14 @@ class TrajectoryCritic(nn.Module):
                 batch_norm=batch_norm,
                 dropout=dropout)
 
-    def set_dset_list(self, data_dir, down_sampling=True, down_samples=200):
+    def train(self, mode=True):
+        # The pooling modules are held by the CompositePooling, not as submodules: they follow the mode of the model
+        super(TrajectoryCritic, self).train(mode)
+        if self.pooling is not None:
+            self.pooling.train(mode)
+        return self
+
+    def set_dset_list(self, data_dir, down_sampling=True, down_samples=200, boundary_tolerance=None):
         directory = get_root_dir() + '/datasets/safegan_dataset/'
 
         self.list_data_files = sorted([get_dset_name(os.path.join(data_dir, _path).split("/")[-1]) for _path in os.listdir(data_dir)])
@@ -67,19 +75,16 @@ class TrajectoryCritic(nn.Module):
             """ The inputs are the boundary points between the traversable and non-traversable areas. It is 
                 possible to take all points or just a sample"""
             path = os.path.join(path_group, name)
-            map = np.load(path + "/world_points_boundary.npy")
-            if down_samples != -1 and down_sampling and map.shape[0] > down_samples:
-                down_sampling = (map.shape[0] // down_samples)
-                sampled = map[::down_sampling]
-                map = sampled[:down_samples]
-            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(device)
+            map = load_boundary_points(path, down_samples if down_sampling else -1, boundary_tolerance)
+            self.scene_information[name] = torch.from_numpy(map).type(torch.float).to(get_device())
 
-    def forward(self, traj, traj_rel, seq_start_end=None, seq_scene_ids=None):
+    def forward(self, traj, traj_rel, seq_start_end=None, seq_scene_ids=None, topology=None):
         """
         Inputs:discriminator
         - traj: Tensor of shape (obs_len + pred_len, batch, 2)
         - traj_rel: Tensor of shape (obs_len + pred_len, batch, 2)
         - seq_start_end: A list of tuples which delimit sequences within batch
+        - topology: BatchTopology of the batch, built from seq_start_end if not given
         Output:
         - scores: Tensor of shape (batch,) with real/fake scores
         """
@@ -88,6 +93,6 @@ class TrajectoryCritic(nn.Module):
         # end_pos. The intution being that hidden state has the whole
         # trajectory and relative postion at the start when combined with
         # trajectory information should help in discriminative behavior.
-        classifier_input = self.pooling.aggregate_context(final_h, seq_start_end, traj[-1], traj_rel[-1], seq_scene_ids)
+        classifier_input = self.pooling.aggregate_context(final_h, seq_start_end, traj[-1], traj_rel[-1], seq_scene_ids, topology)
         scores = self.real_classifier(classifier_input)
         return scores
@@ -6,7 +6,6 @@ from sgan.model.mlp import make_mlp
 from sgan.context.dynamic_pooling import PoolHiddenNet, SocialPoolingAttention
 from sgan.model.utils import get_device
 
-device = get_device()
 
 class TrajectoryDiscriminator(nn.Module):
     def __init__(
@@ -39,7 +38,7 @@ class TrajectoryDiscriminator(nn.Module):
             dropout=dropout
         )
 
-    def forward(self, traj, traj_rel, seq_start_end=None, seq_scene_ids=None):
+    def forward(self, traj, traj_rel, seq_start_end=None, seq_scene_ids=None, topology=None):
         """
         Inputs:discriminator
         - traj: Tensor of shape (obs_len + pred_len, batch, 2)
@@ -12,9 +12,9 @@ class TrajectoryGeneratorEvaluator():
         self.weights.append(weight)
         self.module_count += 1
 
-    def get_loss(self, traj, traj_rel, seq_start_end, seq_scene_ids):
+    def get_loss(self, traj, traj_rel, seq_start_end, seq_scene_ids, topology=None):
         loss = 0 
         for i in range(self.module_count):
-           out = self.modules[i].forward(traj, traj_rel, seq_start_end, seq_scene_ids)
+           out = self.modules[i].forward(traj, traj_rel, seq_start_end, seq_scene_ids, topology=topology)
            loss += self.weights[i]*self.functions[i](out)
         return loss
@@ -0,0 +1,39 @@
+import torch
+
+
+def compile_module_method(module, name, mode):
+    """
+    Replaces module.<name> by its compiled version, as an instance attribute: the parameters and the state_dict keys
+    of the module are unchanged, so that the checkpoints are still saved and loaded as before
+    """
+    setattr(module, name, torch.compile(getattr(module, name), mode=mode))
+
+
+def compile_generator(generator, mode='default'):
+    """
+    Compiles the tensor-only parts of a TrajectoryGenerator for inference: the encoder, the context mlp and the
+    decoder, that is the whole rollout when the decoder does not pool, or else one region per step (the mlp of the last
+    context fused with the LSTM step and the output projection), the pooling modules (which index the batch by
+    sequence and scene) running eagerly in between. The predictions are the same as the eager ones; no latency gain has
+    been measured so far, run scripts/evaluation/benchmark_compiled_generator.py on the target model and hardware
+    before using it for speed
+    Inputs:
+    - generator: TrajectoryGenerator, in eval mode
+    - mode: torch.compile mode, e.g. 'default', 'reduce-overhead' (CUDA graphs) or 'max-autotune'
+    Output:
+    - the same generator
+    """
+    if not hasattr(torch, 'compile'):
+        print("torch.compile needs PyTorch 2.0 or newer, the generator runs eagerly")
+        return generator
+
+    compile_module_method(generator.encoder, 'forward', mode)
+    if generator.mlp_decoder_needed():
+        compile_module_method(generator, 'decoder_context', mode)
+
+    decoder = generator.decoder
+    if decoder.pool_every_timestep:
+        compile_module_method(decoder, 'pooled_step', mode)
+    else:
+        compile_module_method(decoder, 'rollout', mode)
+    return generator
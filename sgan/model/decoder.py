@@ -2,9 +2,9 @@ import torch
 import torch.nn as nn
 
 from sgan.model.mlp import make_mlp
+from sgan.context.batch_topology import get_topology
 from sgan.model.utils import get_device
 
-device = get_device()
 
 class Decoder(nn.Module):
     """Decoder is part of TrajectoryGenerator"""
@@ -12,7 +12,8 @@ class Decoder(nn.Module):
         self, seq_len, embedding_dim=64, h_dim=128, mlp_dim=1024, num_layers=1,
         pool_every_timestep=True, dropout=0.0, 
         activation='relu', batch_norm=True, 
-        pool_static_type='None', pooling=None, pooling_output_dim=64
+        pool_static_type='None', pooling=None, pooling_output_dim=64,
+        pool_every_k=1, pool_steps=None, pool_motion_threshold=0.0
     ):
         super(Decoder, self).__init__()
 
@@ -20,18 +21,31 @@ class Decoder(nn.Module):
         self.mlp_dim = mlp_dim
         self.h_dim = h_dim
         self.embedding_dim = embedding_dim
+        self.num_layers = num_layers
 
         # pooling options
         if pool_static_type and pool_static_type.lower() == 'none':
             pool_static_type = None
         self.pool_static_type = pool_static_type
         self.pool_every_timestep = pool_every_timestep
+        # Pooling schedule, when pool_every_timestep: at the given steps (0 to seq_len - 1) if pool_steps is given, else
+        # when a pedestrian moved more than pool_motion_threshold (m) since the last pooling if it is > 0, else every
+        # pool_every_k steps. In between, the pooling modules are skipped: their outputs of the last pooling are reused,
+        # with the current hidden state
+        self.pool_every_k = max(int(pool_every_k), 1)
+        self.pool_steps = set(pool_steps) if pool_steps else None
+        self.pool_motion_threshold = pool_motion_threshold
         self.pooling = pooling
         self.pooling_output_dim=pooling_output_dim
 
-        self.decoder = nn.LSTM(
-            embedding_dim, h_dim, num_layers, dropout=dropout
-        )
+        # One LSTMCell per layer, stepped explicitly: same weights and gates as nn.LSTM(embedding_dim, h_dim, num_layers)
+        self.decoder = nn.ModuleList([
+            nn.LSTMCell(embedding_dim if layer == 0 else h_dim, h_dim) for layer in range(num_layers)
+        ])
+        # Dropout on the outputs of all the layers but the last, as in nn.LSTM
+        self.layer_dropout = nn.Dropout(dropout)
+        # Checkpoints saved with the nn.LSTM decoder
+        self._register_load_state_dict_pre_hook(self._map_lstm_weights)
         
         if pool_every_timestep:
             mlp_dims = [self.pooling_output_dim, mlp_dim, h_dim]
@@ -41,43 +55,167 @@ class Decoder(nn.Module):
                 batch_norm=batch_norm,
                 dropout=dropout)
 
-        self.spatial_embedding = nn.Linear(2, embedding_dim).to(device)
+        self.spatial_embedding = nn.Linear(2, embedding_dim).to(get_device())
         self.hidden2pos = nn.Linear(h_dim, 2)
 
 
-    def forward(self, last_pos, last_pos_rel, state_tuple, seq_start_end, seq_scene_ids=None):
+    @staticmethod
+    def _map_lstm_weights(state_dict, prefix, *args):
+        """ nn.LSTM weights (decoder.weight_ih_l0, ...) -> LSTMCell weights of the same layer (decoder.0.weight_ih, ...) """
+        lstm_prefix = prefix + 'decoder.'
+        for key in [key for key in state_dict if key.startswith(lstm_prefix) and '_l' in key[len(lstm_prefix):]]:
+            name, layer = key[len(lstm_prefix):].rsplit('_l', 1)
+            state_dict['{}{}.{}'.format(lstm_prefix, layer, name)] = state_dict.pop(key)
+
+    def train(self, mode=True):
+        # The pooling modules are held by the CompositePooling, not as submodules: they follow the mode of the model
+        super(Decoder, self).train(mode)
+        if self.pooling is not None:
+            self.pooling.train(mode)
+        return self
+
+    def embed(self, rel_pos):
+        """ rel_pos: Tensor of shape (batch, 2) -> decoder input of shape (batch, embedding_dim) """
+        return self.spatial_embedding(rel_pos)
+
+    def get_output_projection(self):
+        """
+        hidden2pos and spatial_embedding fused into a single linear map of the decoder output, which gives in one matmul
+        the relative position ([:, :2]) and the embedding of the next input ([:, 2:]). It is built from the parameters at
+        every forward, so that the gradient still reaches both layers
+        Output:
+        - weight: Tensor of shape (2 + embedding_dim, h_dim)
+        - bias: Tensor of shape (2 + embedding_dim,)
+        """
+        weight_pos, bias_pos = self.hidden2pos.weight, self.hidden2pos.bias
+        weight_embedding = self.spatial_embedding.weight.mm(weight_pos)
+        bias_embedding = self.spatial_embedding(bias_pos)
+        return torch.cat([weight_pos, weight_embedding], dim=0), torch.cat([bias_pos, bias_embedding], dim=0)
+
+    def step(self, decoder_input, state_tuple, last_pos, projection):
+        """
+        One decoder step without the pooling, made of tensor ops on fixed-size tensors only (no host sync), so that it
+        can be compiled
+        Inputs:
+        - decoder_input: Tensor of shape (batch, embedding_dim)
+        - state_tuple: (hh, ch) each tensor of shape (num_layers, batch, h_dim)
+        - last_pos: Tensor of shape (batch, 2)
+        - projection: (weight, bias) of get_output_projection
+        Output:
+        - rel_pos, curr_pos: Tensors of shape (batch, 2)
+        - next_input: Tensor of shape (batch, embedding_dim), the embedding of rel_pos
+        - state_tuple: the new (hh, ch)
+        """
+        hh, ch = state_tuple
+        output = decoder_input
+        if self.num_layers == 1:
+            output, c = self.decoder[0](output, (hh[0], ch[0]))
+            state_tuple = (output.unsqueeze(0), c.unsqueeze(0))
+        else:
+            next_hh, next_ch = [], []
+            for layer, cell in enumerate(self.decoder):
+                if layer > 0:
+                    output = self.layer_dropout(output)
+                output, c = cell(output, (hh[layer], ch[layer]))
+                next_hh.append(output)
+                next_ch.append(c)
+            state_tuple = (torch.stack(next_hh, dim=0), torch.stack(next_ch, dim=0))
+
+        weight, bias = projection
+        projected = torch.addmm(bias, output, weight.t())
+        rel_pos = projected[:, :2]
+        return rel_pos, rel_pos + last_pos, projected[:, 2:], state_tuple
+
+    def pooled_step(self, context_information, decoder_input, state_tuple, last_pos, projection):
+        """
+        The mlp of the context of the last step, which gives the hidden state, and the next step, in a single region of
+        tensor ops so that they are compiled together
+        Inputs:
+        - context_information: Tensor of shape (batch, pooling_output_dim)
+        - the other inputs and the output as in step
+        """
+        state_tuple = (torch.unsqueeze(self.mlp(context_information), 0), state_tuple[1])
+        return self.step(decoder_input, state_tuple, last_pos, projection)
+
+    def rollout(self, last_pos, last_pos_rel, state_tuple):
+        """
+        All the steps of a decoder without pooling. The number of steps is fixed, so that the whole loop is unrolled
+        and fused when compiled
+        Output:
+        - pred_traj: tensor of shape (self.seq_len, batch, 2)
+        - decoder_h: tensor of shape (num_layers, batch, h_dim)
+        """
+        projection = self.get_output_projection()
+        decoder_input = self.embed(last_pos_rel)
+        pred_traj_fake_rel = last_pos.new_empty(self.seq_len, last_pos.size(0), 2)
+        for counter in range(self.seq_len):
+            rel_pos, last_pos, decoder_input, state_tuple = self.step(decoder_input, state_tuple, last_pos, projection)
+            pred_traj_fake_rel[counter] = rel_pos
+        return pred_traj_fake_rel, state_tuple[0]
+
+    def pooling_needed(self, counter, curr_pos, pooled_pos):
+        """
+        Inputs:
+        - counter: index of the step
+        - curr_pos: Tensor of shape (batch, 2), positions at this step
+        - pooled_pos: Tensor of shape (batch, 2), positions at the last pooling, None before the first one
+        Output:
+        - True if the context has to be computed at this step
+        """
+        if self.pool_steps is not None:
+            return counter in self.pool_steps
+        if pooled_pos is None:
+            return True
+        if self.pool_motion_threshold > 0:
+            # One host sync per step, instead of a pooling
+            displacement = torch.norm(curr_pos - pooled_pos, dim=1)
+            return bool(torch.max(displacement) > self.pool_motion_threshold)
+        return counter % self.pool_every_k == 0
+
+    def forward(self, last_pos, last_pos_rel, state_tuple, seq_start_end, seq_scene_ids=None, topology=None):
         """
         Inputs:
         - last_pos: Tensor of shape (batch, 2)
         - last_pos_rel: Tensor of shape (batch, 2)
         - state_tuple: (hh, ch) each tensor of shape (num_layers, batch, h_dim)
         - seq_start_end: A list of tuples which delimit sequences within batch
+        - topology: BatchTopology of the batch, built from seq_start_end if not given
         Output:
         - pred_traj: tensor of shape (self.seq_len, batch, 2)
         """
-        batch = last_pos.size(0)
-        pred_traj_fake_rel = []
-        decoder_input = self.spatial_embedding(last_pos_rel.to(device))
-        decoder_input = decoder_input.view(1, batch, self.embedding_dim) # [1, ped, h_dim]
-
-        for counter in range(1, self.seq_len+1):
-            output, state_tuple = self.decoder(decoder_input, state_tuple)
-            rel_pos = self.hidden2pos(output.view(-1, self.h_dim))
-            curr_pos = rel_pos + last_pos
-
-            if self.pool_every_timestep: #and counter % 6 == 0:
-                decoder_h = state_tuple[0]
-                # context information at t+1, since input is curr_pos^(t+1)
-                context_information = self.pooling.aggregate_context(decoder_h, seq_start_end, curr_pos, rel_pos, seq_scene_ids)
+        last_pos_rel = last_pos_rel.to(last_pos.device)
+        if not self.pool_every_timestep:
+            return self.rollout(last_pos, last_pos_rel, state_tuple)
+
+        # The index tensors of the batch are the same at every step
+        topology = get_topology(seq_start_end, seq_scene_ids, topology, batch=last_pos.size(0))
+        projection = self.get_output_projection()
+        decoder_input = self.embed(last_pos_rel)
+        # Written in place at every step
+        pred_traj_fake_rel = last_pos.new_empty(self.seq_len, last_pos.size(0), 2)
+        # Context of the last pooling, and positions at that step
+        context_information, pooled_pos = None, None
 
-                decoder_h = self.mlp(context_information)
-                decoder_h = torch.unsqueeze(decoder_h, 0)
-                state_tuple = (decoder_h, state_tuple[1])
+        for counter in range(self.seq_len):
+            if context_information is None:
+                rel_pos, curr_pos, decoder_input, state_tuple = self.step(decoder_input, state_tuple, last_pos, projection)
+            else:
+                rel_pos, curr_pos, decoder_input, state_tuple = self.pooled_step(context_information, decoder_input,
+                                                                                 state_tuple, last_pos, projection)
+            decoder_h = state_tuple[0]
+
+            if self.pooling_needed(counter, curr_pos, pooled_pos):
+                # context information at t+1, since input is curr_pos^(t+1)
+                context_information = self.pooling.aggregate_context(decoder_h, seq_start_end, curr_pos, rel_pos,
+                                                                     seq_scene_ids, topology)
+                pooled_pos = curr_pos
+            elif context_information is not None:
+                context_information = self.pooling.refresh_context(context_information, decoder_h)
 
-            decoder_input = self.spatial_embedding(rel_pos)
-            decoder_input = decoder_input.view(1, batch, self.embedding_dim)
-            pred_traj_fake_rel.append(rel_pos.view(batch, -1))
+            pred_traj_fake_rel[counter] = rel_pos
             last_pos = curr_pos
 
-        pred_traj_fake_rel = torch.stack(pred_traj_fake_rel, dim=0)
+        if context_information is not None:
+            # The mlp of the last context is applied with the next step, except after the last one
+            state_tuple = (torch.unsqueeze(self.mlp(context_information), 0), state_tuple[1])
         return pred_traj_fake_rel, state_tuple[0]
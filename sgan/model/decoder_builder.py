@@ -12,7 +12,10 @@ class DecoderBuilder(object):
         pool_every_timestep=True, dropout=0.0, bottleneck_dim=1024,
         activation='relu', batch_norm=True, 
 	    static_pooling_type=None,  dynamic_pooling_type=None,
-        neighborhood_size=2.0, grid_size=8, pooling_dim=2, down_samples=200
+        neighborhood_size=2.0, grid_size=8, pooling_dim=2, down_samples=200,
+        neighbor_radius=0, max_neighbors=-1, concurrent_pooling=False,
+        pool_memory_budget=0, pool_checkpoint=False, boundary_tolerance=None,
+        pool_every_k=1, pool_steps=None, pool_motion_threshold=0.0
     ):
          self.seq_len=seq_len
          self.embedding_dim=embedding_dim
@@ -32,7 +35,15 @@ class DecoderBuilder(object):
          self.grid_size=grid_size
          self.pooling_dim=pooling_dim
          self.down_samples=down_samples
-         self.pooling= CompositePooling()
+         self.neighbor_radius=neighbor_radius
+         self.max_neighbors=max_neighbors
+         self.pool_memory_budget=pool_memory_budget
+         self.pool_checkpoint=pool_checkpoint
+         self.boundary_tolerance=boundary_tolerance
+         self.pool_every_k=pool_every_k
+         self.pool_steps=pool_steps
+         self.pool_motion_threshold=pool_motion_threshold
+         self.pooling= CompositePooling(concurrent=concurrent_pooling)
          self.pooling.add(NullPooling())
          self.pooling_output_dim = h_dim
          print('Null pooling added, pooling_output_dim: {}'.format(self.pooling_output_dim))
@@ -58,7 +69,7 @@ class DecoderBuilder(object):
                  dropout=self.dropout,
                  neighborhood_size=self.neighborhood_size,
                  grid_size=self.grid_size)
-         physical_pooling.static_scene_feature_extractor.set_dset_list(data_dir)
+         physical_pooling.static_scene_feature_extractor.set_dset_list(data_dir, boundary_tolerance=self.boundary_tolerance)
          self.pooling.add(physical_pooling)
          self.pooling_output_dim += self.bottleneck_dim
          print('Static pooling added, pooling_output_dim: {}'.format(self.pooling_output_dim))
@@ -74,7 +85,11 @@ class DecoderBuilder(object):
                 batch_norm=self.batch_norm,
                 pooling_dim=self.pooling_dim,
                 neighborhood_size=self.neighborhood_size,
-                pool_every=self.pool_every_timestep))
+                pool_every=self.pool_every_timestep,
+                neighbor_radius=self.neighbor_radius,
+                max_neighbors=self.max_neighbors,
+                pool_memory_budget=self.pool_memory_budget,
+                pool_checkpoint=self.pool_checkpoint))
 
          elif self.dynamic_pooling_type == 'social_pooling': 
             self.pooling.add(SocialPooling(
@@ -84,7 +99,9 @@ class DecoderBuilder(object):
                 batch_norm=self.batch_norm,
                 dropout=self.dropout,
                 neighborhood_size=self.neighborhood_size,
-                grid_size=self.grid_size))
+                grid_size=self.grid_size,
+                neighbor_radius=self.neighbor_radius,
+                max_neighbors=self.max_neighbors))
          elif self.dynamic_pooling_type == 'social_pooling_attention':
             self.pooling.add(SocialPoolingAttention(
                 h_dim=self.h_dim,
@@ -93,7 +110,9 @@ class DecoderBuilder(object):
                 batch_norm=self.batch_norm,
                 dropout=self.dropout,
                 neighborhood_size=self.neighborhood_size,
-                grid_size=self.grid_size))
+                grid_size=self.grid_size,
+                neighbor_radius=self.neighbor_radius,
+                max_neighbors=self.max_neighbors))
          self.pooling_output_dim += self.bottleneck_dim
          print('Dynamic pooling added, pooling_output_dim: {}'.format(self.pooling_output_dim))
 
@@ -111,5 +130,8 @@ class DecoderBuilder(object):
             pool_static_type=self.static_pooling_type,
             pool_every_timestep=self.pool_every_timestep,
             pooling=self.pooling,
-            pooling_output_dim=self.pooling_output_dim
+            pooling_output_dim=self.pooling_output_dim,
+            pool_every_k=self.pool_every_k,
+            pool_steps=self.pool_steps,
+            pool_motion_threshold=self.pool_motion_threshold
         )
\ No newline at end of file
@@ -3,7 +3,6 @@ import torch.nn as nn
 
 from sgan.model.utils import get_device
 
-device = get_device()
 class Encoder(nn.Module):
     """Encoder is part of both TrajectoryGenerator and
     TrajectoryDiscriminator"""
@@ -22,12 +21,12 @@ class Encoder(nn.Module):
             embedding_dim, h_dim, num_layers, dropout=dropout
         )
         # self.linear_out = nn.Linear(2*h_dim, embedding_dim)
-        self.spatial_embedding = nn.Linear(2, embedding_dim).to(device)
+        self.spatial_embedding = nn.Linear(2, embedding_dim).to(get_device())
 
     def init_hidden(self, batch):
         return (
-            torch.zeros(self.num_layers, batch, self.h_dim).to(device),
-            torch.zeros(self.num_layers, batch, self.h_dim).to(device)
+            torch.zeros(self.num_layers, batch, self.h_dim).to(get_device()),
+            torch.zeros(self.num_layers, batch, self.h_dim).to(get_device())
         )
 
     def forward(self, obs_traj, full_seq=False):
@@ -43,7 +42,9 @@ class Encoder(nn.Module):
         obs_traj_embedding = obs_traj_embedding.view(
             -1, batch, self.embedding_dim
         )
-        state_tuple = self.init_hidden(batch)
+        # Zeros created like the input, so that the forward does not depend on the global device (compiled graphs)
+        state_tuple = (obs_traj_embedding.new_zeros(self.num_layers, batch, self.h_dim),
+                       obs_traj_embedding.new_zeros(self.num_layers, batch, self.h_dim))
         output, state = self.encoder(obs_traj_embedding, state_tuple)
         final_h = state[0]
         if full_seq:
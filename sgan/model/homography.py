@@ -0,0 +1,56 @@
+import torch
+
+from sgan.model.models_static_scene import get_homography
+from sgan.model.utils import get_device
+
+
+class HomographyTransform:
+    """
+    Keeps, for each scene, the homography H (pixels -> world) and its inverse (world -> pixels) as tensors on the
+    device, so that whole batches of trajectories are projected with a single batched matmul
+    """
+    def __init__(self):
+        self.homographies = {}  # scene_name -> (H, H^-1), each of shape (3, 3)
+
+    def add_scene(self, scene_name, h=None):
+        """ h: numpy array of shape (3, 3), read from the scene homography file when not given """
+        if scene_name not in self.homographies:
+            if h is None:
+                h = get_homography(scene_name)
+            h = torch.as_tensor(h, dtype=torch.float64, device=get_device())
+            self.homographies[scene_name] = (h.float(), torch.inverse(h).float())
+        return self.homographies[scene_name]
+
+    def get_per_pedestrian(self, scene_names, seq_start_end, inverse=False):
+        """
+        Inputs:
+        - scene_names: list with the scene of each sequence
+        - seq_start_end: Tensor of shape (num_seq, 2)
+        Output:
+        - Tensor of shape (batch, 3, 3) with the homography of the scene of each pedestrian
+        """
+        matrices = torch.stack([self.add_scene(scene_name)[1 if inverse else 0] for scene_name in scene_names])
+        num_peds = (seq_start_end[:, 1] - seq_start_end[:, 0]).to(get_device())
+        return matrices.repeat_interleave(num_peds, dim=0)
+
+    def world_to_pixels(self, traj, seq_start_end, scene_names):
+        """ traj: Tensor of shape (..., batch, 2) in world coordinates """
+        return apply_homography(traj, self.get_per_pedestrian(scene_names, seq_start_end, inverse=True))
+
+    def pixels_to_world(self, traj, seq_start_end, scene_names):
+        """ traj: Tensor of shape (..., batch, 2) in pixel coordinates """
+        return apply_homography(traj, self.get_per_pedestrian(scene_names, seq_start_end))
+
+
+def apply_homography(traj, homographies):
+    """
+    Inputs:
+    - traj: Tensor of shape (..., batch, 2)
+    - homographies: Tensor of shape (batch, 3, 3)
+    Output:
+    - Tensor of shape (..., batch, 2), projective transform of every point with the homography of its pedestrian
+    """
+    homographies = homographies.to(traj.device)
+    points = torch.cat([traj.type_as(homographies), torch.ones_like(traj[..., :1], dtype=homographies.dtype)], dim=-1)
+    points = torch.einsum('bij,...bj->...bi', homographies, points)
+    return points[..., :2] / points[..., 2:]
@@ -1,6 +1,6 @@
 import torch
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+from sgan.model.utils import get_device
 
 def bce_loss(input, target):
     """
@@ -16,6 +16,7 @@ def bce_loss(input, target):
     - A PyTorch Tensor containing the mean BCE loss over the minibatch of
       input data.
     """
+    input = input.float()  # in fp32, also under autocast
     neg_abs = -input.abs()
     loss = input.clamp(min=0) - input * target + (1 + neg_abs.exp()).log()
     return loss.mean()
@@ -29,6 +30,7 @@ def gan_g_loss(scores_fake, loss='mse'):
     Output:
     - loss: Tensor of shape (,) giving GAN generator loss
     """
+    scores_fake = scores_fake.float()  # in fp32, also under autocast (bf16 scores round to exactly 1)
     y_fake = torch.ones_like(scores_fake)  # * random.uniform(0.7, 1.2)
     if loss == 'bce':
         return bce_loss(scores_fake, y_fake)
@@ -37,7 +39,8 @@ def gan_g_loss(scores_fake, loss='mse'):
         return loss_fake.mean()
 
 def g_critic_loss_function(values_fake):
-   return torch.mean(-1 * (values_fake - torch.ones_like(values_fake))).to(device)
+   values_fake = values_fake.float()  # in fp32, also under autocast
+   return torch.mean(-1 * (values_fake - torch.ones_like(values_fake))).to(get_device())
 
 
 def gan_d_loss(scores_real, scores_fake, loss='bce'):
@@ -49,6 +52,7 @@ def gan_d_loss(scores_real, scores_fake, loss='bce'):
     Output:
     - loss: Tensor of shape (,) giving GAN discriminator loss
     """
+    scores_real, scores_fake = scores_real.float(), scores_fake.float()  # in fp32, also under autocast
     y_real = torch.ones_like(scores_real)  # * random.uniform(0.7, 1.2)
     y_fake = torch.zeros_like(scores_fake)  # * random.uniform(0, 0.3)
     if loss == 'mse':
@@ -2,22 +2,22 @@
 import torch
 import torch.nn as nn
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+from sgan.model.utils import get_device
 
 def make_mlp(dim_list, activation='relu', batch_norm=True, dropout=0):
     layers = []
     for dim_in, dim_out in zip(dim_list[:-1], dim_list[1:]):
-        layers.append(nn.Linear(dim_in, dim_out).to(device))
+        layers.append(nn.Linear(dim_in, dim_out).to(get_device()))
         if batch_norm:
-            layers.append(nn.BatchNorm1d(dim_out).to(device))
+            layers.append(nn.BatchNorm1d(dim_out).to(get_device()))
         if activation == 'relu':
-            layers.append(nn.ReLU().to(device))
+            layers.append(nn.ReLU().to(get_device()))
         elif activation == 'leakyrelu':
-            layers.append(nn.LeakyReLU().to(device))
+            layers.append(nn.LeakyReLU().to(get_device()))
         if dropout > 0:
-            layers.append(nn.Dropout(p=dropout).to(device))
-    #layers.append(nn.Linear(dim_list[-1], dim_list[-1]).to(device))
-    return nn.Sequential(*layers).to(device)
+            layers.append(nn.Dropout(p=dropout).to(get_device()))
+    #layers.append(nn.Linear(dim_list[-1], dim_list[-1]).to(get_device()))
+    return nn.Sequential(*layers).to(get_device())
 
 
 
@@ -3,15 +3,16 @@ import torch.nn as nn
 
 from sgan.model.mlp import make_mlp
 from sgan.model.encoder import Encoder
+from sgan.context.batch_topology import get_topology
 
 from sgan.model.utils import get_device
 
-device = get_device()
-def get_noise(shape, noise_type):
+def get_noise(shape, noise_type, device=None):
+    device = get_device() if device is None else device
     if noise_type == 'gaussian':
-        return torch.randn(*shape).to(device)
+        return torch.randn(*shape, device=device)
     elif noise_type == 'uniform':
-        return torch.rand(*shape).sub_(0.5).mul_(2.0).to(device)
+        return torch.rand(*shape, device=device).sub_(0.5).mul_(2.0)
     raise ValueError('Unrecognized noise type "%s"' % noise_type)
 
 
@@ -69,39 +70,50 @@ class TrajectoryGenerator(nn.Module):
                 dropout=dropout
             )
 
-    def add_noise(self, _input, seq_start_end, user_noise=None):
+    def train(self, mode=True):
+        # The pooling modules are held by the CompositePooling, not as submodules: they follow the mode of the model
+        super(TrajectoryGenerator, self).train(mode)
+        if self.pooling is not None:
+            self.pooling.train(mode)
+        return self
+
+    def add_noise(self, _input, seq_start_end, user_noise=None, topology=None, num_samples=1):
         """
         Inputs:
         - _input: Tensor of shape (_, decoder_h_dim - noise_first_dim)
         - seq_start_end: A list of tuples which delimit sequences within batch.
         - user_noise: Generally used for inference when you want to see
-        relation between different types of noise and outputs.
+        relation between different types of noise and outputs. Tensor of shape (num_samples, num_seq, noise_dim) for
+        the 'global' noise, (num_samples, _, noise_dim) for the 'ped' one, or the same flattened over the samples
+        - topology: BatchTopology of the batch, built from seq_start_end if not given
+        - num_samples: Number of samples, each with its own noise
         Outputs:
-        - decoder_h: Tensor of shape (_, decoder_h_dim)
+        - decoder_h: Tensor of shape (num_samples * _, decoder_h_dim), the rows of the first sample, then of the
+        second, ...
         """
+        if num_samples > 1:
+            _input = _input.repeat(num_samples, 1)
         if not self.noise_dim:
             return _input
 
+        num_seq = seq_start_end.size(0)
         if self.noise_mix_type == 'global':
-            noise_shape = (seq_start_end.size(0), ) + self.noise_dim
+            noise_shape = (num_samples * num_seq, ) + self.noise_dim
         else:
             noise_shape = (_input.size(0), ) + self.noise_dim
 
         if user_noise is not None:
-            z_decoder = user_noise
+            z_decoder = user_noise.reshape(noise_shape)
         else:
-            z_decoder = get_noise(noise_shape, self.noise_type)
+            z_decoder = get_noise(noise_shape, self.noise_type, _input.device)
 
         if self.noise_mix_type == 'global':
-            _list = []
-            for idx, (start, end) in enumerate(seq_start_end):
-                start = start.item()
-                end = end.item()
-                _vec = z_decoder[idx].view(1, -1)
-                _to_cat = _vec.repeat(end - start, 1)
-                _list.append(torch.cat([_input[start:end], _to_cat], dim=1))
-            decoder_h = torch.cat(_list, dim=0)
-            return decoder_h
+            # Same noise for all the pedestrians of a sequence, in each sample: gathered by sequence id, built on the
+            # device with the batch size known from the input shape, so that no host sync is needed
+            seq_id = get_topology(seq_start_end, topology=topology, batch=_input.size(0) // num_samples).seq_id
+            if num_samples > 1:
+                seq_id = (torch.arange(num_samples, device=seq_id.device).view(-1, 1) * num_seq + seq_id).view(-1)
+            z_decoder = z_decoder.view(num_samples * num_seq, -1)[seq_id]
 
         decoder_h = torch.cat([_input, z_decoder], dim=1)
 
@@ -116,53 +128,83 @@ class TrajectoryGenerator(nn.Module):
         else:
             return False
 
-    def forward(self, obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids=None, user_noise=None):
+    def decoder_context(self, context_information):
+        """ Input of the noise, computed from the context of the encoder. Its own method, so that it is compiled apart
+        from the mlp of the decoder (both are nn.Sequential, whose forward would be recompiled for each) """
+        if self.mlp_decoder_needed():
+            return self.mlp_decoder_context(context_information)
+        return context_information
+
+    def sample(self, obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids=None, num_samples=1, user_noise=None,
+               topology=None):
         """
         Inputs:
         - obs_traj: Tensor of shape (obs_len, batch, 2)
         - obs_traj_rel: Tensor of shape (obs_len, batch, 2)
         - seq_start_end: A list of tuples which delimit sequences within batch.
+        - num_samples: Number of trajectories predicted for each pedestrian. The encoder and the first pooling run
+        once, only the noise differs between the samples, and the decoder runs once on all of them. In eval mode
+        each sample is the prediction of forward with its noise; in train mode the batch norm layers normalize over
+        all the samples together
         - user_noise: Generally used for inference when you want to see
         relation between different types of noise and outputs.
+        - topology: BatchTopology of the batch, built from seq_start_end if not given. It is shared by the pooling
+        modules, the noise and all the decoder steps
         Output:
-        - pred_traj_rel: Tensor of shape (self.pred_len, batch, 2)
+        - pred_traj_rel: Tensor of shape (num_samples, self.pred_len, batch, 2)
         """
 
         batch = obs_traj_rel.size(1)
+        topology = get_topology(seq_start_end, seq_scene_ids, topology, batch=batch)
         # Encode seq
         final_encoder_h = self.encoder(obs_traj_rel)
         end_pos = obs_traj[-1, :, :]
         rel_pos = obs_traj_rel[-1, :, :]
 
-        context_information = self.pooling.aggregate_context(final_encoder_h, seq_start_end, end_pos, rel_pos, seq_scene_ids)
+        context_information = self.pooling.aggregate_context(final_encoder_h, seq_start_end, end_pos, rel_pos, seq_scene_ids,
+                                                             topology)
 
         # Add Noise
-        if self.mlp_decoder_needed():
-            noise_input = self.mlp_decoder_context(context_information)
-        else:
-            noise_input = context_information
-        decoder_h = self.add_noise(noise_input, seq_start_end, user_noise=user_noise)
+        noise_input = self.decoder_context(context_information)
+        decoder_h = self.add_noise(noise_input, seq_start_end, user_noise=user_noise, topology=topology,
+                                   num_samples=num_samples)
         decoder_h = torch.unsqueeze(decoder_h, 0)
 
-        decoder_c = torch.zeros(
-            self.num_layers, batch, self.decoder_h_dim
-        ).to(device)
+        decoder_c = decoder_h.new_zeros(self.num_layers, num_samples * batch, self.decoder_h_dim)
 
         state_tuple = (decoder_h, decoder_c)
-        last_pos = obs_traj[-1]
-        last_pos_rel = obs_traj_rel[-1]
+        last_pos = obs_traj[-1].repeat(num_samples, 1)
+        last_pos_rel = obs_traj_rel[-1].repeat(num_samples, 1)
+        # The samples are decoded as a batch num_samples times larger, with the sequences of each sample apart
+        sample_topology = topology.repeat(num_samples)
         # Predict Trajectory
 
         decoder_out = self.decoder(
                 last_pos,
                 last_pos_rel,
                 state_tuple,
-                seq_start_end,
-                seq_scene_ids)
+                sample_topology.seq_start_end,
+                sample_topology.seq_scene_ids,
+                sample_topology)
         
         pred_traj_fake_rel, final_decoder_h = decoder_out
 
-        return pred_traj_fake_rel
+        return pred_traj_fake_rel.view(self.pred_len, num_samples, batch, 2).permute(1, 0, 2, 3)
+
+    def forward(self, obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids=None, user_noise=None, topology=None):
+        """
+        Inputs:
+        - obs_traj: Tensor of shape (obs_len, batch, 2)
+        - obs_traj_rel: Tensor of shape (obs_len, batch, 2)
+        - seq_start_end: A list of tuples which delimit sequences within batch.
+        - user_noise: Generally used for inference when you want to see
+        relation between different types of noise and outputs.
+        - topology: BatchTopology of the batch, built from seq_start_end if not given
+        Output:
+        - pred_traj_rel: Tensor of shape (self.pred_len, batch, 2)
+        """
+        return self.sample(obs_traj, obs_traj_rel, seq_start_end, seq_scene_ids, num_samples=1, user_noise=user_noise,
+                           topology=topology)[0]
 
 
 class CollisionPredictor(nn.Module):
@@ -1,9 +1,9 @@
 import torch
 import numpy as np
-import pandas as pd
 import os
 #import matplotlib.pyplot as plt
 from sgan.model.folder_utils import get_dset_group_name, get_root_dir
+from sgan.data.boundary_points import load_boundary_points, BOUNDARY_POINTS_FILE
 
 def rgb2gray(rgb):
     return np.dot(rgb[...,:3], [0.299, 0.587, 0.114])
@@ -26,16 +26,21 @@ def get_homography(dset):
     directory = get_root_dir() + '/data/'
     path_group = os.path.join(directory, get_dset_group_name(dset))
     path = os.path.join(path_group, dset)
+    import pandas as pd
     h_matrix = pd.read_csv(path + '/{}_homography.txt'.format(dset), delim_whitespace=True, header=None).values
     return h_matrix
 
 
-def get_homography_and_map(dset, annotated_points_name = '/world_points_boundary.npy'):
+def get_homography_and_map(dset, annotated_points_name = '/world_points_boundary.npy', tolerance=None):
     directory = get_root_dir() + '/data/'
     path_group = os.path.join(directory, get_dset_group_name(dset))
     path = os.path.join(path_group, dset)
+    import pandas as pd
     h_matrix = pd.read_csv(path + '/{}_homography.txt'.format(dset), delim_whitespace=True, header=None).values
-    if 'txt' in annotated_points_name:
+    if tolerance is not None and annotated_points_name == '/' + BOUNDARY_POINTS_FILE:
+        # Cheapest precomputed resolution of the boundary points within tolerance meters
+        map = load_boundary_points(path, tolerance=tolerance)
+    elif 'txt' in annotated_points_name:
         map = np.loadtxt(path + annotated_points_name, delimiter=' ')
     elif 'jpg' in annotated_points_name:
         map = load_bin_map(path + annotated_points_name)
@@ -143,47 +148,43 @@ def get_polar_coordinates(current_peds_pos, boundary_points):
 
 
 def get_static_obstacles_boundaries(n_buckets, vectors_image, current_peds_pos, boundary_points, radius_image = 20):
-    # print("len boundary_points:", boundary_points.size(0))
-    world_beams = torch.zeros((n_buckets*current_peds_pos.size(0), 2)).cuda()
-    split_theta = torch.tensor(np.pi / n_buckets).cuda()     # angle of each split of the 180 polar grid in front of the current pedestrian
-    polar_coordinates, boundary_points_repeated = get_polar_coordinates(current_peds_pos, boundary_points)  # polar coordinates of boundary points in annotated image
+    """
+    Inputs:
+    - n_buckets: Number of splits of the 180 degrees polar grid in front of each pedestrian
+    - vectors_image: Tensor of shape (num_peds, 2) with the pedestrians directions
+    - current_peds_pos: Tensor of shape (num_peds, 2)
+    - boundary_points: Tensor of shape (num_points, 2)
+    Output:
+    - world_beams: Tensor of shape (num_peds * n_buckets, 2) with the closest boundary point in each split
+    """
+    split_theta = np.pi / n_buckets     # angle of each split of the 180 polar grid in front of the current pedestrian
+
+    # polar coordinates of boundary points with respect to each pedestrian, [numPeds, boundary_points]
+    rel_points = boundary_points.unsqueeze(0) - current_peds_pos.unsqueeze(1)
+    radiuses = torch.norm(rel_points, dim=2)
+    thetas = torch.atan2(rel_points[:, :, 1], rel_points[:, :, 0])
 
     # the starting angle is the one of the current pedestrian trajectory - 90, so on his/her left hand side
     starting_angles = -torch.atan2(vectors_image[:, 1], vectors_image[:, 0]) - np.pi/2 # [numPeds]
-    starting_angles = starting_angles.unsqueeze(dim=1)
-    starting_angles = repeat_row(starting_angles, boundary_points.size(0)) # [numPeds*boundary_points]
-
-    for beams_index in range(0, n_buckets):
-        # select all boundary points that are located in the current split of the polar grid
-        # c0 = torch.index_select(polar_coordinates, dim=1, index=torch.tensor([0]).cuda())
-
-        mask1 = torch.le(polar_coordinates[:, 0], radius_image)
-        mask2 = torch.ge(polar_coordinates[:, 1], starting_angles.squeeze(1))
-        mask3 = torch.le(polar_coordinates[:, 1], starting_angles.squeeze(1) + split_theta)
-        mask = mask1 * mask2 * mask3
-        mask = torch.stack((mask, mask)).transpose(0, 1)
-        #print(polar_coordinates[:, 0].size())
-
-        for ped_index in range(vectors_image.size(0)):
-            index = boundary_points.size(0) * ped_index
-
-            if (mask[index:index+boundary_points.size(0)] == 0).all():
-                # if there are no points in the split of the polar grid chose the point at the extreme part of the current split of the polar grid
-                x = (radius_image+current_peds_pos[ped_index, 0])*torch.cos(starting_angles[ped_index] + split_theta/2)
-                y = (radius_image+current_peds_pos[ped_index, 1])*torch.sin(starting_angles[ped_index] + split_theta/2)
-                world_beams[ped_index*n_buckets + beams_index] = torch.stack((x, y)).squeeze(1)
-            else:
-                selected_points = boundary_points_repeated[index:index+boundary_points.size(0)]
-                #print(' selected_points', selected_points)
-                selected_points = torch.masked_select(selected_points, mask[index:index+boundary_points.size(0)])
-                selected_polar_coordinates = polar_coordinates[index:index+boundary_points.size(0)]
-                selected_polar_coordinates = selected_polar_coordinates[mask[index:index+boundary_points.size(0)]].view(-1, 2)
-                # Among all points in the split, choose the closest one
-                column = torch.index_select(selected_polar_coordinates, dim=1, index=torch.tensor([0]).cuda())
-                minimum_point_index = column.min(0)[1]
-                #print('size selected_points: ', selected_points.size())
-                world_beams[ped_index * n_buckets + beams_index] = selected_points[minimum_point_index]
-
-        starting_angles += split_theta
-
-    return world_beams
+    beams_start = starting_angles.unsqueeze(1) + split_theta * torch.arange(n_buckets, device=current_peds_pos.device,
+                                                                           dtype=current_peds_pos.dtype).unsqueeze(0) # [numPeds, n_buckets]
+
+    # select, for every pedestrian and every split of the polar grid, the boundary points located in it
+    # [numPeds, n_buckets, boundary_points]
+    mask = (radiuses <= radius_image).unsqueeze(1) \
+           & (thetas.unsqueeze(1) >= beams_start.unsqueeze(2)) \
+           & (thetas.unsqueeze(1) <= beams_start.unsqueeze(2) + split_theta)
+    masked_radiuses = radiuses.unsqueeze(1).expand_as(mask).masked_fill(~mask, float('inf'))
+
+    # Among all points in the split, choose the closest one
+    min_radiuses, minimum_point_index = masked_radiuses.min(dim=2)
+    closest_points = boundary_points[minimum_point_index]    # [numPeds, n_buckets, 2]
+
+    # if there are no points in the split of the polar grid chose the point at the extreme part of the current split of the polar grid
+    middle_angles = beams_start + split_theta / 2
+    extreme_points = torch.stack(((radius_image + current_peds_pos[:, 0].unsqueeze(1)) * torch.cos(middle_angles),
+                                  (radius_image + current_peds_pos[:, 1].unsqueeze(1)) * torch.sin(middle_angles)), dim=2)
+
+    world_beams = torch.where(torch.isinf(min_radiuses).unsqueeze(2), extreme_points, closest_points)
+
+    return world_beams.view(-1, 2)
@@ -0,0 +1,42 @@
+import torch
+import torch.nn as nn
+
+# Layers with an int8 dynamic quantized version (int8 weights, activations quantized on the fly), CPU only
+QUANTIZABLE_TYPES = (nn.Linear, nn.LSTM, nn.LSTMCell)
+# Layers of the generator read through their weights rather than called: the decoder fuses hidden2pos and
+# spatial_embedding (see Decoder.get_output_projection). They are tiny anyway
+NOT_QUANTIZABLE = ('decoder.hidden2pos', 'decoder.spatial_embedding')
+
+
+def get_quantizable_modules(module, excluded=()):
+    """ Sorted list with the names of the layers of module that can be quantized """
+    return sorted(name for name, layer in module.named_modules()
+                  if isinstance(layer, QUANTIZABLE_TYPES) and name not in excluded)
+
+
+def quantize_module(module, excluded=()):
+    """ Quantizes in place the layers of module, except the excluded ones, and returns their names """
+    module_names = get_quantizable_modules(module, excluded)
+    if module_names:
+        qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig for name in module_names}
+        torch.ao.quantization.quantize_dynamic(module, qconfig_spec, dtype=torch.qint8, inplace=True)
+    return module_names
+
+
+def quantize_generator(generator):
+    """
+    Applies int8 dynamic quantization, in place, to the encoder and decoder LSTMs and to the Linear layers of the
+    generator and of its pooling modules (make_mlp, PoolHiddenNet.mlp_pre_pool, the physical Attention, ...). The
+    pooling modules are held by the CompositePooling of the generator and of the decoder, not as submodules, so they
+    are quantized one by one
+    Inputs:
+    - generator: TrajectoryGenerator on the CPU, in eval mode
+    Output:
+    - list with the names of the quantized layers
+    """
+    quantized_modules = quantize_module(generator, NOT_QUANTIZABLE)
+    for owner, pooling in (('pooling', generator.pooling), ('decoder.pooling', generator.decoder.pooling)):
+        for i, pooling_module in enumerate(pooling.pooling_list):
+            if isinstance(pooling_module, nn.Module):
+                quantized_modules += ['{}.{}.{}'.format(owner, i, name) for name in quantize_module(pooling_module)]
+    return quantized_modules
@@ -13,7 +13,9 @@ class TrajectoryGeneratorBuilder(object):
         noise_type='gaussian', noise_mix_type='ped', dropout=0.0, bottleneck_dim=1024,
         activation='relu', batch_norm=True, 
         static_pooling_type=None,  dynamic_pooling_type=None, pool_every_timestep=True,
-        neighborhood_size=2.0, grid_size=8, pooling_dim=2, down_samples=200
+        neighborhood_size=2.0, grid_size=8, pooling_dim=2, down_samples=200,
+        neighbor_radius=0, max_neighbors=-1, concurrent_pooling=False,
+        pool_memory_budget=0, pool_checkpoint=False, boundary_tolerance=None
     ):
          self.obs_len=obs_len
          self.pred_len=pred_len
@@ -38,7 +40,12 @@ class TrajectoryGeneratorBuilder(object):
          self.grid_size=grid_size
          self.pooling_dim=pooling_dim
          self.down_samples=down_samples
-         self.pooling= CompositePooling()
+         self.neighbor_radius=neighbor_radius
+         self.max_neighbors=max_neighbors
+         self.pool_memory_budget=pool_memory_budget
+         self.pool_checkpoint=pool_checkpoint
+         self.boundary_tolerance=boundary_tolerance
+         self.pooling= CompositePooling(concurrent=concurrent_pooling)
          self.pooling.add(NullPooling())
          self.pooling_output_dim = encoder_h_dim
          print('Null pooling added, pooling_output_dim: {}'.format(self.pooling_output_dim))
@@ -64,7 +71,7 @@ class TrajectoryGeneratorBuilder(object):
                  dropout=self.dropout,
                  neighborhood_size=self.neighborhood_size,
                  grid_size=self.grid_size)
-         physical_pooling.static_scene_feature_extractor.set_dset_list(data_dir)
+         physical_pooling.static_scene_feature_extractor.set_dset_list(data_dir, boundary_tolerance=self.boundary_tolerance)
          self.pooling.add(physical_pooling)
          self.pooling_output_dim += self.bottleneck_dim
          print('Static pooling added, pooling_output_dim: {}'.format(self.pooling_output_dim))
@@ -80,7 +87,11 @@ class TrajectoryGeneratorBuilder(object):
                 batch_norm=self.batch_norm,
                 pooling_dim=self.pooling_dim,
                 neighborhood_size=self.neighborhood_size,
-                pool_every=self.pool_every_timestep))
+                pool_every=self.pool_every_timestep,
+                neighbor_radius=self.neighbor_radius,
+                max_neighbors=self.max_neighbors,
+                pool_memory_budget=self.pool_memory_budget,
+                pool_checkpoint=self.pool_checkpoint))
 
          elif self.dynamic_pooling_type == 'social_pooling': 
             self.pooling.add(SocialPooling(
@@ -90,7 +101,9 @@ class TrajectoryGeneratorBuilder(object):
                 batch_norm=self.batch_norm,
                 dropout=self.dropout,
                 neighborhood_size=self.neighborhood_size,
-                grid_size=self.grid_size))
+                grid_size=self.grid_size,
+                neighbor_radius=self.neighbor_radius,
+                max_neighbors=self.max_neighbors))
 
          elif self.dynamic_pooling_type == 'social_pooling_attention':
             self.pooling.add(SocialPoolingAttention(
@@ -100,7 +113,9 @@ class TrajectoryGeneratorBuilder(object):
                 batch_norm=self.batch_norm,
                 dropout=self.dropout,
                 neighborhood_size=self.neighborhood_size,
-                grid_size=self.grid_size))
+                grid_size=self.grid_size,
+                neighbor_radius=self.neighbor_radius,
+                max_neighbors=self.max_neighbors))
          self.pooling_output_dim += self.bottleneck_dim
          print('Dynamic pooling added, pooling_output_dim: {}'.format(self.pooling_output_dim))
 
@@ -137,7 +152,8 @@ class TrajectoryCriticBuilder(object):
         c_type='local', collision_threshold=.25, occupancy_threshold=1.0, 
 	    static_pooling_type=None,  dynamic_pooling_type=None,
         pool_every_timestep=True, neighborhood_size=2.0, grid_size=8, pooling_dim=2,
-        down_samples=200
+        down_samples=200, neighbor_radius=0, max_neighbors=-1, concurrent_pooling=False,
+        pool_memory_budget=0, pool_checkpoint=False, boundary_tolerance=None
     ):
          self.obs_len = obs_len
          self.pred_len = pred_len
@@ -161,7 +177,12 @@ class TrajectoryCriticBuilder(object):
          self.grid_size=grid_size
          self.pooling_dim=pooling_dim
          self.down_samples=down_samples
-         self.pooling= CompositePooling()
+         self.neighbor_radius=neighbor_radius
+         self.max_neighbors=max_neighbors
+         self.pool_memory_budget=pool_memory_budget
+         self.pool_checkpoint=pool_checkpoint
+         self.boundary_tolerance=boundary_tolerance
+         self.pooling= CompositePooling(concurrent=concurrent_pooling)
          self.pooling.add(NullPooling())
          self.pooling_output_dim = h_dim
 
@@ -177,7 +198,7 @@ class TrajectoryCriticBuilder(object):
                 pool_static_type=self.static_pooling_type,
                 down_samples=self.down_samples)
          
-         physical_pooling.static_scene_feature_extractor.set_dset_list(data_dir)
+         physical_pooling.static_scene_feature_extractor.set_dset_list(data_dir, boundary_tolerance=self.boundary_tolerance)
          self.pooling.add(physical_pooling)
          self.pooling_output_dim += self.bottleneck_dim
          print('Static pooling added, pooling_output_dim: {}'.format(self.pooling_output_dim))
@@ -193,7 +214,11 @@ class TrajectoryCriticBuilder(object):
                 batch_norm=self.batch_norm,
                 pooling_dim=self.pooling_dim,
                 neighborhood_size=self.neighborhood_size,
-                pool_every=self.pool_every_timestep))
+                pool_every=self.pool_every_timestep,
+                neighbor_radius=self.neighbor_radius,
+                max_neighbors=self.max_neighbors,
+                pool_memory_budget=self.pool_memory_budget,
+                pool_checkpoint=self.pool_checkpoint))
 
          elif self.dynamic_pooling_type == 'social_pooling': 
             self.pooling.add(SocialPooling(
@@ -203,7 +228,9 @@ class TrajectoryCriticBuilder(object):
                 batch_norm=self.batch_norm,
                 dropout=self.dropout,
                 neighborhood_size=self.neighborhood_size,
-                grid_size=self.grid_size))
+                grid_size=self.grid_size,
+                neighbor_radius=self.neighbor_radius,
+                max_neighbors=self.max_neighbors))
 
          elif self.dynamic_pooling_type == 'social_pooling_attention':
             self.pooling.add(SocialPoolingAttention(
@@ -213,7 +240,9 @@ class TrajectoryCriticBuilder(object):
                 batch_norm=self.batch_norm,
                 dropout=self.dropout,
                 neighborhood_size=self.neighborhood_size,
-                grid_size=self.grid_size))
+                grid_size=self.grid_size,
+                neighbor_radius=self.neighbor_radius,
+                max_neighbors=self.max_neighbors))
          self.pooling_output_dim += self.h_dim
          print('Dynamic pooling added, pooling_output_dim: {}'.format(self.pooling_output_dim))
 
@@ -7,11 +7,43 @@ from contextlib import contextmanager
 import subprocess
 
 
+# Device of the models and of the batches. The modules read it with get_device() when they build their parameters and
+# constant tensors, the forward passes create their tensors on the device of their inputs
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 def get_device():
     return device
 
+def set_device(name=None):
+    """
+    Sets the device ('cpu', 'cuda', 'cuda:1', ...), the GPU if available when name is not given. To be called once, at
+    the start of a script, before the models are built
+    """
+    global device
+    if name is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    else:
+        device = torch.device(name)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        print("Device {} requested but CUDA is not available!".format(name))
+        exit()
+    return device
+
+def set_num_threads(num_threads=0, num_interop_threads=0):
+    """
+    CPU threads of the intra-op (e.g. matmul) and inter-op (independent ops) thread pools, the PyTorch defaults when 0.
+    The inter-op pool can only be sized before it is first used, so this is called at the start of a script too
+    """
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads > 0:
+        torch.set_num_interop_threads(num_interop_threads)
+
+def synchronize():
+    """ Waits for the queued kernels, for timings (a no-op on the CPU, where ops are synchronous) """
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
 def int_tuple(s):
     return tuple(int(i) for i in s.split(','))
 
@@ -53,11 +85,11 @@ def get_total_norm(parameters, norm_type=2):
 @contextmanager
 def timeit(msg, should_time=True):
     if should_time:
-        torch.cuda.synchronize()
+        synchronize()
         t0 = time.time()
     yield
     if should_time:
-        torch.cuda.synchronize()
+        synchronize()
         t1 = time.time()
         duration = (t1 - t0) * 1000.0
         print('%s: %.2f ms' % (msg, duration))
@@ -80,15 +112,13 @@ def get_gpu_memory():
 def relative_to_abs(rel_traj, start_pos):
     """
     Inputs:
-    - rel_traj: pytorch tensor of shape (seq_len, batch, 2)
+    - rel_traj: pytorch tensor of shape (seq_len, batch, 2), or (num_samples, seq_len, batch, 2)
     - start_pos: pytorch tensor of shape (batch, 2)
     Outputs:
-    - abs_traj: pytorch tensor of shape (seq_len, batch, 2)
+    - abs_traj: pytorch tensor with the shape of rel_traj
     """
-    # batch, seq_len, 2
-    rel_traj = rel_traj.permute(1, 0, 2)
-    displacement = torch.cumsum(rel_traj, dim=1)
-    start_pos = torch.unsqueeze(start_pos, dim=1)
+    # Accumulated in fp32, also when the displacements come from an autocast region
+    displacement = torch.cumsum(rel_traj.float(), dim=-3)
     abs_traj = displacement + start_pos
-    return abs_traj.permute(1, 0, 2)
+    return abs_traj
 
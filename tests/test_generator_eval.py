@@ -0,0 +1,81 @@
+""" In eval mode the predictions of a pedestrian do not depend on how the batch is split or sampled """
+
+from argparse import Namespace
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from sgan.model.utils import set_device
+from sgan.context.dynamic_pooling import PoolHiddenNet
+from scripts.helpers.helper_get_generator import helper_get_generator
+
+NUM_SAMPLES = 3
+
+
+def get_args(**kwargs):
+    args = dict(
+        obs_len=8, pred_len=12, embedding_dim=16, encoder_h_dim_g=32, decoder_h_dim_g=32, mlp_dim=32, num_layers=1,
+        noise_dim=(8, ), noise_type='gaussian', noise_mix_type='ped', dropout=0.0, bottleneck_dim=64,
+        activation='relu', batch_norm=True, dynamic_pooling_type='pool_hidden_net', static_pooling_type=None,
+        pool_every_timestep=True, neighborhood_size=2.0, grid_size=8, pooling_dim=2, down_samples=-1)
+    args.update(kwargs)
+    return Namespace(**args)
+
+
+def get_batch(seq_lens=(3, 1, 4, 2, 5)):
+    batch = sum(seq_lens)
+    obs_traj_rel = 0.1 * torch.randn(8, batch, 2)
+    obs_traj = torch.cumsum(obs_traj_rel, dim=0) + 4 * torch.rand(1, batch, 2)
+    ends = torch.cumsum(torch.tensor(seq_lens), dim=0)
+    seq_start_end = torch.stack([ends - torch.tensor(seq_lens), ends], dim=1)
+    return obs_traj, obs_traj_rel, seq_start_end
+
+
+def get_generator(**kwargs):
+    set_device('cpu')
+    torch.manual_seed(0)
+    generator = helper_get_generator(get_args(**kwargs), None)
+    # Running statistics different from the initial ones, as after training
+    generator.train()
+    with torch.no_grad():
+        for _ in range(3):
+            generator(*get_batch())
+    return generator.eval()
+
+
+def test_sample_equals_forward_calls():
+    generator = get_generator()
+    obs_traj, obs_traj_rel, seq_start_end = get_batch()
+    user_noise = torch.randn(NUM_SAMPLES, obs_traj.size(1), 8)
+    with torch.no_grad():
+        samples = generator.sample(obs_traj, obs_traj_rel, seq_start_end, num_samples=NUM_SAMPLES, user_noise=user_noise)
+        for k in range(NUM_SAMPLES):
+            prediction = generator(obs_traj, obs_traj_rel, seq_start_end, user_noise=user_noise[k])
+            assert torch.allclose(samples[k], prediction, atol=1e-5)
+
+
+def test_sequence_alone_equals_sequence_in_batch():
+    generator = get_generator()
+    obs_traj, obs_traj_rel, seq_start_end = get_batch()
+    user_noise = torch.randn(obs_traj.size(1), 8)
+    start, end = seq_start_end[2].tolist()
+    with torch.no_grad():
+        prediction = generator(obs_traj, obs_traj_rel, seq_start_end, user_noise=user_noise)
+        alone = generator(obs_traj[:, start:end], obs_traj_rel[:, start:end], torch.tensor([[0, end - start]]),
+                          user_noise=user_noise[start:end])
+    assert torch.allclose(prediction[:, start:end], alone, atol=1e-5)
+
+
+def test_chunked_pooling_equals_pooling():
+    generator = get_generator()
+    obs_traj, obs_traj_rel, seq_start_end = get_batch()
+    user_noise = torch.randn(obs_traj.size(1), 8)
+    with torch.no_grad():
+        prediction = generator(obs_traj, obs_traj_rel, seq_start_end, user_noise=user_noise)
+        # The same pooling modules, with chunks of a few pairs
+        for pooling in generator.pooling.pooling_list + generator.decoder.pooling.pooling_list:
+            if isinstance(pooling, PoolHiddenNet):
+                pooling.pool_memory_budget = 0.001
+        chunked_prediction = generator(obs_traj, obs_traj_rel, seq_start_end, user_noise=user_noise)
+    assert torch.allclose(prediction, chunked_prediction, atol=1e-5)
@@ -0,0 +1,43 @@
+""" Importing the models must stay cheap: the plotting and data-frame libraries are only imported by the features
+that use them, so that the scripts and the DataLoader workers start fast """
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('torch')
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+HEAVY_MODULES = ('matplotlib', 'pandas', 'torchvision', 'imageio', 'scripts.evaluation.visualization')
+# Seconds on top of the import of torch itself
+IMPORT_TIME_BUDGET = 2.0
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import torch
+torch_time = time.perf_counter() - start
+start = time.perf_counter()
+import sgan.model.models
+models_time = time.perf_counter() - start
+print(json.dumps({{'torch_time': torch_time, 'models_time': models_time,
+                  'heavy_modules': [name for name in {heavy_modules!r} if name in sys.modules]}}))
+"""
+
+
+def import_models():
+    """ Imports sgan.model.models in a fresh interpreter, where nothing has been imported yet """
+    script = IMPORT_SCRIPT.format(heavy_modules=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', script], cwd=ROOT_DIR, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def test_import_models_without_heavy_modules():
+    assert import_models()['heavy_modules'] == []
+
+
+def test_import_models_time_budget():
+    assert import_models()['models_time'] < IMPORT_TIME_BUDGET